@@ -3,18 +3,17 @@ import os
 import sys
 import logging
 import json
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, request, jsonify, send_from_directory, render_template
 from flask_cors import CORS
 import numpy as np
-from PIL import Image
 import uuid
 from datetime import datetime
 import tempfile # Added for temporary file handling
 import argparse
-import cv2
 import sys
 import threading
 import time
+import queue
 
 def get_base_path():
     """
@@ -52,6 +51,10 @@ import bce_embedding
 import qwen_service
 import database_utils as db
 import faiss_utils as fu
+import cache_utils
+import embedding_store
+import image_loader
+import inference_service
 
 # --- 新增/修改开始 ---
 # 导入新增的人脸服务模块
@@ -72,16 +75,57 @@ CLIP_MODEL_DOWNLOAD_ROOT = os.path.join(CURRENT_DIR, "models")
 
 UPLOADS_DIR = os.path.join(CURRENT_DIR, "uploads")
 THUMBNAILS_DIR = os.path.join(CURRENT_DIR, "thumbnails")
-TEMP_SEARCH_UPLOADS_DIR = os.path.join(UPLOADS_DIR, "temp_search") # For temporary search images
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(THUMBNAILS_DIR, exist_ok=True)
-os.makedirs(TEMP_SEARCH_UPLOADS_DIR, exist_ok=True) # Create temp dir for search image
 os.makedirs(os.path.join(CURRENT_DIR, "data"), exist_ok=True) 
 os.makedirs(CLIP_MODEL_DOWNLOAD_ROOT, exist_ok=True)
 
 clip_model = None
 clip_preprocess = None
 
+# 多进程部署 (gunicorn, 见 gunicorn.conf.py): 每个 HTTP worker 以 mmap 只读方式共享FAISS索引,
+# CLIP/BCE 推理通过 inference_client 发送给集中推理进程; 单进程运行 app.py 时 worker_mode 为 False
+worker_mode = False
+inference_client = None
+INFERENCE_CONNECT_TIMEOUT = 600
+RUN_DIR = os.path.join(CURRENT_DIR, "data", "run")
+# worker 跟随共享索引日志、检查配置文件和发布后台任务状态的间隔
+WORKER_SYNC_INTERVAL_SECONDS = 1.0
+# 主 worker (持有 primary.lock) 负责启动时的索引对账和定期的文件核对, 其他 worker 在它退出后接替
+primary_lock_file = None
+
+# 检索结果集缓存: 保存每次检索的排序ID列表, 翻页时只查询元数据
+SEARCH_PAGE_SIZE = 50
+# 检索结果分数的含义: 相似度 (前端按阈值过滤) 或 RRF 排名分数 (fusion_method 为 rrf 时, 只用于排序, 不能与相似度阈值比较)
+SCORE_TYPE_SIMILARITY = "similarity"
+SCORE_TYPE_RANK = "rank"
+# 批量文本检索单次请求的最大查询数
+SEARCH_BATCH_MAX_QUERIES = 256
+# 图搜图: 返回CLIP相似度大于该阈值的全部图片 (请求中可用 threshold 覆盖), 结果数量上限防止阈值过低时结果集过大
+IMAGE_SEARCH_SIMILARITY_THRESHOLD = 0.6
+IMAGE_SEARCH_MAX_RESULTS = 10000
+# 多进程部署时结果集同时写入共享目录, 翻页请求 (/search_results) 可以由任意 worker 处理
+search_result_cache = cache_utils.SharedTTLCache(name="检索结果缓存")
+SEARCH_RESULT_SHARED_DIR = os.path.join(RUN_DIR, "search_results")
+
+# 查询文本向量缓存: 键为 (文本模型版本, 规范化后的查询文本), 值同时包含 CLIP 与 BCE 查询向量,
+# 重复的查询直接复用, 不再经过分词和TPU文本推理。启动时用最常见的查询预热。
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+QUERY_EMBEDDING_CACHE_TTL = 7 * 24 * 3600
+QUERY_CACHE_PRELOAD_COUNT = 200
+QUERY_STATS_FILE = os.path.join(CURRENT_DIR, "data", "query_stats.json")
+query_embedding_cache = cache_utils.TTLCache(max_entries=QUERY_EMBEDDING_CACHE_SIZE, ttl_seconds=QUERY_EMBEDDING_CACHE_TTL,
+                                             name="查询向量缓存")
+query_stats = cache_utils.QueryStats(QUERY_STATS_FILE)
+query_model_version = None
+# 检索查询缓存: 键为 (接口, 规范化的查询, 检索模式, 过滤条件, top_k, 融合参数, 数据版本), 值为排序结果。
+# 数据版本由 faiss_utils 的索引版本号与 database_utils 的数据版本号组成, 任何写入都会使旧条目不再命中。
+search_query_cache = cache_utils.TTLCache(name="检索查询缓存")
+
+# 常驻内存的CLIP向量矩阵, 与CLIP索引同步写入; 精确重排、融合检索补算相似度直接读取, 无需解析数据库中的JSON
+CLIP_EMBEDDING_STORE_PATH = os.path.join(CURRENT_DIR, "data", "clip_embeddings.npy")
+clip_store = None
+
 # --- 批量增强分析状态管理 ---
 batch_enhance_status = {
     "is_running": False,
@@ -105,8 +149,15 @@ batch_clip_status = {
     "current_image_filename": None,
     "start_time": None,
     "errors": [],
-    "last_error": None
+    "last_error": None,
+    "pipeline": {}
 }
+# 批量CLIP分析按流水线执行: 多个线程解码并预处理图片 -> 一个推理线程按整批推理 -> 写入线程批量更新数据库与索引,
+# 解码线程把预处理结果直接写入批量缓冲池中一块 (B, 3, H, W) 缓冲的对应行, 写满后整块交给推理线程 (解码结果最多积压 BATCH_CLIP_QUEUE_BATCHES 批),
+# 推理结果经有界队列交给写入线程; 解码、推理与写入互相重叠
+BATCH_CLIP_DECODE_THREADS = 4
+BATCH_CLIP_QUEUE_BATCHES = 2
+BATCH_CLIP_REMOTE_INFER_BATCH = 16 # 推理在集中推理进程中执行时每次提交的图片数
 
 # --- 批量人脸检测状态管理 ---
 batch_face_detection_status = {
@@ -144,6 +195,58 @@ batch_face_detection_lock = threading.Lock()
 batch_face_clustering_thread = None
 batch_face_clustering_lock = threading.Lock()
 
+# --- FAISS 与数据库一致性对账状态管理 ---
+# report: {索引名称: {"index_total", "db_total", "orphans", "missing", "removed", "added", "unrecoverable", "orphan_sample", "missing_sample"}}
+RECONCILE_ADD_CHUNK = 4096
+RECONCILE_SAMPLE_SIZE = 20
+reconcile_status = {
+    "is_running": False,
+    "dry_run": False,
+    "trigger": None,
+    "start_time": None,
+    "finish_time": None,
+    "duration_seconds": None,
+    "report": {},
+    "last_error": None
+}
+reconcile_thread = None
+reconcile_lock = threading.Lock()
+
+# --- 图片文件存在性校验状态管理 ---
+# 检索/列表接口按数据库中的 original_exists / thumbnail_exists 生成URL, 由该任务定期与文件系统核对
+FILE_VERIFY_CHUNK = 1000
+FILE_VERIFY_INTERVAL_MINUTES = 360
+file_verify_status = {
+    "is_running": False,
+    "trigger": None,
+    "start_time": None,
+    "finish_time": None,
+    "duration_seconds": None,
+    "checked_count": 0,
+    "missing_originals": 0,
+    "missing_thumbnails": 0,
+    "changed_count": 0,
+    "last_error": None
+}
+file_verify_thread = None
+file_verify_lock = threading.Lock()
+
+# --- 多进程部署时的后台任务协调 ---
+# 后台任务在收到启动请求的 worker 中运行, 运行期间的状态每秒发布到 JOB_STATUS_DIR/<任务>.json,
+# 其他 worker 收到的状态请求直接返回发布的状态; 停止请求写入 <任务>.stop, 由运行任务的 worker 读取后停止。
+JOB_STATUS_DIR = os.path.join(RUN_DIR, "jobs")
+# 发布的状态超过该时间未更新时, 视为运行任务的 worker 已退出
+JOB_STATUS_STALE_SECONDS = 10
+shared_jobs = {
+    "batch_enhance": (batch_enhance_status, batch_enhance_lock),
+    "batch_clip": (batch_clip_status, batch_clip_lock),
+    "batch_face_detection": (batch_face_detection_status, batch_face_detection_lock),
+    "batch_face_clustering": (batch_face_clustering_status, batch_face_clustering_lock),
+    "reconcile": (reconcile_status, reconcile_lock),
+    "file_verify": (file_verify_status, file_verify_lock),
+}
+jobs_published_running = set()
+
 
 # --- 应用配置 (可持久化或从配置文件加载) ---
 APP_CONFIG_FILE = os.path.join(CURRENT_DIR, "data", "app_config.json")
@@ -160,6 +263,39 @@ default_app_config = {
     "face_recognition_enabled": True, # 是否在上传时自动识别人脸
     "face_api_url": "http://127.0.0.1:8000", # 您的人脸识别服务地址
     "face_cluster_threshold": 0.5, # 人脸聚类相似度阈值 (内积)，需要根据模型效果微调
+    # FAISS索引自动扩展与检索参数
+    "faiss_ivf_threshold": fu.IVF_THRESHOLD, # 向量数量超过该值后迁移到 IVF-Flat (0 表示禁用)
+    "faiss_hnsw_threshold": fu.HNSW_THRESHOLD, # 向量数量超过该值后迁移到 HNSW (0 表示禁用)
+    "faiss_nprobe": fu.IVF_NPROBE, # IVF 检索时访问的聚类数量
+    "faiss_ef_search": fu.HNSW_EF_SEARCH, # HNSW 检索时的候选队列长度
+    "faiss_storage": fu.STORAGE_FLOAT32, # 向量存储格式: "float32" / "fp16" / "sq8"
+    "faiss_rerank_factor": fu.RERANK_FACTOR, # 压缩存储时的候选倍数, 候选用全精度向量精确重排
+    "faiss_lazy_load": True, # 启动时以 mmap 只读方式加载索引, 可写索引在后台加载 (重启后生效)
+    # 增强搜索时CLIP索引与BCE索引结果的融合方式 ("weighted" 或 "rrf") 及权重
+    "search_fusion_method": fu.FUSION_WEIGHTED,
+    "search_clip_weight": 1.0,
+    "search_bce_weight": 1.0,
+    # 描述/关键词/用户标签的全文检索 (BM25, 按最高分归一化到 0~1) 分数与向量相似度加和时的权重 (0 表示不使用)
+    "search_lexical_weight": 1.0,
+    # 检索方式: "fused" (各索引分别检索后融合) 或 "two_stage" (CLIP取候选后用BCE/关键词分数重排), 及两阶段的候选数量
+    "search_retrieval_mode": fu.RETRIEVAL_FUSED,
+    "search_two_stage_candidates": fu.TWO_STAGE_CANDIDATES,
+    # 检索结果分页: 每页数量, 以及排序结果在服务端缓存的有效期 (秒)
+    "search_page_size": SEARCH_PAGE_SIZE,
+    "search_cache_ttl": cache_utils.DEFAULT_TTL_SECONDS,
+    # 查询向量缓存的最大条目数, 以及启动时预热的最常见查询数量 (0 表示不预热)
+    "query_cache_size": QUERY_EMBEDDING_CACHE_SIZE,
+    "query_cache_preload_count": QUERY_CACHE_PRELOAD_COUNT,
+    # 启动时在后台对账FAISS索引与数据库 (删除孤立向量, 补齐缺失向量)
+    "faiss_reconcile_on_startup": True,
+    # 常驻CLIP向量矩阵的存储类型 ("float32" 或 "float16", 内存减半) 及是否以 mmap 加载快照 (重启后生效)
+    "embedding_store_dtype": "float32",
+    "embedding_store_mmap": True,
+    # 计算CLIP向量时 JPEG 按 DCT 缩小解码 (更快, 但输入与已有的按原尺寸解码得到的向量略有差异, 开启后宜重新批量CLIP分析);
+    # 缩略图总是缩小解码
+    "clip_reduced_decode": False,
+    # 后台核对图片文件是否存在的间隔 (分钟, 启动时先执行一次; 0 表示只在启动和手动触发时执行)
+    "file_verify_interval_minutes": FILE_VERIFY_INTERVAL_MINUTES,
 }
 # --- 新增/修改结束 ---
 
@@ -194,6 +330,18 @@ def save_app_config():
         logging.error(f"保存配置到 {APP_CONFIG_FILE} 失败: {e}")
 
 
+def apply_faiss_index_config():
+    """将应用配置中的FAISS自动扩展阈值与检索参数应用到 faiss_utils。"""
+    fu.configure_index(
+        ivf_threshold=app_config.get("faiss_ivf_threshold"),
+        hnsw_threshold=app_config.get("faiss_hnsw_threshold"),
+        nprobe=app_config.get("faiss_nprobe"),
+        ef_search=app_config.get("faiss_ef_search"),
+        storage=app_config.get("faiss_storage"),
+        rerank_factor=app_config.get("faiss_rerank_factor")
+    )
+
+
 def load_bce_model_on_startup(args):
     global bce_service
     try:
@@ -225,36 +373,172 @@ def load_clip_model_on_startup(args):
         logging.error(f"加载 Chinese-CLIP 模型失败: {e}", exc_info=True)
         clip_model = None
 
+def load_clip_vectors(ids):
+    """CLIP全精度向量来源: 常驻向量矩阵加载完成后直接读取, 之前退回数据库"""
+    if clip_store is not None and clip_store.ready:
+        return clip_store.get_vectors(ids)
+    return db.get_embeddings_by_faiss_ids(ids, "clip_embedding")
+
+def init_clip_store():
+    """创建常驻CLIP向量矩阵并注册到CLIP索引, 在后台加载快照并与数据库核对"""
+    global clip_store
+    clip_store = embedding_store.EmbeddingStore(fu.CLIP_EMBEDDING_DIM, CLIP_EMBEDDING_STORE_PATH,
+                                                dtype=app_config.get("embedding_store_dtype", "float32"),
+                                                name="CLIP向量矩阵")
+    fu.set_embedding_store(fu.CLIP_INDEX, clip_store)
+    threading.Thread(
+        target=clip_store.load,
+        args=(lambda: db.get_live_faiss_ids("has_clip_embedding"),
+              lambda ids: db.get_embeddings_by_faiss_ids(ids, "clip_embedding"),
+              app_config.get("embedding_store_mmap", True)),
+        daemon=True
+    ).start()
+
+def clip_decode_target() -> int | None:
+    """
+    CLIP 输入只需 letterbox 到模型分辨率, 开启 clip_reduced_decode 时 JPEG 按能覆盖该分辨率的最小比例解码;
+    默认返回 None (按原尺寸解码), 使新上传和图搜图的向量与库中已有的向量一致
+    """
+    if not app_config.get("clip_reduced_decode", False):
+        return None
+    return getattr(clip_model, "image_resolution", None)
+
 def compute_clip_image_embedding(image_path: str) -> np.ndarray | None:
+    return compute_clip_image_embedding_for(image_loader.read_bgr(image_path, clip_decode_target()), image_path)
+
+def compute_clip_image_embedding_from_bytes(data: bytes, name: str = "上传的图片") -> np.ndarray | None:
+    """直接在内存中解码图片数据并计算CLIP embedding, 无需写入临时文件"""
+    img = image_loader.read_bgr(data, clip_decode_target()) if data else None
+    return compute_clip_image_embedding_for(img, name)
+
+def compute_clip_image_embedding_for(img: np.ndarray | None, image_path: str) -> np.ndarray | None:
+    """对已解码的 BGR 图片计算归一化的CLIP embedding, image_path 仅用于日志"""
     if not clip_model or not clip_preprocess:
         logging.error("CLIP模型未加载，无法计算图像 embedding。")
         return None
+    if img is None:
+        logging.error(f"无法解码图像 '{image_path}'。")
+        return None
     try:
-        img = cv2.imread(image_path)
-        image_input = np.expand_dims(clip_preprocess(img), axis=0)
-        image_features = clip_model.encode_image(image_input)
+        image_input = clip_preprocess(img)
+        image_batcher = getattr(clip_model, "image_batcher", None)
+        if image_batcher is not None:
+            # 与并发的上传/图搜图请求合并成一批推理
+            image_features = image_batcher.submit(image_input).result()[None]
+        else:
+            image_features = clip_model.encode_image(np.expand_dims(image_input, axis=0))
         image_features /= np.linalg.norm(image_features,axis=-1, keepdims=True)
         return image_features.astype(np.float32)[0]
     except Exception as e:
         logging.error(f"计算图像 '{image_path}' 的CLIP embedding失败: {e}")
         return None
 
+def encode_clip_text_tokens(tokens: np.ndarray) -> np.ndarray:
+    """文本推理: 本进程加载模型时逐条提交给请求合并调度器, 与并发的检索请求合并成批"""
+    text_batcher = getattr(clip_model, "text_batcher", None)
+    if text_batcher is not None:
+        return text_batcher.encode(tokens)
+    return clip_model.encode_text(tokens)
+
 def compute_clip_text_embedding(text: str) -> np.ndarray | None:
     if not clip_model:
         logging.error("CLIP模型未加载，无法计算文本 embedding。")
         return None
     try:
         tokens = clip.tokenize([text])
-        text_features = clip_model.encode_text(tokens)
+        text_features = encode_clip_text_tokens(tokens)
         text_features /= np.linalg.norm(text_features,axis=-1, keepdims=True)
         return text_features.astype(np.float32)[0]
     except Exception as e:
         logging.error(f"计算文本 '{text[:20]}...' 的CLIP embedding失败: {e}")
         return None
 
+def compute_clip_text_embeddings(texts: list) -> np.ndarray | None:
+    """批量计算文本的CLIP embedding: 一次分词, 按文本模型的batch大小整批推理。返回 (N, d) 矩阵。"""
+    if not clip_model:
+        logging.error("CLIP模型未加载，无法计算文本 embedding。")
+        return None
+    try:
+        tokens = clip.tokenize(list(texts))
+        text_features = encode_clip_text_tokens(tokens)
+        text_features /= np.linalg.norm(text_features,axis=-1, keepdims=True)
+        return text_features.astype(np.float32)
+    except Exception as e:
+        logging.error(f"批量计算 {len(texts)} 条文本的CLIP embedding失败: {e}")
+        return None
+
+def model_file_version(model_path: str) -> str:
+    """模型文件的版本标识 (文件名 + 大小 + 修改时间), 替换模型文件后查询向量缓存自动失效"""
+    try:
+        stat = os.stat(model_path)
+        return f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        return os.path.basename(model_path)
+
+def search_data_version() -> tuple:
+    """检索结果依赖的数据版本: 向量索引或数据库发生任何写入后都会变化"""
+    return fu.get_index_version(), db.get_data_version()
+
+def get_query_embeddings(texts: list, with_bce: bool, record: bool = True):
+    """
+    查询文本的 CLIP / BCE 向量: 先查查询向量缓存, 未命中的文本整批推理后写入缓存。
+    返回 (CLIP矩阵, BCE矩阵), 第 i 行对应 texts[i]。CLIP 推理失败时前者为 None;
+    with_bce 为 False 或 BCE 向量无法计算时后者为 None。record 为 True 时计入查询统计, 用于下次启动预热。
+    """
+    keys = [cache_utils.normalize_query_text(text) for text in texts]
+    entries = {}
+    for key in dict.fromkeys(keys):
+        cached = query_embedding_cache.get((query_model_version, key))
+        entries[key] = dict(cached) if cached else {"clip": None, "bce": None}
+    computed = set()
+
+    missing_clip = [key for key, entry in entries.items() if entry["clip"] is None]
+    if missing_clip:
+        clip_embs = compute_clip_text_embeddings(missing_clip)
+        if clip_embs is None:
+            return None, None
+        for key, emb in zip(missing_clip, clip_embs):
+            entries[key]["clip"] = emb
+        computed.update(missing_clip)
+
+    missing_bce = [key for key, entry in entries.items() if entry["bce"] is None] if with_bce and bce_service else []
+    if missing_bce:
+        try:
+            bce_embs = bce_service.get_bce_embeddings(missing_bce)
+            if bce_embs.shape != (len(missing_bce), fu.BCE_EMBEDDING_DIM):
+                raise ValueError(f"维度不符: {bce_embs.shape}")
+            for key, emb in zip(missing_bce, bce_embs.astype(np.float32)):
+                entries[key]["bce"] = emb
+            computed.update(missing_bce)
+        except Exception as e:
+            logging.warning(f"计算 {len(missing_bce)} 条查询的BCE embedding失败: {e}")
+
+    for key in computed:
+        query_embedding_cache.put((query_model_version, key), entries[key])
+    if record:
+        query_stats.record(keys)
+
+    clip_matrix = np.stack([entries[key]["clip"] for key in keys])
+    bce_matrix = None
+    if with_bce and all(entries[key]["bce"] is not None for key in keys):
+        bce_matrix = np.stack([entries[key]["bce"] for key in keys])
+    return clip_matrix, bce_matrix
+
+def preload_query_embeddings():
+    """用查询统计中最常见的查询预热查询向量缓存"""
+    texts = query_stats.most_common(app_config.get("query_cache_preload_count", QUERY_CACHE_PRELOAD_COUNT))
+    if not texts or not clip_model:
+        return
+    start_time = time.time()
+    for start_idx in range(0, len(texts), SEARCH_BATCH_MAX_QUERIES):
+        get_query_embeddings(texts[start_idx:start_idx + SEARCH_BATCH_MAX_QUERIES],
+                             with_bce=bce_service is not None, record=False)
+    logging.info(f"查询向量缓存已预热 {len(texts)} 条常见查询, 耗时 {time.time() - start_time:.2f} 秒")
+
 def generate_thumbnail(image_path: str, thumbnail_path: str, size=(256, 256)):
     try:
-        img = Image.open(image_path)
+        # JPEG 只按能覆盖缩略图尺寸的比例解码
+        img = image_loader.open_pil(image_path, size)
         img.thumbnail(size)
         if img.mode == 'RGBA' or img.mode == 'LA' or (img.mode == 'P' and 'transparency' in img.info):
             img = img.convert('RGB')
@@ -264,7 +548,36 @@ def generate_thumbnail(image_path: str, thumbnail_path: str, size=(256, 256)):
         logging.error(f"生成缩略图失败 for {image_path}: {e}")
         return False
 
-def process_single_image_upload(file_storage):
+def new_upload_batches():
+    """一次上传请求共用的向量写入缓冲: 所有图片处理完后 (或缓冲满时) 按批写入各索引"""
+    return {
+        "clip": fu.VectorBatch(fu.CLIP_INDEX),
+        "bce": fu.VectorBatch(fu.BCE_INDEX),
+        "face": fu.VectorBatch("face", flush_fn=ffu_face.add_vectors),
+    }
+
+def flush_upload_batches(write_batches: dict, processed_results: list, force: bool = False):
+    """
+    写入上传缓冲中的向量。CLIP向量写入失败时不删除已保存的图片,
+    而是将其 has_clip_embedding 标志位置为 False, 之后可由批量CLIP分析补齐。
+    """
+    for key, vector_batch in write_batches.items():
+        if not force and not vector_batch.should_flush():
+            continue
+        vector_ids, ok = vector_batch.flush()
+        if not vector_ids or ok:
+            continue
+        logging.error(f"上传图片的 {len(vector_ids)} 个向量批量写入{vector_batch.index_name}索引失败。")
+        if key == "clip":
+            failed_ids = set(vector_ids)
+            failed_image_ids = []
+            for result in processed_results:
+                if result["faiss_id"] in failed_ids:
+                    result["analysis_flags"]["has_clip_embedding"] = False
+                    failed_image_ids.append(result["id"])
+            db.update_images_status_flags(failed_image_ids, has_clip_embedding=False)
+
+def process_single_image_upload(file_storage, write_batches: dict):
     original_filename = file_storage.filename
     logging.info(f"[process_single_image_upload] 开始处理文件: {original_filename}")
     
@@ -288,6 +601,7 @@ def process_single_image_upload(file_storage):
     
     image_db_id = None
     actual_faiss_id = None 
+    new_face_ids = []
 
     try:
         file_storage.save(original_path_abs)
@@ -336,18 +650,16 @@ def process_single_image_upload(file_storage):
         actual_faiss_id = image_db_id 
         db.update_faiss_id_for_image(image_db_id, actual_faiss_id)
 
-        # 2. FAISS索引处理（如果有CLIP embedding）
+        # 2. FAISS索引处理（如果有CLIP embedding）, 向量在请求结束时按批写入
         if clip_img_emb is not None:
-            zeros_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
-            concatenated_emb = np.concatenate((clip_img_emb, zeros_bce_emb))
-            
-            if not fu.add_vector_to_index(concatenated_emb, actual_faiss_id):
-                logging.error(f"图片 '{original_filename}' 添加到FAISS失败")
+            if clip_img_emb.shape[-1] != fu.CLIP_EMBEDDING_DIM:
+                logging.error(f"图片 '{original_filename}' CLIP向量维度 ({clip_img_emb.shape[-1]}) 与索引不符，添加到FAISS失败")
                 # 回滚数据库记录
                 db.hard_delete_image_from_db(image_db_id)
                 if os.path.exists(original_path_abs): os.remove(original_path_abs)
                 if thumbnail_path_abs and os.path.exists(thumbnail_path_abs): os.remove(thumbnail_path_abs)
                 return None
+            write_batches["clip"].append(clip_img_emb, actual_faiss_id)
 
         # 3. Qwen-VL增强分析处理
         if app_config.get("qwen_vl_analysis_enabled", True):
@@ -357,15 +669,14 @@ def process_single_image_upload(file_storage):
                 db.update_image_enhancement(image_db_id, qwen_result["description"], qwen_result["keywords"])
                 status_flags['is_enhanced'] = True
                 
-                # 更新FAISS向量（如果有CLIP embedding）
-                if clip_img_emb is not None:
-                    bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"]) 
-                    if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
-                        updated_concatenated_emb = np.concatenate((clip_img_emb, bce_desc_emb))
-                        fu.update_vector_in_index(updated_concatenated_emb, actual_faiss_id) 
-                        logging.info(f"图片 ID: {image_db_id} Qwen-VL分析完成并更新了FAISS向量")
-                    else:
-                        logging.warning(f"图片 ID: {image_db_id} BCE embedding生成失败，FAISS向量未更新BCE部分")
+                # 将描述的BCE向量写入BCE索引
+                bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"]) 
+                if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
+                    db.update_image_bce_embedding(image_db_id, bce_desc_emb)
+                    write_batches["bce"].append(bce_desc_emb, actual_faiss_id)
+                    logging.info(f"图片 ID: {image_db_id} Qwen-VL分析完成，BCE向量等待写入BCE索引")
+                else:
+                    logging.warning(f"图片 ID: {image_db_id} BCE embedding生成失败，未写入BCE索引")
             else:
                 error_msg = qwen_result.get("error", "未知错误") if qwen_result else "返回结果为空"
                 logging.warning(f"图片 ID: {image_db_id} Qwen-VL分析失败: {error_msg}")
@@ -384,8 +695,11 @@ def process_single_image_upload(file_storage):
                     for i, face in enumerate(detected_faces):
                         feature_vec = face["FeatureData"]
                         
-                        # 在人脸FAISS中搜索最相似的人脸
+                        # 在人脸FAISS和本次请求尚未写入的人脸中搜索最相似的人脸
                         sims, face_ids = ffu_face.search_vectors_in_index(feature_vec, top_k=1)
+                        pending_sim, pending_face_id = write_batches["face"].best_match(feature_vec)
+                        if pending_sim is not None and (not sims or pending_sim > sims[0]):
+                            sims, face_ids = [pending_sim], [pending_face_id]
                         
                         cluster_id = None
                         # 如果找到了相似人脸且相似度超过阈值
@@ -414,12 +728,11 @@ def process_single_image_upload(file_storage):
                         )
 
                         if new_face_id:
-                            # 将新的人脸特征向量添加到人脸FAISS索引中
-                            ffu_face.add_vector_to_index(feature_vec, new_face_id)
+                            # 新的人脸特征向量加入人脸索引的写入缓冲
+                            write_batches["face"].append(feature_vec, new_face_id)
+                            new_face_ids.append(new_face_id)
                     
                     status_flags['has_face_clustering'] = True
-                    # 保存人脸FAISS索引
-                    ffu_face.save_faiss_index()
                 else:
                     # 人脸聚类被禁用，只存储人脸信息但不进行聚类
                     for face in detected_faces:
@@ -453,18 +766,231 @@ def process_single_image_upload(file_storage):
     except Exception as e:
         logging.error(f"处理上传图片 '{original_filename}' 时发生严重错误: {e}", exc_info=True)
         if image_db_id: 
-            if actual_faiss_id and fu.faiss_index is not None: 
-                try: 
-                    fu.faiss_index.remove_ids(np.array([actual_faiss_id], dtype='int64'))
-                    logging.info(f"FAISS ID {actual_faiss_id} removed during error cleanup.")
-                except Exception as fe: 
-                    logging.error(f"处理错误后FAISS回滚失败: {fe}")
+            if actual_faiss_id:
+                # 向量尚未写入索引, 从写入缓冲中丢弃即可
+                write_batches["clip"].discard([actual_faiss_id])
+                write_batches["bce"].discard([actual_faiss_id])
+                write_batches["face"].discard(new_face_ids)
+                logging.info(f"FAISS ID {actual_faiss_id} removed during error cleanup.")
             db.hard_delete_image_from_db(image_db_id) 
         
         if os.path.exists(original_path_abs): os.remove(original_path_abs)
         if thumbnail_path_abs and os.path.exists(thumbnail_path_abs): os.remove(thumbnail_path_abs)
         return None
 
+def _flush_enhance_batch(vector_batch):
+    """将批量增强分析累积的CLIP或BCE向量一次写入对应索引"""
+    faiss_ids, ok = vector_batch.flush()
+    if not faiss_ids:
+        return
+    if ok:
+        logging.info(f"{len(faiss_ids)} 个向量已批量写入{vector_batch.index_name}索引。")
+        return
+    error_msg = f"{len(faiss_ids)} 个向量批量写入{vector_batch.index_name}索引失败 (faiss_id: {faiss_ids[:10]}...)"
+    logging.error(error_msg)
+    with batch_enhance_lock:
+        batch_enhance_status["last_error"] = error_msg
+
+def _sorted_setdiff(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """a 中不在 b 中的元素, a、b 均为升序数组 (二分查找, 百万级ID只需几十毫秒)"""
+    if len(b) == 0:
+        return a
+    positions = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[positions] != a]
+
+def _reconcile_one(name: str, index_ids: np.ndarray, live_ids: np.ndarray, expected_ids: np.ndarray,
+                   remove_fn, load_fn, add_fn, dry_run: bool) -> dict:
+    """
+    对账单个索引: index_ids 为索引中的ID, live_ids 为数据库中仍存在的记录, expected_ids 为应当在索引中的记录
+    (均为升序int64数组)。索引中有而数据库中没有的ID为孤立向量, 直接删除; 数据库中有而索引中没有的ID
+    为缺失向量, 通过 load_fn 从数据库取回存储的向量后分批写入, 数据库中没有存储向量的记为 unrecoverable。
+    """
+    orphans = _sorted_setdiff(index_ids, live_ids)
+    missing = _sorted_setdiff(expected_ids, index_ids)
+    result = {
+        "index_total": int(len(index_ids)),
+        "db_total": int(len(expected_ids)),
+        "orphans": int(len(orphans)),
+        "missing": int(len(missing)),
+        "removed": 0,
+        "added": 0,
+        "unrecoverable": 0,
+        "orphan_sample": orphans[:RECONCILE_SAMPLE_SIZE].tolist(),
+        "missing_sample": missing[:RECONCILE_SAMPLE_SIZE].tolist(),
+    }
+    if dry_run:
+        return result
+    if len(orphans):
+        result["removed"] = int(remove_fn(orphans))
+        logging.info(f"[对账] {name}: 删除了 {result['removed']} 个孤立向量。")
+    for start in range(0, len(missing), RECONCILE_ADD_CHUNK):
+        chunk = missing[start:start + RECONCILE_ADD_CHUNK]
+        found_ids, vectors = load_fn(chunk)
+        result["unrecoverable"] += len(chunk) - len(found_ids)
+        if len(found_ids) and add_fn(vectors, found_ids):
+            result["added"] += int(len(found_ids))
+        elif len(found_ids):
+            result["unrecoverable"] += int(len(found_ids))
+    if len(missing):
+        logging.info(f"[对账] {name}: 补齐了 {result['added']} 个缺失向量，{result['unrecoverable']} 个无法恢复。")
+    return result
+
+def reconcile_worker(dry_run: bool = False, trigger: str = "manual"):
+    """对账 CLIP / BCE / 人脸索引与数据库, 只比较ID集合 (向量化的集合运算), 只为有差异的记录读取向量"""
+    with reconcile_lock:
+        if reconcile_status["is_running"]:
+            logging.warning("索引对账已在运行中，跳过重复启动。")
+            return
+        reconcile_status.update({
+            "is_running": True,
+            "dry_run": dry_run,
+            "trigger": trigger,
+            "start_time": time.time(),
+            "finish_time": None,
+            "duration_seconds": None,
+            "report": {},
+            "last_error": None
+        })
+
+    try:
+        logging.info(f"开始对账FAISS索引与数据库 (dry_run={dry_run}, trigger={trigger})...")
+        report = {}
+        live_faiss_ids = db.get_live_faiss_ids()
+        for index_name, column, status_flag in ((fu.CLIP_INDEX, "clip_embedding", "has_clip_embedding"),
+                                                (fu.BCE_INDEX, "bce_embedding", "is_enhanced")):
+            report[index_name] = _reconcile_one(
+                index_name,
+                fu.get_index_ids(index_name),
+                live_faiss_ids,
+                db.get_live_faiss_ids(status_flag),
+                lambda ids, index_name=index_name: fu.remove_vectors(ids, (index_name,)),
+                lambda ids, column=column: db.get_embeddings_by_faiss_ids(ids, column),
+                lambda vectors, ids, index_name=index_name: fu.upsert_vectors(vectors, ids, index_name),
+                dry_run
+            )
+            with reconcile_lock:
+                reconcile_status["report"] = dict(report)
+
+        report["face"] = _reconcile_one(
+            "face",
+            ffu_face.get_index_ids(),
+            db.get_live_face_ids(),
+            db.get_live_face_ids(clustered_only=True),
+            ffu_face.remove_vectors_from_index,
+            db.get_face_features_by_ids,
+            ffu_face.add_vectors,
+            dry_run
+        )
+
+        if not dry_run and any(item["removed"] or item["added"] for item in report.values()):
+            fu.save_faiss_index()
+            ffu_face.save_faiss_index()
+        with reconcile_lock:
+            reconcile_status["report"] = report
+        logging.info(f"FAISS索引对账完成，耗时 {time.time() - reconcile_status['start_time']:.2f} 秒: "
+                     + ", ".join(f"{name} 孤立 {item['orphans']} / 缺失 {item['missing']}" for name, item in report.items()))
+
+    except Exception as e:
+        error_msg = f"FAISS索引对账过程中发生错误: {str(e)}"
+        logging.error(error_msg, exc_info=True)
+        with reconcile_lock:
+            reconcile_status["last_error"] = error_msg
+
+    finally:
+        with reconcile_lock:
+            reconcile_status["is_running"] = False
+            reconcile_status["finish_time"] = time.time()
+            reconcile_status["duration_seconds"] = round(reconcile_status["finish_time"] - reconcile_status["start_time"], 3)
+
+def start_reconcile(dry_run: bool = False, trigger: str = "manual") -> bool:
+    """在后台线程中启动对账, 已在运行时返回 False"""
+    global reconcile_thread
+    with reconcile_lock:
+        if reconcile_status["is_running"]:
+            return False
+    reconcile_thread = threading.Thread(target=reconcile_worker, args=(dry_run, trigger), daemon=True)
+    reconcile_thread.start()
+    return True
+
+def file_verify_worker(trigger: str = "manual"):
+    """按ID分批核对原图/缩略图是否存在, 只更新与文件系统不一致的标志位"""
+    with file_verify_lock:
+        if file_verify_status["is_running"]:
+            logging.warning("文件校验已在运行中，跳过重复启动。")
+            return
+        file_verify_status.update({
+            "is_running": True,
+            "trigger": trigger,
+            "start_time": time.time(),
+            "finish_time": None,
+            "duration_seconds": None,
+            "checked_count": 0,
+            "missing_originals": 0,
+            "missing_thumbnails": 0,
+            "changed_count": 0,
+            "last_error": None
+        })
+
+    try:
+        logging.info(f"开始核对图片文件是否存在 (trigger={trigger})...")
+        last_id = 0
+        while True:
+            records = db.get_image_file_records(last_id, FILE_VERIFY_CHUNK)
+            if not records:
+                break
+            last_id = records[-1]["id"]
+            changes = []
+            missing_originals = 0
+            missing_thumbnails = 0
+            for record in records:
+                original_exists = bool(record["original_path"]) and os.path.exists(os.path.join(CURRENT_DIR, record["original_path"]))
+                thumbnail_exists = bool(record["thumbnail_path"]) and os.path.exists(os.path.join(CURRENT_DIR, record["thumbnail_path"]))
+                missing_originals += not original_exists
+                missing_thumbnails += not thumbnail_exists
+                if original_exists != bool(record["original_exists"]) or thumbnail_exists != bool(record["thumbnail_exists"]):
+                    changes.append((record["id"], original_exists, thumbnail_exists))
+            if changes:
+                db.update_images_file_flags(changes)
+            with file_verify_lock:
+                file_verify_status["checked_count"] += len(records)
+                file_verify_status["missing_originals"] += missing_originals
+                file_verify_status["missing_thumbnails"] += missing_thumbnails
+                file_verify_status["changed_count"] += len(changes)
+        logging.info(f"图片文件核对完成: 检查 {file_verify_status['checked_count']} 张，"
+                     f"原图缺失 {file_verify_status['missing_originals']}，缩略图缺失 {file_verify_status['missing_thumbnails']}，"
+                     f"更新 {file_verify_status['changed_count']} 条记录。")
+
+    except Exception as e:
+        error_msg = f"核对图片文件时发生错误: {str(e)}"
+        logging.error(error_msg, exc_info=True)
+        with file_verify_lock:
+            file_verify_status["last_error"] = error_msg
+
+    finally:
+        with file_verify_lock:
+            file_verify_status["is_running"] = False
+            file_verify_status["finish_time"] = time.time()
+            file_verify_status["duration_seconds"] = round(file_verify_status["finish_time"] - file_verify_status["start_time"], 3)
+
+def start_file_verify(trigger: str = "manual") -> bool:
+    """在后台线程中启动文件校验, 已在运行时返回 False"""
+    global file_verify_thread
+    with file_verify_lock:
+        if file_verify_status["is_running"]:
+            return False
+    file_verify_thread = threading.Thread(target=file_verify_worker, args=(trigger,), daemon=True)
+    file_verify_thread.start()
+    return True
+
+def file_verify_scheduler():
+    """启动时核对一次, 之后按 file_verify_interval_minutes 定期核对 (每轮重新读取设置)"""
+    file_verify_worker(trigger="startup")
+    while True:
+        interval_minutes = app_config.get("file_verify_interval_minutes", FILE_VERIFY_INTERVAL_MINUTES)
+        time.sleep(max(float(interval_minutes), 1.0) * 60)
+        if app_config.get("file_verify_interval_minutes", FILE_VERIFY_INTERVAL_MINUTES) > 0:
+            file_verify_worker(trigger="scheduled")
+
 def batch_enhance_worker():
     """批量增强分析的工作线程函数"""
     global batch_enhance_status
@@ -502,6 +1028,9 @@ def batch_enhance_worker():
         
         logging.info(f"找到 {len(unenhanced_images)} 张未增强的图片，开始处理...")
         
+        # CLIP / BCE 向量先累积在缓冲中, 按批写入索引
+        clip_batch = fu.VectorBatch(fu.CLIP_INDEX)
+        bce_batch = fu.VectorBatch(fu.BCE_INDEX)
         for image_record in unenhanced_images:
             # 检查是否被停止
             with batch_enhance_lock:
@@ -523,6 +1052,7 @@ def batch_enhance_worker():
                 if not os.path.exists(absolute_original_path):
                     error_msg = f"图片文件不存在: {absolute_original_path}"
                     logging.warning(error_msg)
+                    db.update_image_file_flags(image_record["id"], original_exists=False)
                     with batch_enhance_lock:
                         batch_enhance_status["errors"].append({
                             "image_id": image_record["id"], 
@@ -559,27 +1089,18 @@ def batch_enhance_worker():
                             else:
                                 logging.error(f"图片 ID: {image_record['id']} CLIP embedding重新计算失败")
                         
-                        if clip_img_emb is not None:
-                            # 生成BCE embedding
-                            bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"])
-                            if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
-                                updated_concatenated_emb = np.concatenate((clip_img_emb, bce_desc_emb))
-                            else:
-                                zeros_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
-                                updated_concatenated_emb = np.concatenate((clip_img_emb, zeros_bce_emb))
-                            
-                            # 更新FAISS向量
-                            faiss_id = image_record["faiss_id"] if image_record["faiss_id"] else image_record["id"]
-                            if fu.update_vector_in_index(updated_concatenated_emb, faiss_id):
-                                logging.info(f"图片 ID: {image_record['id']} FAISS向量更新成功")
-                            else:
-                                # 如果更新失败，尝试添加新向量
-                                if fu.add_vector_to_index(updated_concatenated_emb, faiss_id):
-                                    logging.info(f"图片 ID: {image_record['id']} FAISS向量添加成功")
-                                else:
-                                    logging.error(f"图片 ID: {image_record['id']} FAISS向量更新和添加都失败")
+                        faiss_id = image_record["faiss_id"] if image_record["faiss_id"] else image_record["id"]
+                        if clip_img_emb is not None and image_record["clip_embedding"] is None:
+                            # 新计算的CLIP向量写入CLIP索引
+                            clip_batch.append(clip_img_emb, faiss_id)
+                        
+                        # 生成BCE embedding并写入BCE索引
+                        bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"])
+                        if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
+                            db.update_image_bce_embedding(image_record["id"], bce_desc_emb)
+                            bce_batch.append(bce_desc_emb, faiss_id)
                         else:
-                            logging.warning(f"图片 ID: {image_record['id']} 无法获取CLIP embedding，跳过FAISS更新")
+                            logging.warning(f"图片 ID: {image_record['id']} BCE embedding生成失败，未写入BCE索引")
                         
                         # 更新状态标志位
                         db.update_image_status_flags(image_record["id"], is_enhanced=True)
@@ -619,9 +1140,17 @@ def batch_enhance_worker():
             with batch_enhance_lock:
                 batch_enhance_status["processed_count"] += 1
             
+            for vector_batch in (clip_batch, bce_batch):
+                if vector_batch.should_flush():
+                    _flush_enhance_batch(vector_batch)
+            
             # 添加小延迟避免过度占用资源
             time.sleep(0.1)
         
+        # 写入剩余的向量
+        for vector_batch in (clip_batch, bce_batch):
+            _flush_enhance_batch(vector_batch)
+        
         # 保存FAISS索引
         try:
             fu.save_faiss_index()
@@ -643,8 +1172,47 @@ def batch_enhance_worker():
         
         logging.info("批量增强分析线程结束。")
 
+def _flush_clip_batch(clip_batch, image_ids_by_faiss_id: dict):
+    """将累积的CLIP向量一次写入索引, 成功后批量更新状态标志位, 失败时为每张图片记录错误"""
+    faiss_ids, ok = clip_batch.flush()
+    image_ids = [image_ids_by_faiss_id.pop(faiss_id) for faiss_id in faiss_ids if faiss_id in image_ids_by_faiss_id]
+    if not image_ids:
+        return
+    if ok:
+        db.update_images_status_flags(image_ids, has_clip_embedding=True)
+        logging.info(f"{len(image_ids)} 张图片的CLIP embedding已批量写入FAISS索引。")
+        return
+    with batch_clip_lock:
+        for image_id in image_ids:
+            error_msg = f"图片 ID: {image_id} FAISS索引更新失败"
+            batch_clip_status["errors"].append({
+                "image_id": image_id, 
+                "error": error_msg
+            })
+            batch_clip_status["last_error"] = error_msg
+    logging.error(f"{len(image_ids)} 张图片的CLIP向量批量写入FAISS索引失败。")
+
+def _clip_pipeline_snapshot(stages: dict, elapsed: float) -> dict:
+    """
+    流水线各阶段的吞吐: images_per_second 为实际吞吐, capacity_per_second 为该阶段满负荷时的吞吐
+    (处理张数 / 忙碌时间 × 线程数), utilization 为忙碌时间占比, 占比最高的阶段即瓶颈。
+    """
+    snapshot = {}
+    for name, stage in stages.items():
+        busy_seconds = stage["busy_seconds"]
+        snapshot[name] = {
+            "threads": stage["threads"],
+            "images": stage["images"],
+            "busy_seconds": round(busy_seconds, 2),
+            "images_per_second": round(stage["images"] / elapsed, 1) if elapsed > 0 else None,
+            "capacity_per_second": round(stage["images"] * stage["threads"] / busy_seconds, 1) if busy_seconds > 0 else None,
+            "utilization": round(busy_seconds / (elapsed * stage["threads"]), 3) if elapsed > 0 else None,
+        }
+    bottleneck = max(snapshot, key=lambda name: snapshot[name]["utilization"] or 0)
+    return {"elapsed_seconds": round(elapsed, 1), "stages": snapshot, "bottleneck": bottleneck}
+
 def batch_clip_worker():
-    """批量CLIP embedding计算的工作线程函数"""
+    """批量CLIP embedding计算的工作线程函数 (本线程为流水线的写入阶段)"""
     global batch_clip_status
     
     with batch_clip_lock:
@@ -660,11 +1228,14 @@ def batch_clip_worker():
             "current_image_filename": None,
             "start_time": time.time(),
             "errors": [],
-            "last_error": None
+            "last_error": None,
+            "pipeline": {}
         })
     
     try:
         logging.info("开始批量CLIP embedding计算...")
+        if not clip_model or not clip_preprocess:
+            raise RuntimeError("CLIP模型未加载")
         
         # 获取没有CLIP embedding的图片列表
         images_without_clip = db.get_images_without_clip_embedding(limit=10000)
@@ -678,99 +1249,240 @@ def batch_clip_worker():
                 batch_clip_status["is_running"] = False
             return
         
-        logging.info(f"找到 {len(images_without_clip)} 张需要计算CLIP embedding的图片，开始处理...")
+        infer_batch_size = getattr(clip_model, "image_net_batch_size", BATCH_CLIP_REMOTE_INFER_BATCH)
+        decode_threads = max(1, min(BATCH_CLIP_DECODE_THREADS, len(images_without_clip)))
+        input_resolution = clip_model.image_resolution
+        decode_target = clip_decode_target()
+        logging.info(f"找到 {len(images_without_clip)} 张需要计算CLIP embedding的图片，开始处理 "
+                     f"(解码线程 {decode_threads}，推理批大小 {infer_batch_size})...")
         
+        task_queue = queue.Queue()
         for image_record in images_without_clip:
-            # 检查是否被停止
-            with batch_clip_lock:
-                if batch_clip_status["is_stopped"]:
-                    logging.info("批量CLIP分析被用户停止。")
-                    break
-                    
-                # 更新当前处理状态
-                batch_clip_status["current_image_id"] = image_record["id"]
-                original_path = image_record["original_path"]
-                batch_clip_status["current_image_filename"] = os.path.basename(original_path) if original_path else f"ID_{image_record['id']}"
-            
+            task_queue.put(image_record)
+        # 解码线程把预处理结果直接写入批量缓冲的一行 (clip_preprocess(img, out=行)), 写满一批后整块交给推理线程,
+        # 推理直接使用缓冲的前 n 行, 不再逐张分配和拼接。缓冲在池中循环使用, 池的大小同时限制了积压的批数。
+        buffer_pool = queue.Queue()
+        for _ in range(BATCH_CLIP_QUEUE_BATCHES + 2): # 正在填充、排队等待、正在推理的缓冲
+            buffer_pool.put(np.empty((infer_batch_size, 3, input_resolution, input_resolution), dtype=np.float32))
+        # 填充中的批: {"buffer", "entries": [[图片记录, 是否有效]], "pending": 尚未写完的行数, "sealed": 是否不再接收新行}
+        fill_state = {"batch": None, "finished_decoders": 0}
+        fill_lock = threading.Lock()
+        reserve_lock = threading.Lock() # 同一时间只有一个解码线程等待空闲缓冲
+        # 元素为写满的批、解码失败的 (图片记录, None, 错误信息, 文件是否缺失), 最后一个解码线程结束时放入 None
+        decoded_queue = queue.Queue()
+        # 元素为一批 (图片记录, embedding, 错误信息, 文件是否缺失), 推理线程结束时放入 None
+        result_queue = queue.Queue(maxsize=BATCH_CLIP_QUEUE_BATCHES)
+        stop_event = threading.Event()
+        stages = {
+            "decode": {"threads": decode_threads, "images": 0, "busy_seconds": 0.0},
+            "infer": {"threads": 1, "images": 0, "busy_seconds": 0.0},
+            "write": {"threads": 1, "images": 0, "busy_seconds": 0.0},
+        }
+        stages_lock = threading.Lock()
+        pipeline_start = time.perf_counter()
+        
+        def record_stage(name: str, images: int, busy_seconds: float):
+            with stages_lock:
+                stages[name]["images"] += images
+                stages[name]["busy_seconds"] += busy_seconds
+        
+        def pipeline_snapshot() -> dict:
+            with stages_lock:
+                return _clip_pipeline_snapshot(stages, time.perf_counter() - pipeline_start)
+        
+        def reserve_row(image_record):
+            """在填充中的批里占用一行, 返回 (批, 行号); 没有填充中的批时从池中取一个空闲缓冲"""
+            with reserve_lock:
+                with fill_lock:
+                    batch = fill_state["batch"]
+                if batch is None:
+                    batch = {"buffer": buffer_pool.get(), "entries": [], "pending": 0, "sealed": False}
+                with fill_lock:
+                    fill_state["batch"] = batch
+                    row = len(batch["entries"])
+                    batch["entries"].append([image_record, True])
+                    batch["pending"] += 1
+                    if len(batch["entries"]) == infer_batch_size:
+                        batch["sealed"] = True
+                        fill_state["batch"] = None
+                return batch, row
+        
+        def complete_row(batch: dict, row: int, ok: bool):
+            with fill_lock:
+                batch["entries"][row][1] = ok
+                batch["pending"] -= 1
+                ready = batch["sealed"] and batch["pending"] == 0
+            if ready:
+                decoded_queue.put(batch)
+        
+        def decode_loop():
             try:
-                # 构建绝对路径
-                absolute_original_path = os.path.join(CURRENT_DIR, image_record["original_path"])
-                
-                if not os.path.exists(absolute_original_path):
-                    error_msg = f"图片文件不存在: {absolute_original_path}"
-                    logging.warning(error_msg)
-                    with batch_clip_lock:
-                        batch_clip_status["errors"].append({
-                            "image_id": image_record["id"], 
-                            "error": error_msg
-                        })
-                        batch_clip_status["last_error"] = error_msg
-                    continue
-                
-                logging.info(f"正在计算CLIP embedding - 图片 ID: {image_record['id']} - {batch_clip_status['current_image_filename']}")
-                
-                # 计算CLIP embedding
-                clip_img_emb = compute_clip_image_embedding(absolute_original_path)
-                
-                if clip_img_emb is not None:
-                    # 更新数据库中的CLIP embedding
-                    if db.update_image_clip_embedding(image_record["id"], clip_img_emb):
-                        # 更新FAISS索引
-                        zeros_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
-                        concatenated_emb = np.concatenate((clip_img_emb, zeros_bce_emb))
-                        
-                        # 获取faiss_id
-                        faiss_id = image_record["faiss_id"] if image_record["faiss_id"] else image_record["id"]
-                        
-                        # 更新或添加到FAISS索引
-                        if fu.add_vector_to_index(concatenated_emb, faiss_id):
-                            # 更新状态标志位
-                            db.update_image_status_flags(image_record["id"], has_clip_embedding=True)
-                            logging.info(f"图片 ID: {image_record['id']} CLIP embedding计算完成并更新FAISS索引。")
+                while not stop_event.is_set():
+                    try:
+                        image_record = task_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    start_time = time.perf_counter()
+                    error_msg, missing = None, False
+                    absolute_original_path = os.path.join(CURRENT_DIR, image_record["original_path"])
+                    try:
+                        if not os.path.exists(absolute_original_path):
+                            error_msg, missing = f"图片文件不存在: {absolute_original_path}", True
                         else:
-                            error_msg = f"图片 ID: {image_record['id']} FAISS索引更新失败"
-                            logging.error(error_msg)
+                            img = image_loader.read_bgr(absolute_original_path, decode_target)
+                            if img is None:
+                                error_msg = f"图片 ID: {image_record['id']} 无法解码图像"
+                            else:
+                                batch, row = reserve_row(image_record)
+                                try:
+                                    clip_preprocess(img, out=batch["buffer"][row])
+                                    complete_row(batch, row, True)
+                                except Exception:
+                                    complete_row(batch, row, False)
+                                    raise
+                    except Exception as e:
+                        error_msg = f"处理图片 ID: {image_record['id']} 时发生异常: {str(e)}"
+                    record_stage("decode", 1, time.perf_counter() - start_time)
+                    if error_msg:
+                        decoded_queue.put((image_record, None, error_msg, missing))
+            finally:
+                with reserve_lock, fill_lock:
+                    fill_state["finished_decoders"] += 1
+                    last = fill_state["finished_decoders"] == decode_threads
+                    batch = fill_state["batch"] if last else None
+                    if batch is not None:
+                        # 其他解码线程都已结束, 未写满的最后一批没有尚未写完的行
+                        batch["sealed"] = True
+                        fill_state["batch"] = None
+                if batch is not None:
+                    decoded_queue.put(batch)
+                if last:
+                    decoded_queue.put(None)
+        
+        def infer_batch(batch: dict) -> list:
+            start_time = time.perf_counter()
+            entries = batch["entries"]
+            valid_rows = [row for row, (_, ok) in enumerate(entries) if ok]
+            records = [entries[row][0] for row in valid_rows]
+            if not records:
+                return []
+            try:
+                # 全部有效时直接使用缓冲的前 n 行 (连续内存), 否则只取出有效的行
+                image_inputs = batch["buffer"][:len(entries)] if len(valid_rows) == len(entries) else batch["buffer"][valid_rows]
+                image_features = clip_model.encode_image(image_inputs)
+                image_features = image_features / np.linalg.norm(image_features, axis=-1, keepdims=True)
+                image_features = image_features.astype(np.float32)
+                results = [(image_record, image_features[row], None, False) for row, image_record in enumerate(records)]
+            except Exception as e:
+                logging.error(f"{len(records)} 张图片的CLIP批量推理失败: {e}")
+                results = [(image_record, None, f"图片 ID: {image_record['id']} CLIP embedding计算失败: {e}", False)
+                           for image_record in records]
+            record_stage("infer", len(records), time.perf_counter() - start_time)
+            return results
+        
+        def infer_loop():
+            # 被停止后仍要取完解码队列并归还缓冲, 解码线程才不会阻塞在空的缓冲池上; 停止后解码出的图片直接丢弃
+            failed = []
+            try:
+                while True:
+                    item = decoded_queue.get()
+                    if item is None:
+                        break
+                    batch = item if isinstance(item, dict) else None
+                    try:
+                        if not stop_event.is_set():
                             with batch_clip_lock:
-                                batch_clip_status["errors"].append({
-                                    "image_id": image_record["id"], 
-                                    "error": error_msg
-                                })
-                                batch_clip_status["last_error"] = error_msg
-                    else:
-                        error_msg = f"图片 ID: {image_record['id']} 数据库更新失败"
-                        logging.error(error_msg)
-                        with batch_clip_lock:
-                            batch_clip_status["errors"].append({
-                                "image_id": image_record["id"], 
-                                "error": error_msg
-                            })
-                            batch_clip_status["last_error"] = error_msg
-                else:
-                    error_msg = f"图片 ID: {image_record['id']} CLIP embedding计算失败"
-                    logging.warning(error_msg)
-                    with batch_clip_lock:
-                        batch_clip_status["errors"].append({
-                            "image_id": image_record["id"], 
-                            "error": error_msg
-                        })
-                        batch_clip_status["last_error"] = error_msg
-                
+                                stopped = batch_clip_status["is_stopped"]
+                            if stopped:
+                                logging.info("批量CLIP分析被用户停止。")
+                                stop_event.set()
+                            elif batch is None:
+                                failed.append(item)
+                            else:
+                                results = infer_batch(batch) + failed
+                                failed = []
+                                if results:
+                                    result_queue.put(results)
+                    finally:
+                        if batch is not None:
+                            buffer_pool.put(batch["buffer"])
+                if failed:
+                    result_queue.put(failed)
             except Exception as e:
-                error_msg = f"处理图片 ID: {image_record['id']} 时发生异常: {str(e)}"
-                logging.error(error_msg, exc_info=True)
-                with batch_clip_lock:
+                logging.error(f"批量CLIP推理线程异常: {e}", exc_info=True)
+                stop_event.set()
+                while True:
+                    item = decoded_queue.get()
+                    if item is None:
+                        break
+                    if isinstance(item, dict):
+                        buffer_pool.put(item["buffer"])
+            finally:
+                result_queue.put(None)
+        
+        workers = [threading.Thread(target=decode_loop, name=f"BatchClipDecode-{i}", daemon=True) for i in range(decode_threads)]
+        workers.append(threading.Thread(target=infer_loop, name="BatchClipInfer", daemon=True))
+        for worker in workers:
+            worker.start()
+        
+        # 写入阶段: 每批一次事务写入数据库, 向量累积在缓冲中按批写入索引
+        clip_batch = fu.VectorBatch(fu.CLIP_INDEX)
+        image_ids_by_faiss_id = {}
+        while True:
+            results = result_queue.get()
+            if results is None:
+                break
+            start_time = time.perf_counter()
+            errors = []
+            try:
+                missing_records = [image_record for image_record, _, _, missing in results if missing]
+                if missing_records:
+                    db.update_images_file_flags([(image_record["id"], False, None) for image_record in missing_records])
+                embedded = [(image_record, clip_img_emb) for image_record, clip_img_emb, _, _ in results if clip_img_emb is not None]
+                updated_ids = set(db.update_images_clip_embeddings([(image_record["id"], clip_img_emb) for image_record, clip_img_emb in embedded]))
+                for image_record, clip_img_emb in embedded:
+                    if image_record["id"] not in updated_ids:
+                        errors.append((image_record["id"], f"图片 ID: {image_record['id']} 数据库更新失败"))
+                        continue
+                    # 加入写入缓冲, 写入索引成功后再更新状态标志位
+                    faiss_id = image_record["faiss_id"] if image_record["faiss_id"] else image_record["id"]
+                    clip_batch.append(clip_img_emb, faiss_id)
+                    image_ids_by_faiss_id[faiss_id] = image_record["id"]
+                errors.extend((image_record["id"], error_msg) for image_record, _, error_msg, _ in results if error_msg)
+                if clip_batch.should_flush():
+                    _flush_clip_batch(clip_batch, image_ids_by_faiss_id)
+            except Exception as e:
+                errors.append((results[-1][0]["id"], f"写入 {len(results)} 张图片的CLIP embedding时发生异常: {str(e)}"))
+            record_stage("write", len(results), time.perf_counter() - start_time)
+            
+            for _, error_msg in errors:
+                logging.warning(error_msg)
+            last_record = results[-1][0]
+            pipeline = pipeline_snapshot()
+            with batch_clip_lock:
+                for image_id, error_msg in errors:
                     batch_clip_status["errors"].append({
-                        "image_id": image_record["id"], 
+                        "image_id": image_id, 
                         "error": error_msg
                     })
                     batch_clip_status["last_error"] = error_msg
-            
-            # 更新处理计数
-            with batch_clip_lock:
-                batch_clip_status["processed_count"] += 1
-            
-            # 添加小延迟避免过度占用资源
-            time.sleep(0.1)
+                batch_clip_status["processed_count"] += len(results)
+                batch_clip_status["current_image_id"] = last_record["id"]
+                original_path = last_record["original_path"]
+                batch_clip_status["current_image_filename"] = os.path.basename(original_path) if original_path else f"ID_{last_record['id']}"
+                batch_clip_status["pipeline"] = pipeline
+        
+        for worker in workers:
+            worker.join()
+        
+        # 写入剩余的向量 (包括被用户停止时已计算的部分)
+        _flush_clip_batch(clip_batch, image_ids_by_faiss_id)
+        pipeline = pipeline_snapshot()
+        with batch_clip_lock:
+            batch_clip_status["pipeline"] = pipeline
+        logging.info("批量CLIP流水线各阶段吞吐 (张/秒): " + ", ".join(
+            f"{name} {stage['images_per_second']} (满负荷 {stage['capacity_per_second']}, 利用率 {stage['utilization']})"
+            for name, stage in pipeline["stages"].items()) + f"，瓶颈: {pipeline['bottleneck']}")
         
         # 保存FAISS索引
         try:
@@ -849,6 +1561,7 @@ def batch_face_detection_worker():
                 if not os.path.exists(absolute_original_path):
                     error_msg = f"图片文件不存在: {absolute_original_path}"
                     logging.warning(error_msg)
+                    db.update_image_file_flags(image_record["id"], original_exists=False)
                     with batch_face_detection_lock:
                         batch_face_detection_status["errors"].append({
                             "image_id": image_record["id"], 
@@ -930,6 +1643,15 @@ def batch_face_detection_worker():
         
         logging.info("批量人脸检测线程结束。")
 
+def _flush_face_batch(face_batch):
+    """将批量人脸聚类累积的人脸向量一次写入人脸索引"""
+    face_ids, ok = face_batch.flush()
+    if face_ids and not ok:
+        error_msg = f"{len(face_ids)} 个人脸向量批量写入人脸FAISS索引失败 (face_id: {face_ids[:10]}...)"
+        logging.error(error_msg)
+        with batch_face_clustering_lock:
+            batch_face_clustering_status["last_error"] = error_msg
+
 def batch_face_clustering_worker():
     """批量人脸聚类的工作线程函数"""
     global batch_face_clustering_status
@@ -967,6 +1689,8 @@ def batch_face_clustering_worker():
         logging.info(f"找到 {len(faces_without_cluster)} 张需要聚类的人脸，开始处理...")
         cluster_threshold = app_config.get("face_cluster_threshold", 0.5)
         
+        # 人脸向量先累积在缓冲中按批写入索引; 匹配时同时比较缓冲中尚未写入的人脸
+        face_batch = fu.VectorBatch("face", flush_fn=ffu_face.add_vectors)
         for face_record in faces_without_cluster:
             # 检查是否被停止
             with batch_face_clustering_lock:
@@ -989,6 +1713,9 @@ def batch_face_clustering_worker():
                 
                 # 在人脸FAISS中搜索最相似的人脸
                 sims, face_ids = ffu_face.search_vectors_in_index(feature_vec, top_k=1)
+                pending_sim, pending_face_id = face_batch.best_match(feature_vec)
+                if pending_sim is not None and (not sims or pending_sim > sims[0]):
+                    sims, face_ids = [pending_sim], [pending_face_id]
                 
                 cluster_id = None
                 # 如果找到了相似人脸且相似度超过阈值
@@ -1007,8 +1734,8 @@ def batch_face_clustering_worker():
                 
                 # 更新人脸的聚类信息
                 if db.update_face_cluster(face_record["face_id"], cluster_id):
-                    # 将人脸特征向量添加到FAISS索引
-                    ffu_face.add_vector_to_index(feature_vec, face_record["face_id"])
+                    # 将人脸特征向量加入写入缓冲
+                    face_batch.append(feature_vec, face_record["face_id"])
                     
                     # 更新对应图片的人脸聚类状态标志位
                     db.update_image_status_flags(face_record["image_id"], has_face_clustering=True)
@@ -1038,9 +1765,15 @@ def batch_face_clustering_worker():
             with batch_face_clustering_lock:
                 batch_face_clustering_status["processed_count"] += 1
             
+            if face_batch.should_flush():
+                _flush_face_batch(face_batch)
+            
             # 添加小延迟避免过度占用资源
             time.sleep(0.1)
         
+        # 写入剩余的人脸向量
+        _flush_face_batch(face_batch)
+        
         # 保存人脸FAISS索引
         try:
             ffu_face.save_faiss_index()
@@ -1081,18 +1814,22 @@ def upload_images_api():
 
     processed_results = []
     failed_count = 0
+    write_batches = new_upload_batches()
     for file_storage in files:
         if file_storage and file_storage.filename: 
-            result = process_single_image_upload(file_storage)
+            result = process_single_image_upload(file_storage, write_batches)
             if result:
                 processed_results.append(result)
             else:
                 failed_count += 1
+            flush_upload_batches(write_batches, processed_results)
         else:
             failed_count +=1 
+    flush_upload_batches(write_batches, processed_results, force=True)
     
     if processed_results:
         fu.save_faiss_index() 
+        ffu_face.save_faiss_index()
         return jsonify({
             "message": f"成功处理 {len(processed_results)} 张图片，失败 {failed_count} 张。",
             "processed_files": processed_results
@@ -1103,95 +1840,436 @@ def upload_images_api():
         return jsonify({"error": "未提供有效文件进行处理。"}), 400
 
 
-@app.route('/search_images', methods=['POST'])
-def search_images_api():
-    if not clip_model or fu.faiss_index is None:
-        return jsonify({"error": "模型或FAISS索引未初始化。"}), 503
-    
-    data = request.get_json()
-    if not data: return jsonify({"error": "请求数据为空"}), 400
+def build_file_urls(image_data):
+    """
+    根据数据库中的文件存在标志位生成 (thumbnail_url, original_url), 只做字符串拼接, 不访问文件系统。
+    标志位在写入/删除时维护, 并由后台文件校验任务定期核对。
+    """
+    thumbnail_path = image_data["thumbnail_path"]
+    original_path = image_data["original_path"]
+    thumbnail_url = f"/thumbnails/{os.path.basename(thumbnail_path)}" if thumbnail_path and image_data["thumbnail_exists"] else None
+    original_url = f"/uploads/{os.path.basename(original_path)}" if original_path and image_data["original_exists"] else None
+    return thumbnail_url, original_url
+
+def format_search_result(image_data, similarity: float) -> dict:
+    """将数据库中的图片记录整理为检索结果条目"""
+    try:
+        keywords_list = json.loads(image_data["qwen_keywords"]) if image_data["qwen_keywords"] else []
+    except (json.JSONDecodeError, TypeError):
+        keywords_list = []
+    try:
+        user_tags_list = json.loads(image_data["user_tags"]) if image_data["user_tags"] else []
+    except (json.JSONDecodeError, TypeError):
+        user_tags_list = []
+
+    thumbnail_url, original_url = build_file_urls(image_data)
+
+    return {
+        "id": image_data["id"],
+        "faiss_id": image_data["faiss_id"],
+        "filename": image_data["original_filename"],
+        "thumbnail_url": thumbnail_url,
+        "original_url": original_url,
+        "similarity": similarity, 
+        "qwen_description": image_data["qwen_description"],
+        "qwen_keywords": keywords_list,
+        "user_tags": user_tags_list, 
+        "is_enhanced": image_data["is_enhanced"]
+    }
+
+def parse_page_size(value) -> int:
+    """解析请求中的每页数量, 缺省时取应用设置; 格式错误时抛出 ValueError"""
+    if value is None or value == '':
+        return int(app_config.get("search_page_size", SEARCH_PAGE_SIZE))
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        page_size = 0
+    if page_size < 1:
+        raise ValueError("page_size 必须是正整数")
+    return page_size
+
+def get_search_page(result_set_id: str, result_set: dict, offset: int, page_size: int) -> dict:
+    """
+    从缓存的结果集中取出一页: 这一页的元数据通过一次批量查询按排名顺序取回。
+    result_set: {"key": "faiss_id" 或 "id", "ids": 排序后的ID列表, "scores": 对应的相似度, "meta": 检索信息}
+    返回 {"results", "cursor" (下一页游标, 没有更多时为 None), "total_results"}。
+    """
+    lookup = db.get_images_by_faiss_ids if result_set["key"] == "faiss_id" else db.get_images_by_ids
+    page_ids = result_set["ids"][offset:offset + page_size]
+    page_scores = result_set["scores"][offset:offset + page_size]
+    results = []
+    for image_key, similarity, image_data in zip(page_ids, page_scores, lookup(page_ids)):
+        if image_data:
+            results.append(format_search_result(image_data, similarity))
+        else:
+            logging.warning(f"在数据库中未找到{result_set['key']}为 {image_key} 的图片记录 (可能已被删除或不同步)。")
+    next_offset = offset + len(page_ids)
+    return {
+        "results": results,
+        "cursor": cache_utils.encode_cursor(result_set_id, next_offset) if next_offset < len(result_set["ids"]) else None,
+        "total_results": len(result_set["ids"]),
+    }
+
+def parse_search_filters(filters):
+    """
+    解析检索请求中的 filters 对象, 返回 db.get_faiss_ids_by_filters 的关键字参数 (没有任何过滤条件时返回 None)。
+    格式错误时抛出 ValueError。
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters 必须是对象")
+    parsed = {}
+    tags = filters.get("tags")
+    if tags:
+        if isinstance(tags, str):
+            tags = [tags]
+        if not isinstance(tags, list):
+            raise ValueError("filters.tags 必须是字符串列表")
+        tags = [str(tag).strip() for tag in tags if str(tag).strip()]
+        if tags:
+            parsed["tags"] = tags
+    for key in ("date_from", "date_to"):
+        value = filters.get(key)
+        if value:
+            value = str(value).strip()
+            try:
+                datetime.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"filters.{key} 必须是 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS 格式")
+            parsed[key] = value.replace("T", " ")
+    if filters.get("is_enhanced") is not None:
+        if not isinstance(filters["is_enhanced"], bool):
+            raise ValueError("filters.is_enhanced 必须是布尔值")
+        parsed["is_enhanced"] = filters["is_enhanced"]
+    cluster_ids = filters.get("cluster_ids", filters.get("cluster_id"))
+    if cluster_ids is not None and cluster_ids != []:
+        if not isinstance(cluster_ids, list):
+            cluster_ids = [cluster_ids]
+        try:
+            parsed["cluster_ids"] = [int(cluster_id) for cluster_id in cluster_ids]
+        except (TypeError, ValueError):
+            raise ValueError("filters.cluster_ids 必须是整数列表")
+    person_name = str(filters.get("person_name") or "").strip()
+    if person_name:
+        parsed["person_name"] = person_name
+    return parsed or None
+
+def parse_fusion_options(data: dict):
+    """融合方式和权重可在请求中覆盖应用配置，无需重建索引。返回 (fusion_method, weights), 格式错误时抛出 ValueError。"""
+    fusion_method = data.get('fusion_method', app_config.get("search_fusion_method", fu.FUSION_WEIGHTED))
+    if fusion_method not in (fu.FUSION_WEIGHTED, fu.FUSION_RRF):
+        raise ValueError(f"不支持的融合方式: {fusion_method}")
+    try:
+        weights = {
+            fu.CLIP_INDEX: float(data.get('clip_weight', app_config.get("search_clip_weight", 1.0))),
+            fu.BCE_INDEX: float(data.get('bce_weight', app_config.get("search_bce_weight", 1.0))),
+            fu.LEXICAL_SOURCE: float(data.get('lexical_weight', app_config.get("search_lexical_weight", 1.0))),
+        }
+    except (TypeError, ValueError):
+        raise ValueError("clip_weight、bce_weight 和 lexical_weight 必须是数字")
+    return fusion_method, weights
+
+def parse_retrieval_options(data: dict):
+    """检索方式与两阶段检索的候选数量, 可在请求中覆盖应用配置。返回 (retrieval_mode, num_candidates), 格式错误时抛出 ValueError。"""
+    retrieval_mode = data.get('retrieval_mode', app_config.get("search_retrieval_mode", fu.RETRIEVAL_FUSED))
+    if retrieval_mode not in (fu.RETRIEVAL_FUSED, fu.RETRIEVAL_TWO_STAGE):
+        raise ValueError(f"不支持的检索方式: {retrieval_mode}")
+    try:
+        num_candidates = int(data.get('num_candidates', app_config.get("search_two_stage_candidates", fu.TWO_STAGE_CANDIDATES)))
+    except (TypeError, ValueError):
+        raise ValueError("num_candidates 必须是整数")
+    if num_candidates < 1:
+        raise ValueError("num_candidates 必须大于 0")
+    return retrieval_mode, num_candidates
+
+def lexical_candidate_scores(query_text: str):
+    """两阶段检索的关键词分数: 候选的 BM25 分数除以候选中的最大值, 归一化到 [0, 1]"""
+    def scores_for(candidate_ids):
+        bm25_scores = db.get_fts_scores(query_text, candidate_ids)
+        best = max(bm25_scores.values(), default=0.0)
+        if best <= 0:
+            return {}
+        return {fu.LEXICAL_SOURCE: [bm25_scores.get(faiss_id, 0.0) / best for faiss_id in candidate_ids.tolist()]}
+    return scores_for
+
+def fuse_lexical_results(query_text: str, query_vectors: dict, distances, faiss_ids, weights: dict, fusion_method: str,
+                         top_k: int, allowed_ids=None):
+    """
+    在描述、关键词和用户标签的全文索引中检索 (BM25), 与向量检索结果合并。返回 (scores, ids)。
+    - weighted: 与两阶段检索相同, 分数为加权相似度 + lexical_weight × BM25 分数 (按命中中的最高分归一化到 0~1);
+      只由关键词命中的图片从存储的向量精确计算相似度, 因此分数始终是相似度, 可以按阈值过滤。
+    - rrf: 向量检索的排名与关键词检索的排名做 RRF 融合 (分数本来就是排名分数)。
+    关键词检索没有命中或权重为 0 时原样返回向量检索结果。
+    """
+    lexical_weight = weights.get(fu.LEXICAL_SOURCE, 1.0)
+    if lexical_weight <= 0:
+        return distances, faiss_ids
+    lexical_ids, bm25_scores = db.search_images_fts(query_text, limit=top_k)
+    if allowed_ids is not None:
+        allowed = set(np.asarray(allowed_ids).tolist())
+        lexical_hits = [(faiss_id, score) for faiss_id, score in zip(lexical_ids, bm25_scores) if faiss_id in allowed]
+        lexical_ids = [faiss_id for faiss_id, _ in lexical_hits]
+        bm25_scores = [score for _, score in lexical_hits]
+    if not lexical_ids:
+        return distances, faiss_ids
+    if fusion_method == fu.FUSION_RRF:
+        return fu.fuse_ranked_lists({"vector": list(faiss_ids), fu.LEXICAL_SOURCE: lexical_ids},
+                                    {"vector": 1.0, fu.LEXICAL_SOURCE: lexical_weight}, top_k=top_k)
+
+    scores = dict(zip(faiss_ids, distances))
+    missing = [faiss_id for faiss_id in lexical_ids if faiss_id not in scores]
+    if missing:
+        scores.update(zip(missing, fu.score_ids(query_vectors, missing, weights)))
+    best = max(bm25_scores)
+    if best > 0:
+        for faiss_id, bm25_score in zip(lexical_ids, bm25_scores):
+            scores[faiss_id] += lexical_weight * bm25_score / best
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [score for _, score in ranked], [faiss_id for faiss_id, _ in ranked]
+
+def score_type_for(fusion_method: str) -> str:
+    """结果分数的含义: "similarity" 为 (加权) 相似度, 可以按阈值过滤; "rank" 为 RRF 排名分数, 只用于排序"""
+    return SCORE_TYPE_RANK if fusion_method == fu.FUSION_RRF else SCORE_TYPE_SIMILARITY
+
+def run_text_search(data: dict):
+    """
+    /search_images 与 /search_images_stream 共用的文本检索: 解析请求、检索并缓存完整的排序结果。
+    返回 (result_set_id, result_set, response): 检索到结果时 response 为 None;
+    请求无效或没有结果时前两项为 None, response 为 (响应体, 状态码)。
+    """
+    if not clip_model or fu.clip_index is None:
+        return None, None, ({"error": "模型或FAISS索引未初始化。"}, 503)
+    if not data: return None, None, ({"error": "请求数据为空"}, 400)
 
     query_text = data.get('query_text', '').strip()
     top_k = int(data.get('top_k', 200)) 
     if not query_text:
-        return jsonify({"error": "查询文本不能为空"}), 400
-
-    query_clip_emb = compute_clip_text_embedding(query_text) 
-    if query_clip_emb is None:
-        return jsonify({"error": "无法计算查询文本的CLIP embedding"}), 500
+        return None, None, ({"error": "查询文本不能为空"}, 400)
+    try:
+        filters = parse_search_filters(data.get('filters'))
+        fusion_method, weights = parse_fusion_options(data)
+        retrieval_mode, num_candidates = parse_retrieval_options(data)
+    except ValueError as e:
+        return None, None, ({"error": str(e)}, 400)
 
     use_enhanced = app_config.get("use_enhanced_search", True)
-    logging.info(f"搜索模式: {'增强搜索' if use_enhanced else '仅CLIP搜索'}")
-
+    logging.info(f"搜索模式: {'增强搜索' if use_enhanced else '仅CLIP搜索'}, 检索方式: {retrieval_mode}")
+
+    # 相同的检索在数据未变化时直接复用已缓存的排序结果, 不再推理和检索
+    cache_key = ("search_images", cache_utils.normalize_query_text(query_text), use_enhanced,
+                 json.dumps(filters, sort_keys=True), top_k, fusion_method, tuple(sorted(weights.items())),
+                 retrieval_mode, num_candidates, search_data_version())
+    result_set_id = search_query_cache.get(cache_key)
+    result_set = search_result_cache.get(result_set_id) if result_set_id else None
+    if result_set is not None:
+        return result_set_id, result_set, None
+
+    # 过滤条件先通过SQLite索引解析为ID集合, 再在FAISS中只检索这些ID
+    allowed_ids = None
+    if filters:
+        allowed_ids = db.get_faiss_ids_by_filters(**filters)
+        logging.info(f"检索过滤条件 {filters} 匹配 {len(allowed_ids)} 张图片")
+        if len(allowed_ids) == 0:
+            return None, None, ({
+                "query": query_text,
+                "results": [],
+                "message": "没有符合过滤条件的图片。",
+                "cursor": None,
+                "total_results": 0,
+                "filters": filters,
+                "search_mode_is_enhanced": use_enhanced
+            }, 200)
+
+    query_clip_embs, query_bce_embs = get_query_embeddings([query_text], with_bce=use_enhanced)
+    if query_clip_embs is None:
+        return None, None, ({"error": "无法计算查询文本的CLIP embedding"}, 500)
+
+    query_vectors = {fu.CLIP_INDEX: query_clip_embs[0]}
     if use_enhanced:
-        query_bce_emb = bce_service.get_bce_embedding(query_text)
-        if query_bce_emb is None or query_bce_emb.shape[0] != fu.BCE_EMBEDDING_DIM:
-            logging.warning(f"增强搜索的BCE embedding生成失败或维度不符。将使用零向量代替BCE部分。")
-            query_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
+        if query_bce_embs is None:
+            logging.warning(f"增强搜索的BCE embedding生成失败或维度不符。将仅使用CLIP索引检索。")
+        else:
+            query_vectors[fu.BCE_INDEX] = query_bce_embs[0]
+
+    if retrieval_mode == fu.RETRIEVAL_TWO_STAGE:
+        # CLIP索引取候选, 只对候选计算BCE相似度与关键词分数并按权重重排
+        extra_scores_fn = lexical_candidate_scores(query_text) if weights.get(fu.LEXICAL_SOURCE, 1.0) > 0 else None
+        distances, faiss_ids = fu.search_two_stage(query_vectors, top_k=top_k, weights=weights, num_candidates=num_candidates,
+                                                   allowed_ids=allowed_ids, extra_scores_fn=extra_scores_fn)
+        score_type = SCORE_TYPE_SIMILARITY
     else:
-        query_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
-    
-    concatenated_query_emb = np.concatenate((query_clip_emb, query_bce_emb))
-    
-    distances, faiss_ids = fu.search_vectors_in_index(concatenated_query_emb, top_k=top_k)
-    results = []
+        distances, faiss_ids = fu.search_fused(query_vectors, top_k=top_k, weights=weights, method=fusion_method,
+                                               allowed_ids=allowed_ids)
+        # 精确的关键词/标签匹配由全文索引补充, 其分数与向量相似度加权合并
+        distances, faiss_ids = fuse_lexical_results(query_text, query_vectors, distances, faiss_ids, weights, fusion_method,
+                                                    top_k, allowed_ids)
+        score_type = score_type_for(fusion_method)
     if not faiss_ids: 
-        return jsonify({
+        return None, None, ({
             "query": query_text, 
             "results": [], 
             "message": "未找到匹配图片。",
+            "cursor": None,
+            "total_results": 0,
+            "filters": filters,
             "search_mode_is_enhanced": use_enhanced
-        }), 200
+        }, 200)
 
-    for i in range(len(faiss_ids)):
-        faiss_id_val = int(faiss_ids[i])
-        similarity = float(distances[i]) 
-        
-        image_data = db.get_image_by_faiss_id(faiss_id_val) 
-        if image_data:
-            try:
-                keywords_list = json.loads(image_data["qwen_keywords"]) if image_data["qwen_keywords"] else []
-            except (json.JSONDecodeError, TypeError):
-                keywords_list = []
-            
-            try:
-                user_tags_list = json.loads(image_data["user_tags"]) if image_data["user_tags"] else []
-            except (json.JSONDecodeError, TypeError):
-                user_tags_list = []
+    # 完整的排序结果缓存在服务端, 调用方按页 (/search_results) 或按块 (流式响应) 读取
+    meta = {"query": query_text, "filters": filters, "search_mode_is_enhanced": use_enhanced, "retrieval_mode": retrieval_mode,
+            "score_type": score_type}
+    result_set = {"key": "faiss_id", "ids": [int(faiss_id) for faiss_id in faiss_ids],
+                  "scores": [float(distance) for distance in distances], "meta": meta}
+    result_set_id = search_result_cache.add(result_set)
+    search_query_cache.put(cache_key, result_set_id)
+    return result_set_id, result_set, None
 
-            # --- MODIFIED: Rebuild absolute path for existence check ---
-            thumbnail_path_from_db = image_data['thumbnail_path']
-            original_path_from_db = image_data['original_path']
-            
-            thumbnail_url = f"/thumbnails/{os.path.basename(thumbnail_path_from_db)}" if thumbnail_path_from_db and os.path.exists(os.path.join(CURRENT_DIR, thumbnail_path_from_db)) else None
-            original_url = f"/uploads/{os.path.basename(original_path_from_db)}" if original_path_from_db and os.path.exists(os.path.join(CURRENT_DIR, original_path_from_db)) else None
+def ndjson_line(message: dict) -> str:
+    return json.dumps(message, ensure_ascii=False) + "\n"
 
-            results.append({
-                "id": image_data["id"],
-                "faiss_id": image_data["faiss_id"],
-                "filename": image_data["original_filename"],
-                "thumbnail_url": thumbnail_url,
-                "original_url": original_url,
-                "similarity": similarity, 
-                "qwen_description": image_data["qwen_description"],
-                "qwen_keywords": keywords_list,
-                "user_tags": user_tags_list, 
-                "is_enhanced": image_data["is_enhanced"]
-            })
+def stream_result_set(result_set_id: str, result_set: dict, chunk_size: int):
+    """
+    以 NDJSON 逐块输出缓存的结果集: 先输出一行 meta, 之后每块结果在生成时才查询数据库,
+    浏览器收到第一块即可开始渲染, 首个结果的延迟与结果总数无关。
+    """
+    total_results = len(result_set["ids"])
+    yield ndjson_line({"type": "meta", **result_set["meta"], "total_results": total_results})
+    returned = 0
+    try:
+        for offset in range(0, total_results, chunk_size):
+            page = get_search_page(result_set_id, result_set, offset, chunk_size)
+            returned += len(page["results"])
+            yield ndjson_line({"type": "results", "offset": offset, "results": page["results"]})
+    except Exception as e:
+        logging.error(f"流式输出检索结果失败: {e}", exc_info=True)
+        yield ndjson_line({"type": "error", "error": f"输出检索结果失败: {e}"})
+        return
+    yield ndjson_line({"type": "done", "total_results": total_results, "returned": returned})
+
+def ndjson_response(body: dict, status: int):
+    """检索未产生结果集时的流式响应: 出错时返回普通JSON错误, 否则输出只有 meta 与 done 的流"""
+    if status != 200:
+        return jsonify(body), status
+    meta = {key: value for key, value in body.items() if key not in ("results", "cursor")}
+    lines = [ndjson_line({"type": "meta", **meta}), ndjson_line({"type": "done", "total_results": 0, "returned": 0})]
+    return Response(lines, mimetype="application/x-ndjson")
+
+def stream_response(result_set_id: str, result_set: dict, chunk_size: int):
+    # 关闭反向代理 (nginx) 的响应缓冲, 每块结果立即发送给浏览器
+    return Response(stream_result_set(result_set_id, result_set, chunk_size), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"})
+
+@app.route('/search_images', methods=['POST'])
+def search_images_api():
+    data = request.get_json(silent=True)
+    try:
+        page_size = parse_page_size((data or {}).get('page_size'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result_set_id, result_set, response = run_text_search(data)
+    if response is not None:
+        return jsonify(response[0]), response[1]
+    return jsonify({**result_set["meta"], **get_search_page(result_set_id, result_set, 0, page_size)}), 200
+
+@app.route('/search_images_stream', methods=['POST'])
+def search_images_stream_api():
+    """与 /search_images 相同的检索, 以 NDJSON 流式返回全部 top_k 个结果, 每块 page_size 个"""
+    data = request.get_json(silent=True)
+    try:
+        chunk_size = parse_page_size((data or {}).get('page_size'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result_set_id, result_set, response = run_text_search(data)
+    if response is not None:
+        return ndjson_response(*response)
+    return stream_response(result_set_id, result_set, chunk_size)
+
+
+@app.route('/search_images_batch', methods=['POST'])
+def search_images_batch_api():
+    """
+    一次请求检索多条文本: 所有查询一起分词, CLIP / BCE 文本模型整批推理,
+    每个索引只以 (N, d) 查询矩阵调用一次检索。结果按查询文本分组, 每组的翻页方式与 /search_images 相同。
+    """
+    if not clip_model or fu.clip_index is None:
+        return jsonify({"error": "模型或FAISS索引未初始化。"}), 503
+
+    data = request.get_json()
+    if not data: return jsonify({"error": "请求数据为空"}), 400
+
+    queries = data.get('queries')
+    if not isinstance(queries, list):
+        return jsonify({"error": "queries 必须是字符串列表"}), 400
+    # 去掉空白和重复的查询, 保持请求中的顺序
+    queries = list(dict.fromkeys(str(query).strip() for query in queries if str(query).strip()))
+    if not queries:
+        return jsonify({"error": "查询文本不能为空"}), 400
+    if len(queries) > SEARCH_BATCH_MAX_QUERIES:
+        return jsonify({"error": f"单次最多检索 {SEARCH_BATCH_MAX_QUERIES} 条查询"}), 400
+    try:
+        top_k = int(data.get('top_k', 200))
+        filters = parse_search_filters(data.get('filters'))
+        page_size = parse_page_size(data.get('page_size'))
+        fusion_method, weights = parse_fusion_options(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    use_enhanced = app_config.get("use_enhanced_search", True)
+
+    def empty_results(message):
+        return {query: {"query": query, "results": [], "message": message, "cursor": None, "total_results": 0,
+                        "filters": filters, "search_mode_is_enhanced": use_enhanced} for query in queries}
+
+    allowed_ids = None
+    if filters:
+        allowed_ids = db.get_faiss_ids_by_filters(**filters)
+        logging.info(f"批量检索过滤条件 {filters} 匹配 {len(allowed_ids)} 张图片")
+        if len(allowed_ids) == 0:
+            return jsonify({"results": empty_results("没有符合过滤条件的图片。")}), 200
+
+    # 已缓存的查询直接复用向量, 只有未命中的查询整批推理
+    query_clip_embs, query_bce_embs = get_query_embeddings(queries, with_bce=use_enhanced)
+    if query_clip_embs is None:
+        return jsonify({"error": "无法计算查询文本的CLIP embedding"}), 500
+
+    query_matrices = {fu.CLIP_INDEX: query_clip_embs}
+    if use_enhanced:
+        if query_bce_embs is None:
+            logging.warning("增强搜索的批量BCE embedding生成失败。将仅使用CLIP索引检索。")
         else:
-            logging.warning(f"在数据库中未找到FAISS ID为 {faiss_id_val} 的图片记录 (可能已被删除或不同步)。")
-    
-    return jsonify({
-        "query": query_text, 
-        "results": results,
-        "search_mode_is_enhanced": use_enhanced
-    }), 200
+            query_matrices[fu.BCE_INDEX] = query_bce_embs
+
+    start_time = time.time()
+    fused_results = fu.search_fused_batch(query_matrices, top_k=top_k, weights=weights, method=fusion_method,
+                                          allowed_ids=allowed_ids)
+    logging.info(f"批量检索 {len(queries)} 条查询, FAISS检索与融合耗时 {time.time() - start_time:.3f} 秒")
+
+    results = empty_results("未找到匹配图片。")
+    for row, (query, (distances, faiss_ids)) in enumerate(zip(queries, fused_results)):
+        query_vectors = {index_name: matrix[row] for index_name, matrix in query_matrices.items()}
+        distances, faiss_ids = fuse_lexical_results(query, query_vectors, distances, faiss_ids, weights, fusion_method,
+                                                    top_k, allowed_ids)
+        if not faiss_ids:
+            continue
+        meta = {"query": query, "filters": filters, "search_mode_is_enhanced": use_enhanced,
+                "score_type": score_type_for(fusion_method)}
+        result_set = {"key": "faiss_id", "ids": [int(faiss_id) for faiss_id in faiss_ids],
+                      "scores": [float(distance) for distance in distances], "meta": meta}
+        result_set_id = search_result_cache.add(result_set)
+        results[query] = {**meta, **get_search_page(result_set_id, result_set, 0, page_size)}
+    return jsonify({"results": results}), 200
 
 # --- NEW: Image-to-Image Search API ---
 @app.route('/search_by_uploaded_image', methods=['POST'])
 def search_by_uploaded_image_api():
-    if not clip_model:
-        return jsonify({"error": "CLIP模型未初始化。"}), 503
+    """
+    图搜图: 上传的图片在内存中解码并计算CLIP embedding, 再在CLIP索引中做范围检索,
+    返回相似度大于 threshold 的全部图片 (按相似度降序分页)。
+    """
+    if not clip_model or fu.clip_index is None:
+        return jsonify({"error": "CLIP模型或FAISS索引未初始化。"}), 503
     
     if 'image_query_file' not in request.files:
         return jsonify({"error": "请求中未找到图片文件(image_query_file key missing)"}), 400
@@ -1199,101 +2277,61 @@ def search_by_uploaded_image_api():
     uploaded_file = request.files['image_query_file']
     if not uploaded_file or uploaded_file.filename == '':
         return jsonify({"error": "未选择图片文件进行搜索"}), 400
+    try:
+        page_size = parse_page_size(request.form.get('page_size'))
+        threshold = float(request.form.get('threshold', IMAGE_SEARCH_SIMILARITY_THRESHOLD))
+        if not -1.0 <= threshold <= 1.0:
+            raise ValueError
+    except ValueError as e:
+        return jsonify({"error": str(e) or "threshold 必须是 -1 到 1 之间的数字"}), 400
 
     logging.info(f"开始图搜图处理，上传文件名: {uploaded_file.filename}")
 
-    tmp_file_path = None
-    query_clip_emb = None
     try:
-        # Save to a temporary file to pass its path to compute_clip_image_embedding
-        # Suffix helps Pillow determine file type, though compute_clip_image_embedding converts to RGB
-        suffix = os.path.splitext(uploaded_file.filename)[1] if os.path.splitext(uploaded_file.filename)[1] else '.tmp'
-        with tempfile.NamedTemporaryFile(dir=TEMP_SEARCH_UPLOADS_DIR, suffix=suffix, delete=False) as tmp_file:
-            uploaded_file.save(tmp_file.name)
-            tmp_file_path = tmp_file.name
-        
-        logging.info(f"图搜图: 临时文件已保存到 {tmp_file_path}")
-        query_clip_emb = compute_clip_image_embedding(tmp_file_path)
-
+        query_clip_emb = compute_clip_image_embedding_from_bytes(uploaded_file.read())
     except Exception as e:
         logging.error(f"图搜图: 处理上传图片时发生错误: {e}", exc_info=True)
         return jsonify({"error": f"处理上传图片失败: {e}"}), 500
-    finally:
-        if tmp_file_path and os.path.exists(tmp_file_path):
-            try:
-                os.remove(tmp_file_path)
-                logging.info(f"图搜图: 临时文件 {tmp_file_path} 已删除。")
-            except Exception as e_remove:
-                logging.warning(f"图搜图: 无法删除临时文件 {tmp_file_path}: {e_remove}")
 
     if query_clip_emb is None:
         return jsonify({"error": "无法为上传的图片计算CLIP embedding"}), 500
 
-    # Get all valid CLIP embeddings from the database
-    # This list contains dicts: {'id': db_id, 'faiss_id': faiss_id, 'clip_embedding': np.array}
-    all_db_images_data = db.get_all_valid_images_clip_embeddings()
-    if not all_db_images_data:
-        return jsonify({"query_filename": uploaded_file.filename, "results": [], "message": "数据库中没有可比较的图片。"}), 200
-
-    db_clip_embeddings_list = [item['clip_embedding'] for item in all_db_images_data]
-    # Stack into a matrix for batch dot product: (N, D)
-    db_clip_embeddings_matrix = np.array(db_clip_embeddings_list)
-
-    # Calculate cosine similarities (dot product, since embeddings are normalized)
-    # query_clip_emb is (D,), db_clip_embeddings_matrix is (N, D)
-    # Result of dot product will be (N,)
-    similarities = np.dot(db_clip_embeddings_matrix, query_clip_emb) # Already normalized
-
-    results = []
-    SIMILARITY_THRESHOLD = 0.6 # As per requirement
-
-    for i, image_data_item in enumerate(all_db_images_data):
-        similarity_score = float(similarities[i])
-        
-        if similarity_score > SIMILARITY_THRESHOLD:
-            # Fetch full image details from DB using its ID
-            image_full_details = db.get_image_by_id(image_data_item["id"])
-            if image_full_details:
-                try:
-                    keywords_list = json.loads(image_full_details["qwen_keywords"]) if image_full_details["qwen_keywords"] else []
-                except (json.JSONDecodeError, TypeError):
-                    keywords_list = []
-                try:
-                    user_tags_list = json.loads(image_full_details["user_tags"]) if image_full_details["user_tags"] else []
-                except (json.JSONDecodeError, TypeError):
-                    user_tags_list = []
-                
-                # --- MODIFIED: Rebuild absolute path for existence check ---
-                thumbnail_path_from_db = image_full_details['thumbnail_path']
-                original_path_from_db = image_full_details['original_path']
-
-                thumbnail_url = f"/thumbnails/{os.path.basename(thumbnail_path_from_db)}" if thumbnail_path_from_db and os.path.exists(os.path.join(CURRENT_DIR, thumbnail_path_from_db)) else None
-                original_url = f"/uploads/{os.path.basename(original_path_from_db)}" if original_path_from_db and os.path.exists(os.path.join(CURRENT_DIR, original_path_from_db)) else None
-                
-                results.append({
-                    "id": image_full_details["id"],
-                    "faiss_id": image_full_details["faiss_id"], # Though not used for this search, good to return
-                    "filename": image_full_details["original_filename"],
-                    "thumbnail_url": thumbnail_url,
-                    "original_url": original_url,
-                    "similarity": similarity_score, 
-                    "qwen_description": image_full_details["qwen_description"],
-                    "qwen_keywords": keywords_list,
-                    "user_tags": user_tags_list,
-                    "is_enhanced": image_full_details["is_enhanced"]
-                })
-            else:
-                logging.warning(f"图搜图: 在数据库中未找到图片ID为 {image_data_item['id']} 的详细记录，尽管其embedding存在。")
+    # 范围检索: 返回相似度大于阈值的图片, 最多 IMAGE_SEARCH_MAX_RESULTS 张 (按相似度取最高的), 排序结果缓存在服务端, 本次只返回第一页
+    similarities, faiss_ids = fu.range_search_vectors(query_clip_emb, threshold, fu.CLIP_INDEX,
+                                                      max_results=IMAGE_SEARCH_MAX_RESULTS)
+    meta = {"query_filename": uploaded_file.filename, "threshold": threshold,
+            "search_mode_is_enhanced": False, # This is pure CLIP image search
+            "truncated": len(faiss_ids) == IMAGE_SEARCH_MAX_RESULTS} # 达到数量上限, 可能还有更多大于阈值的图片
+    result_set = {"key": "faiss_id", "ids": [int(faiss_id) for faiss_id in faiss_ids],
+                  "scores": [float(similarity) for similarity in similarities], "meta": meta}
+    result_set_id = search_result_cache.add(result_set)
+
+    logging.info(f"图搜图: 为 '{uploaded_file.filename}' 找到 {len(faiss_ids)} 张相似图片 (阈值 > {threshold})。")
+    
+    return jsonify({**meta, **get_search_page(result_set_id, result_set, 0, page_size)}), 200
 
-    # Sort results by similarity, descending
-    results.sort(key=lambda x: x["similarity"], reverse=True)
 
-    logging.info(f"图搜图: 为 '{uploaded_file.filename}' 找到 {len(results)} 张相似图片 (阈值 > {SIMILARITY_THRESHOLD})。")
-    
+@app.route('/search_results', methods=['GET'])
+def get_search_results_page_api():
+    """按游标获取检索结果的后续页, 只查询元数据, 不重新推理和检索"""
+    try:
+        result_set_id, offset = cache_utils.decode_cursor(request.args.get('cursor', ''))
+        page_size = parse_page_size(request.args.get('page_size'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result_set = search_result_cache.get(result_set_id)
+    if result_set is None:
+        return jsonify({"error": "检索结果已过期，请重新搜索。"}), 410
+    return jsonify({**result_set["meta"], **get_search_page(result_set_id, result_set, offset, page_size)}), 200
+
+
+@app.route('/search/cache', methods=['GET'])
+def get_search_cache_status_api():
+    """查询向量缓存与检索结果缓存的命中统计"""
     return jsonify({
-        "query_filename": uploaded_file.filename,
-        "results": results,
-        "search_mode_is_enhanced": False # This is pure CLIP image search
+        "query_embedding_cache": {**query_embedding_cache.status(), "model_version": query_model_version},
+        "search_query_cache": {**search_query_cache.status(), "data_version": list(search_data_version())},
+        "search_result_cache": search_result_cache.status()
     }), 200
 
 
@@ -1313,9 +2351,7 @@ def get_image_details_api(image_db_id):
     except (json.JSONDecodeError, TypeError): 
         user_tags_list = []
 
-    # --- MODIFIED: Rebuild absolute path for existence check ---
-    original_path_from_db = image_data['original_path']
-    original_url = f"/uploads/{os.path.basename(original_path_from_db)}" if original_path_from_db and os.path.exists(os.path.join(CURRENT_DIR, original_path_from_db)) else None
+    _, original_url = build_file_urls(image_data)
 
     details = {
         "id": image_data["id"],
@@ -1404,6 +2440,97 @@ def handle_app_settings():
             app_config['face_cluster_threshold'] = data['face_cluster_threshold']
             logging.info(f"人脸聚类阈值已更新为: {app_config['face_cluster_threshold']}")
             updated_any = True
+
+        # 处理FAISS索引自动扩展与检索参数
+        faiss_settings_updated = False
+        for key in ('faiss_ivf_threshold', 'faiss_hnsw_threshold', 'faiss_nprobe', 'faiss_ef_search'):
+            if key in data and isinstance(data[key], int) and not isinstance(data[key], bool) and data[key] >= 0:
+                app_config[key] = data[key]
+                logging.info(f"{key} 已更新为: {app_config[key]}")
+                faiss_settings_updated = True
+        if data.get('faiss_storage') in fu.STORAGE_MODES:
+            app_config['faiss_storage'] = data['faiss_storage']
+            logging.info(f"FAISS向量存储格式已更新为: {app_config['faiss_storage']}")
+            faiss_settings_updated = True
+        if 'faiss_rerank_factor' in data and isinstance(data['faiss_rerank_factor'], int) \
+                and not isinstance(data['faiss_rerank_factor'], bool) and data['faiss_rerank_factor'] >= 1:
+            app_config['faiss_rerank_factor'] = data['faiss_rerank_factor']
+            logging.info(f"FAISS重排候选倍数已更新为: {app_config['faiss_rerank_factor']}")
+            faiss_settings_updated = True
+        if faiss_settings_updated:
+            apply_faiss_index_config()
+            updated_any = True
+
+        if 'faiss_reconcile_on_startup' in data and isinstance(data['faiss_reconcile_on_startup'], bool):
+            app_config['faiss_reconcile_on_startup'] = data['faiss_reconcile_on_startup']
+            logging.info(f"启动时索引对账已更新为: {app_config['faiss_reconcile_on_startup']}")
+            updated_any = True
+
+        if 'file_verify_interval_minutes' in data and isinstance(data['file_verify_interval_minutes'], (int, float)) \
+                and not isinstance(data['file_verify_interval_minutes'], bool) and data['file_verify_interval_minutes'] >= 0:
+            app_config['file_verify_interval_minutes'] = data['file_verify_interval_minutes']
+            logging.info(f"图片文件核对间隔已更新为: {app_config['file_verify_interval_minutes']} 分钟")
+            updated_any = True
+
+        if data.get('embedding_store_dtype') in embedding_store.STORE_DTYPES:
+            app_config['embedding_store_dtype'] = data['embedding_store_dtype']
+            logging.info(f"CLIP向量矩阵存储类型已更新为: {app_config['embedding_store_dtype']} (重启后生效)")
+            updated_any = True
+        if 'embedding_store_mmap' in data and isinstance(data['embedding_store_mmap'], bool):
+            app_config['embedding_store_mmap'] = data['embedding_store_mmap']
+            logging.info(f"CLIP向量矩阵 mmap 加载已更新为: {app_config['embedding_store_mmap']} (重启后生效)")
+            updated_any = True
+
+        if 'clip_reduced_decode' in data and isinstance(data['clip_reduced_decode'], bool):
+            app_config['clip_reduced_decode'] = data['clip_reduced_decode']
+            logging.info(f"CLIP向量计算的JPEG缩小解码已更新为: {app_config['clip_reduced_decode']}")
+            updated_any = True
+
+        if 'faiss_lazy_load' in data and isinstance(data['faiss_lazy_load'], bool):
+            app_config['faiss_lazy_load'] = data['faiss_lazy_load']
+            logging.info(f"FAISS索引延迟加载已更新为: {app_config['faiss_lazy_load']} (重启后生效)")
+            updated_any = True
+
+        # 处理检索结果融合方式与权重
+        if data.get('search_retrieval_mode') in (fu.RETRIEVAL_FUSED, fu.RETRIEVAL_TWO_STAGE):
+            app_config['search_retrieval_mode'] = data['search_retrieval_mode']
+            logging.info(f"检索方式已更新为: {app_config['search_retrieval_mode']}")
+            updated_any = True
+        if isinstance(data.get('search_two_stage_candidates'), int) and not isinstance(data['search_two_stage_candidates'], bool) \
+                and data['search_two_stage_candidates'] >= 1:
+            app_config['search_two_stage_candidates'] = data['search_two_stage_candidates']
+            logging.info(f"两阶段检索候选数量已更新为: {app_config['search_two_stage_candidates']}")
+            updated_any = True
+
+        if data.get('search_fusion_method') in (fu.FUSION_WEIGHTED, fu.FUSION_RRF):
+            app_config['search_fusion_method'] = data['search_fusion_method']
+            logging.info(f"检索结果融合方式已更新为: {app_config['search_fusion_method']}")
+            updated_any = True
+
+        for key in ('search_clip_weight', 'search_bce_weight', 'search_lexical_weight'):
+            if key in data and isinstance(data[key], (int, float)) and not isinstance(data[key], bool) and data[key] >= 0:
+                app_config[key] = float(data[key])
+                logging.info(f"{key} 已更新为: {app_config[key]}")
+                updated_any = True
+
+        # 处理检索结果分页与缓存有效期
+        for key in ('search_page_size', 'search_cache_ttl'):
+            if key in data and isinstance(data[key], int) and not isinstance(data[key], bool) and data[key] >= 1:
+                app_config[key] = data[key]
+                logging.info(f"{key} 已更新为: {app_config[key]}")
+                updated_any = True
+        if 'search_cache_ttl' in data:
+            search_result_cache.configure(ttl_seconds=app_config.get('search_cache_ttl'))
+            search_query_cache.configure(ttl_seconds=app_config.get('search_cache_ttl'))
+
+        # 处理查询向量缓存大小与启动预热数量
+        for key in ('query_cache_size', 'query_cache_preload_count'):
+            if key in data and isinstance(data[key], int) and not isinstance(data[key], bool) and data[key] >= 0:
+                app_config[key] = data[key]
+                logging.info(f"{key} 已更新为: {app_config[key]}")
+                updated_any = True
+        if 'query_cache_size' in data:
+            query_embedding_cache.configure(max_entries=app_config.get('query_cache_size'))
         # --- 新增/修改结束 ---
 
         if updated_any:
@@ -1438,15 +2565,9 @@ def enhance_single_image_api(image_db_id):
     
     absolute_original_path = os.path.join(CURRENT_DIR, relative_original_path)
     if not os.path.exists(absolute_original_path):
+        db.update_image_file_flags(image_db_id, original_exists=False)
         return jsonify({"error": f"图片 ID {image_db_id} 的原始文件 '{absolute_original_path}' 不存在。"}), 404
 
-    clip_img_emb = db.get_clip_embedding_for_image(image_db_id) 
-    if clip_img_emb is None:
-        logging.warning(f"图片ID {image_db_id} 在数据库中未找到纯CLIP embedding，尝试重新计算...")
-        clip_img_emb = compute_clip_image_embedding(absolute_original_path) # Use absolute path
-        if clip_img_emb is None: 
-            return jsonify({"error": f"无法获取或计算图片 ID {image_db_id} 的CLIP embedding"}), 500
-
     logging.info(f"手动触发对图片 ID: {image_db_id} ({absolute_original_path}) 的Qwen-VL分析。")
     qwen_result = qwen_service.analyze_image_content(absolute_original_path) # Use absolute path
 
@@ -1456,20 +2577,19 @@ def enhance_single_image_api(image_db_id):
         if not update_success:
              return jsonify({"error": f"图片 ID {image_db_id} 分析结果存入数据库失败。"}), 500
 
-        bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"])
-        if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
-            updated_concatenated_emb = np.concatenate((clip_img_emb, bce_desc_emb))
-        else: 
-            logging.warning(f"BCE embedding for description failed or wrong dim for image {image_db_id}. Using zero vector for BCE part in FAISS.")
-            zeros_bce_emb = np.zeros(fu.BCE_EMBEDDING_DIM, dtype=np.float32)
-            updated_concatenated_emb = np.concatenate((clip_img_emb, zeros_bce_emb))
-
-
         if image_data["faiss_id"] is None: 
             logging.error(f"图片 ID {image_db_id} 在数据库中没有FAISS ID，无法更新FAISS向量。")
             return jsonify({"error": f"图片 ID {image_db_id} 数据不一致，缺少FAISS ID。"}), 500
 
-        if fu.update_vector_in_index(updated_concatenated_emb, image_data["faiss_id"]):
+        bce_desc_emb = bce_service.get_bce_embedding(qwen_result["description"])
+        if bce_desc_emb is not None and bce_desc_emb.shape[0] == fu.BCE_EMBEDDING_DIM:
+            db.update_image_bce_embedding(image_db_id, bce_desc_emb)
+            index_updated = fu.update_vector_in_index(bce_desc_emb, image_data["faiss_id"], fu.BCE_INDEX)
+        else: 
+            logging.warning(f"BCE embedding for description failed or wrong dim for image {image_db_id}. The image is not added to the BCE index.")
+            index_updated = True
+
+        if index_updated:
              logging.info(f"图片 ID: {image_db_id} 手动Qwen-VL分析完成并更新了FAISS向量。")
              fu.save_faiss_index()
              return jsonify({
@@ -1766,12 +2886,7 @@ def get_images_list_api():
         except (json.JSONDecodeError, TypeError):
             user_tags_list = []
 
-        # --- MODIFIED: Rebuild absolute path for existence check ---
-        relative_original_path = img_row['original_path']
-        relative_thumbnail_path = img_row['thumbnail_path']
-
-        thumbnail_url = f"/thumbnails/{os.path.basename(relative_thumbnail_path)}" if relative_thumbnail_path and os.path.exists(os.path.join(CURRENT_DIR, relative_thumbnail_path)) else None
-        original_url = f"/uploads/{os.path.basename(relative_original_path)}" if relative_original_path and os.path.exists(os.path.join(CURRENT_DIR, relative_original_path)) else None
+        thumbnail_url, original_url = build_file_urls(img_row)
 
         results.append({
             "id": img_row["id"],
@@ -1827,6 +2942,9 @@ def delete_images_batch_api():
                 else:
                     logging.warning(f"缩略图文件未找到，无法删除: {absolute_thumbnail_path} for ID {image_id_int}")
 
+            # 文件已删除, 即使随后删除记录失败, 也不会再返回指向已删除文件的URL
+            db.update_image_file_flags(image_id_int, original_exists=False, thumbnail_exists=False)
+
             if faiss_id is not None:
                 faiss_ids_to_remove_from_index.append(faiss_id)
             
@@ -1845,15 +2963,10 @@ def delete_images_batch_api():
             failed_ids.append(image_id)
     
     if faiss_ids_to_remove_from_index:
-        if fu.faiss_index is not None and fu.faiss_index.ntotal > 0:
-            try:
-                logging.info(f"准备从FAISS中删除ID列表: {faiss_ids_to_remove_from_index}")
-                ids_to_remove_np = np.array(faiss_ids_to_remove_from_index, dtype=np.int64)
-                num_removed = fu.faiss_index.remove_ids(ids_to_remove_np)
-                logging.info(f"从FAISS索引中移除了 {num_removed} 个向量。")
-                if num_removed > 0 : fu.save_faiss_index()
-            except Exception as e_faiss_remove:
-                logging.error(f"从FAISS索引移除向量时出错: {e_faiss_remove}")
+        if fu.indexes:
+            logging.info(f"准备从FAISS中删除ID列表: {faiss_ids_to_remove_from_index}")
+            num_removed = fu.remove_vectors_from_index(faiss_ids_to_remove_from_index)
+            if num_removed > 0 : fu.save_faiss_index()
         else:
             logging.warning("FAISS索引为空或未初始化，跳过FAISS删除。")
             
@@ -1922,17 +3035,17 @@ def add_user_tags_batch_api():
 
 
 # 新增人脸相关 API 路由
-@app.route('/faces/search_by_face', methods=['POST'])
-def search_images_by_face_api():
+def match_face_cluster():
     """
-    图搜人脸：上传一张带有人脸的图片，返回包含该人脸的所有相册图片。
+    检测请求中上传的人脸图片 (face_query_file), 在人脸索引中找到最相似的人脸所属的聚类。
+    返回 (cluster_id, response): 找不到时 cluster_id 为 None, response 为 (响应体, 状态码)。
     """
     if 'face_query_file' not in request.files:
-        return jsonify({"error": "请求中未找到人脸查询文件(face_query_file key missing)"}), 400
+        return None, ({"error": "请求中未找到人脸查询文件(face_query_file key missing)"}, 400)
     
     query_file = request.files['face_query_file']
     if not query_file or query_file.filename == '':
-        return jsonify({"error": "未选择人脸查询文件"}), 400
+        return None, ({"error": "未选择人脸查询文件"}, 400)
 
     logging.info(f"开始通过人脸图片 '{query_file.filename}' 进行搜索...")
 
@@ -1944,10 +3057,10 @@ def search_images_by_face_api():
             detected_faces = face_service.detect_faces(tmp_file.name)
     except Exception as e:
         logging.error(f"处理人脸查询图片时出错: {e}", exc_info=True)
-        return jsonify({"error": "处理查询图片失败。"}), 500
+        return None, ({"error": "处理查询图片失败。"}, 500)
 
     if not detected_faces:
-        return jsonify({"error": "在您上传的图片中未能检测到人脸，或服务出错。"}), 400
+        return None, ({"error": "在您上传的图片中未能检测到人脸，或服务出错。"}, 400)
     
     # 默认使用检测到的第一张、质量最高的人脸进行搜索
     query_face = max(detected_faces, key=lambda x: x.get('Score', 0))
@@ -1957,12 +3070,29 @@ def search_images_by_face_api():
     sims, face_ids = ffu_face.search_vectors_in_index(query_feature_vec, top_k=1)
     
     if not face_ids:
-        return jsonify({"message": "未在图库中找到任何相似的人脸。", "results": []}), 200
+        return None, ({"message": "未在图库中找到任何相似的人脸。", "results": []}, 200)
         
     # 根据最匹配的人脸ID找到其所属的聚类ID
     target_cluster_id = db.get_cluster_id_by_face_id(face_ids[0])
     if not target_cluster_id:
-        return jsonify({"error": "数据不一致：找到了匹配的人脸但无法找到其聚类信息。"}), 500
+        return None, ({"error": "数据不一致：找到了匹配的人脸但无法找到其聚类信息。"}, 500)
+    return target_cluster_id, None
+
+def stream_image_ids(image_ids: list, meta: dict, chunk_size: int):
+    """以 NDJSON 流式返回一组按顺序排列的图片 (人物检索), 格式与文本检索的流式结果相同, similarity 为 null"""
+    if not image_ids:
+        return ndjson_response({**meta, "message": "未找到相关图片。"}, 200)
+    result_set = {"key": "id", "ids": image_ids, "scores": [None] * len(image_ids), "meta": meta}
+    return stream_response(search_result_cache.add(result_set), result_set, chunk_size)
+
+@app.route('/faces/search_by_face', methods=['POST'])
+def search_images_by_face_api():
+    """
+    图搜人脸：上传一张带有人脸的图片，返回包含该人脸的所有相册图片。
+    """
+    target_cluster_id, response = match_face_cluster()
+    if response is not None:
+        return jsonify(response[0]), response[1]
 
     # 根据聚类ID，分页获取所有包含该人脸的图片信息
     page = request.args.get('page', 1, type=int)
@@ -1973,8 +3103,7 @@ def search_images_by_face_api():
     
     results = []
     for img_row in images_data:
-        thumbnail_url = f"/thumbnails/{os.path.basename(img_row['thumbnail_path'])}" if img_row['thumbnail_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['thumbnail_path'])) else None
-        original_url = f"/uploads/{os.path.basename(img_row['original_path'])}" if img_row['original_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['original_path'])) else None
+        thumbnail_url, original_url = build_file_urls(img_row)
         results.append({
             "id": img_row["id"],
             "filename": img_row["original_filename"],
@@ -1995,6 +3124,62 @@ def search_images_by_face_api():
 # --- 新增/修改结束 ---
 
 
+@app.route('/faiss/status', methods=['GET'])
+def get_faiss_status_api():
+    """获取CLIP/BCE向量索引和人脸向量索引的状态 (索引类型、向量数量、迁移进度、检索参数)"""
+    index_status = fu.get_index_status()
+    return jsonify({
+        "clip_index": index_status[fu.CLIP_INDEX],
+        "bce_index": index_status[fu.BCE_INDEX],
+        "face_index": ffu_face.get_face_index_status(),
+        "clip_embedding_store": clip_store.status() if clip_store is not None else None
+    }), 200
+
+
+@app.route('/faiss/reconcile', methods=['GET', 'POST'])
+def faiss_reconcile_api():
+    """GET: 最近一次对账的报告; POST: 在后台启动对账 (请求体可选 {"dry_run": true} 只统计不修复)"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        dry_run = data.get('dry_run', False)
+        if not isinstance(dry_run, bool):
+            return jsonify({"error": "dry_run 必须是布尔值"}), 400
+        if not start_reconcile(dry_run=dry_run):
+            return jsonify({"error": "索引对账已在运行中"}), 409
+        return jsonify({"message": "索引对账已在后台启动。", "dry_run": dry_run}), 202
+    with reconcile_lock:
+        return jsonify(dict(reconcile_status)), 200
+
+
+@app.route('/files/verify', methods=['GET', 'POST'])
+def file_verify_api():
+    """GET: 最近一次图片文件核对的结果; POST: 立即在后台核对一次"""
+    if request.method == 'POST':
+        if not start_file_verify():
+            return jsonify({"error": "文件校验已在运行中"}), 409
+        return jsonify({"message": "图片文件核对已在后台启动。"}), 202
+    with file_verify_lock:
+        return jsonify(dict(file_verify_status)), 200
+
+
+@app.route('/faiss/compression_report', methods=['GET'])
+def get_faiss_compression_report_api():
+    """评估CLIP/BCE索引压缩存储的内存占用，以及与全精度暴力检索相比的召回率"""
+    index_name = request.args.get('index', fu.CLIP_INDEX)
+    if index_name not in fu.INDEX_DIMS:
+        return jsonify({"error": f"未知的索引: {index_name}"}), 400
+    try:
+        n_queries = max(1, min(int(request.args.get('queries', 100)), 1000))
+        top_k = max(1, min(int(request.args.get('top_k', 10)), 1000))
+    except ValueError:
+        return jsonify({"error": "queries 和 top_k 必须为整数"}), 400
+
+    report = fu.get_compression_report(index_name, n_queries, top_k)
+    if report is None:
+        return jsonify({"error": "FAISS索引未初始化"}), 500
+    return jsonify(report), 200
+
+
 @app.route('/uploads/<path:filename>')
 def serve_upload(filename):
     if ".." in filename or filename.startswith("/"):
@@ -2069,8 +3254,7 @@ def get_images_for_cluster(cluster_id):
         images_data, total_count = db.get_images_by_cluster_id(cluster_id, page, limit)
         results = []
         for img_row in images_data:
-            thumbnail_url = f"/thumbnails/{os.path.basename(img_row['thumbnail_path'])}" if img_row['thumbnail_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['thumbnail_path'])) else None
-            original_url = f"/uploads/{os.path.basename(img_row['original_path'])}" if img_row['original_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['original_path'])) else None
+            thumbnail_url, original_url = build_file_urls(img_row)
             results.append({
                 "id": img_row["id"],
                 "filename": img_row["original_filename"],
@@ -2090,6 +3274,37 @@ def get_images_for_cluster(cluster_id):
         logging.error(f"获取聚类图片时出错: {e}", exc_info=True)
         return jsonify({"error": "获取聚类图片失败。"}), 500
 
+@app.route('/faces/search_by_face_stream', methods=['POST'])
+def search_images_by_face_stream_api():
+    """与 /faces/search_by_face 相同, 以 NDJSON 流式返回该人物的全部图片, 每块 page_size 张"""
+    try:
+        chunk_size = parse_page_size(request.form.get('page_size'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    target_cluster_id, response = match_face_cluster()
+    if response is not None:
+        return ndjson_response(*response)
+    image_ids = db.get_image_ids_by_cluster_id(target_cluster_id)
+    meta = {"cluster_id": target_cluster_id, "message": f"找到了属于聚类 {target_cluster_id} 的 {len(image_ids)} 张图片。"}
+    return stream_image_ids(image_ids, meta, chunk_size)
+
+@app.route('/faces/search_stream', methods=['GET'])
+def search_faces_by_name_stream():
+    """与 /faces/search 相同的人名检索, 以 NDJSON 流式返回全部匹配的图片, 每块 page_size 张"""
+    name_query = request.args.get('name', '').strip()
+    if not name_query:
+        return jsonify({"error": "需要提供 'name' 查询参数。"}), 400
+    try:
+        chunk_size = parse_page_size(request.args.get('page_size'))
+        image_ids = db.get_image_ids_by_cluster_name(name_query)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"按名称搜索人脸时出错: {e}", exc_info=True)
+        return jsonify({"error": "按名称搜索人脸失败。"}), 500
+    meta = {"query": name_query, "message": f"为 '{name_query}' 找到了 {len(image_ids)} 张图片。"}
+    return stream_image_ids(image_ids, meta, chunk_size)
+
 @app.route('/faces/search', methods=['GET'])
 def search_faces_by_name():
     """
@@ -2103,20 +3318,25 @@ def search_faces_by_name():
     page = request.args.get('page', 1, type=int)
     limit = request.args.get('limit', 50, type=int)
 
+    # 数据未变化时相同的查询直接返回缓存的响应
+    cache_key = ("faces_search", name_query, page, limit, search_data_version())
+    cached_response = search_query_cache.get(cache_key)
+    if cached_response is not None:
+        return jsonify(cached_response), 200
+
     try:
         # 这个DB函数需要能处理模糊匹配并返回分页的图片列表和总数
         images_data, total_count = db.get_images_by_cluster_name(name_query, page, limit)
         results = []
         for img_row in images_data:
-            thumbnail_url = f"/thumbnails/{os.path.basename(img_row['thumbnail_path'])}" if img_row['thumbnail_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['thumbnail_path'])) else None
-            original_url = f"/uploads/{os.path.basename(img_row['original_path'])}" if img_row['original_path'] and os.path.exists(os.path.join(CURRENT_DIR, img_row['original_path'])) else None
+            thumbnail_url, original_url = build_file_urls(img_row)
             results.append({
                 "id": img_row["id"],
                 "filename": img_row["original_filename"],
                 "thumbnail_url": thumbnail_url,
                 "original_url": original_url,
             })
-        return jsonify({
+        response = {
             "message": f"为 '{name_query}' 找到了 {total_count} 张图片。",
             "query": name_query,
             "results": results,
@@ -2124,7 +3344,9 @@ def search_faces_by_name():
             "limit": limit,
             "total_count": total_count,
             "total_pages": (total_count + limit - 1) // limit if limit > 0 else 0
-        }), 200
+        }
+        search_query_cache.put(cache_key, response)
+        return jsonify(response), 200
     except Exception as e:
         logging.error(f"按名称搜索人脸时出错: {e}", exc_info=True)
         return jsonify({"error": "按名称搜索人脸失败。"}), 500
@@ -2132,69 +3354,298 @@ def search_faces_by_name():
 # --- 新增API路由结束 ---
 
 
-def argsparser():
+# --- 多进程部署 (gunicorn worker) ---
+def init_shared_state():
+    """加载应用配置、初始化数据库并清理损坏的embedding。多进程部署时只在 gunicorn 主进程中执行一次。"""
+    load_app_config()
+    db.init_db() 
+    
+    # 清理损坏的embedding数据
+    logging.info("正在检查并清理损坏的embedding数据...")
+    try:
+        cleaned_count = db.clean_corrupted_embeddings()
+        if cleaned_count > 0:
+            logging.info(f"已清理 {cleaned_count} 条损坏的embedding记录")
+        elif cleaned_count == 0:
+            logging.info("未发现损坏的embedding数据")
+    except Exception as e:
+        logging.error(f"清理embedding数据时出错: {e}")
+
+def apply_runtime_config():
+    """把应用配置应用到索引检索参数、各缓存和外部服务客户端 (启动时, 以及其他 worker 修改配置后)"""
+    apply_faiss_index_config()
+    search_result_cache.configure(ttl_seconds=app_config.get("search_cache_ttl", cache_utils.DEFAULT_TTL_SECONDS))
+    search_query_cache.configure(ttl_seconds=app_config.get("search_cache_ttl", cache_utils.DEFAULT_TTL_SECONDS))
+    query_embedding_cache.configure(max_entries=app_config.get("query_cache_size", QUERY_EMBEDDING_CACHE_SIZE))
+    face_service.init_face_client(app_config.get('face_api_url'))
+    qwen_service.init_qwen_client(
+        api_key=app_config.get('qwen_api_key'),
+        base_url=app_config.get('qwen_base_url'),
+        model_name=app_config.get('qwen_model_name')
+    )
+
+def init_indexes():
+    """注册全精度向量来源并加载图片与人脸FAISS索引"""
+    # 压缩存储时用数据库中的全精度向量精确重排和重建索引
+    fu.set_vector_loader(fu.CLIP_INDEX, load_clip_vectors)
+    fu.set_vector_loader(fu.BCE_INDEX, lambda ids: db.get_embeddings_by_faiss_ids(ids, "bce_embedding"))
+    index_start_time = time.time()
+    fu.init_faiss_index(lazy_load=app_config.get("faiss_lazy_load", True))
+    ffu_face.init_faiss_index(lazy_load=app_config.get("faiss_lazy_load", True))
+    logging.info(f"FAISS索引 (图片 + 人脸) 加载耗时 {time.time() - index_start_time:.2f} 秒")
+
+def try_become_primary_worker() -> bool:
+    """以非阻塞的文件锁选出主 worker, 锁随进程退出自动释放"""
+    global primary_lock_file
+    if primary_lock_file is not None:
+        return True
+    import fcntl
+    os.makedirs(RUN_DIR, exist_ok=True)
+    lock_file = open(os.path.join(RUN_DIR, "primary.lock"), "a+")
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    primary_lock_file = lock_file
+    logging.info(f"worker {os.getpid()} 成为主 worker, 负责定期核对图片文件。")
+    threading.Thread(target=file_verify_scheduler, daemon=True).start()
+    return True
+
+def connect_inference_service():
+    """连接集中推理进程 (它启动时要先加载模型), 用远程实现替换本进程的 CLIP / BCE 模型"""
+    global inference_client, clip_model, clip_preprocess, bce_service
+    try:
+        client, info = inference_service.connect(timeout=INFERENCE_CONNECT_TIMEOUT)
+    except Exception as e:
+        logging.error(f"worker {os.getpid()} 无法连接推理服务, CLIP/BCE 推理不可用: {e}")
+        return
+    inference_client = client
+    if info.get("clip_loaded"):
+        if info["embed_dim"] != fu.CLIP_EMBEDDING_DIM:
+            logging.error(f"致命错误: CLIP模型的实际输出维度 ({info['embed_dim']}) "
+                          f"与 faiss_utils.py 中配置的 CLIP_EMBEDDING_DIM ({fu.CLIP_EMBEDDING_DIM}) 不符。请修正配置。")
+        clip_preprocess = clip.load_preprocess(info["image_resolution"])
+        clip_model = inference_service.RemoteCLIP(client, info)
+    else:
+        logging.warning("推理服务中的CLIP模型未能加载,请检查推理服务日志。")
+    if info.get("bce_loaded"):
+        bce_service = inference_service.RemoteBCE(client)
+    else:
+        logging.warning("推理服务中的BCE模型未能加载。请检查推理服务日志。")
+    logging.info(f"worker {os.getpid()} 已连接推理服务。")
+    preload_query_embeddings()
+
+def job_status_path(job: str, suffix: str = ".json") -> str:
+    return os.path.join(JOB_STATUS_DIR, job + suffix)
+
+def write_job_status(job: str, status: dict):
+    os.makedirs(JOB_STATUS_DIR, exist_ok=True)
+    path = job_status_path(job)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"pid": os.getpid(), "updated": time.time(), "status": status}, f, ensure_ascii=False, default=str)
+    os.replace(tmp_path, path)
+
+def read_job_status(job: str) -> dict | None:
+    """其他 worker 发布的任务状态; 发布者已退出 (状态长时间未更新) 时 is_running 视为 False"""
+    try:
+        with open(job_status_path(job), "r", encoding="utf-8") as f:
+            published = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"读取任务 {job} 的发布状态失败: {e}")
+        return None
+    status = published.get("status", {})
+    if status.get("is_running") and (published.get("pid") == os.getpid()
+                                     or time.time() - published.get("updated", 0) > JOB_STATUS_STALE_SECONDS):
+        status["is_running"] = False
+    return status
+
+def publish_job_statuses():
+    """发布本进程中运行 (或刚结束) 的任务状态, 并处理其他 worker 转来的停止请求"""
+    for job, (status, lock) in shared_jobs.items():
+        with lock:
+            running = status["is_running"]
+            snapshot = dict(status)
+        if not running and job not in jobs_published_running:
+            continue
+        write_job_status(job, snapshot)
+        if not running:
+            jobs_published_running.discard(job)
+            continue
+        jobs_published_running.add(job)
+        stop_path = job_status_path(job, ".stop")
+        if os.path.exists(stop_path):
+            os.remove(stop_path)
+            if "is_stopped" in status:
+                with lock:
+                    status["is_stopped"] = True
+                logging.info(f"收到其他 worker 转来的停止请求, 正在停止任务 {job}")
+
+def worker_sync_loop():
+    """worker 后台线程: 跟随共享索引日志、在配置文件被其他 worker 修改后重新加载、发布后台任务状态"""
+    config_mtime = os.path.getmtime(APP_CONFIG_FILE) if os.path.exists(APP_CONFIG_FILE) else None
+    while True:
+        time.sleep(WORKER_SYNC_INTERVAL_SECONDS)
+        try:
+            fu.follow_index_logs()
+            ffu_face.follow_index_log()
+            mtime = os.path.getmtime(APP_CONFIG_FILE) if os.path.exists(APP_CONFIG_FILE) else None
+            if mtime != config_mtime:
+                config_mtime = mtime
+                load_app_config()
+                apply_runtime_config()
+            publish_job_statuses()
+            try_become_primary_worker()
+        except Exception as e:
+            logging.error(f"worker {os.getpid()} 同步共享状态失败: {e}", exc_info=True)
+
+def init_worker(args):
+    """
+    gunicorn worker 进程 fork 之后的初始化 (由 gunicorn.conf.py 的 post_fork 调用):
+    索引以 mmap 只读方式打开并跟随共享增量日志, 数据库切换为 WAL 模式, 推理交给集中推理进程。
+    """
+    global worker_mode, query_model_version
+    worker_mode = True
+    fu.set_follower_mode(True)
+    ffu_face.set_follower_mode(True)
+    db.enable_multiprocess_access()
+    search_result_cache.share(SEARCH_RESULT_SHARED_DIR)
+    apply_runtime_config()
+    query_stats.load()
+    # 不创建常驻CLIP向量矩阵 (每个 worker 一份会成倍占用内存), 全精度向量从数据库读取
+    init_indexes()
+    query_model_version = "|".join(model_file_version(path) for path in (*args.text_model, *args.bce_model))
+    threading.Thread(target=connect_inference_service, daemon=True).start()
+    threading.Thread(target=worker_sync_loop, daemon=True).start()
+    if try_become_primary_worker() and app_config.get("faiss_reconcile_on_startup", True):
+        start_reconcile(trigger="startup")
+
+def shared_job_action(path: str, method: str):
+    """请求对应的后台任务与操作 ("status" / "start" / "stop"), 不是任务接口时返回 (None, None)"""
+    if path == "/faiss/reconcile":
+        return "reconcile", "start" if method == "POST" else "status"
+    if path == "/files/verify":
+        return "file_verify", "start" if method == "POST" else "status"
+    job, _, action = path.lstrip("/").partition("/")
+    if job in shared_jobs and action in ("status", "start", "stop"):
+        return job, action
+    return None, None
+
+@app.before_request
+def coordinate_shared_jobs():
+    """多进程部署: 任务在其他 worker 中运行时, 状态请求返回其发布的状态, 停止请求转给它, 启动请求被拒绝"""
+    if not worker_mode:
+        return None
+    job, action = shared_job_action(request.path, request.method)
+    if job is None:
+        return None
+    status, lock = shared_jobs[job]
+    with lock:
+        if status["is_running"]:
+            # 任务就在本进程中运行, 由原有接口处理
+            return None
+    if action == "status":
+        published = read_job_status(job)
+        if published is None:
+            return None
+        if job.startswith("batch_") and published.get("start_time"):
+            published["elapsed_time"] = time.time() - published["start_time"]
+        return jsonify(published), 200
+    if action == "stop":
+        published = read_job_status(job)
+        if not published or not published.get("is_running"):
+            return None
+        os.makedirs(JOB_STATUS_DIR, exist_ok=True)
+        open(job_status_path(job, ".stop"), "w").close()
+        logging.info(f"已把任务 {job} 的停止请求转给运行它的 worker")
+        return jsonify({"success": True, "message": "正在停止..."}), 200
+    # 启动: 在文件锁内确认没有其他 worker 在运行, 并先发布 is_running 占位, 避免两个 worker 同时启动
+    import fcntl
+    os.makedirs(JOB_STATUS_DIR, exist_ok=True)
+    with open(job_status_path(job, ".lock"), "a+") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        published = read_job_status(job)
+        if published and published.get("is_running"):
+            if job.startswith("batch_"):
+                return jsonify({"success": False, "error": "该任务已在其他 worker 中运行"}), 400
+            return jsonify({"error": "该任务已在其他 worker 中运行"}), 409
+        with lock:
+            claim = dict(status)
+        claim["is_running"] = True
+        write_job_status(job, claim)
+    jobs_published_running.add(job)
+    return None
+
+@app.route('/inference/status', methods=['GET'])
+def get_inference_status_api():
+    """集中推理进程的状态 (模型、批处理统计、维护中的索引); 单进程运行时推理在本进程中执行"""
+    if inference_client is None:
+        batching, graphs = {}, {}
+        if getattr(clip_model, "image_batcher", None) is not None:
+            batching = {"clip_image": clip_model.image_batcher.stats(), "clip_text": clip_model.text_batcher.stats()}
+            graphs.update(clip_model.graph_stats())
+        if hasattr(bce_service, "graph_stats"):
+            graphs.update(bce_service.graph_stats())
+        return jsonify({
+            "mode": "multi_worker" if worker_mode else "single_process",
+            "connected": False,
+            "clip_loaded": clip_model is not None,
+            "bce_loaded": bce_service is not None,
+            "batching": batching,
+            "graphs": graphs
+        }), 200
+    try:
+        status = inference_client.call(inference_service.OP_STATUS)
+    except inference_service.InferenceServiceError as e:
+        return jsonify({"error": f"推理服务不可用: {e}"}), 503
+    return jsonify({"mode": "multi_worker", "connected": True, "worker_pid": os.getpid(), **status}), 200
+
+
+def argsparser(argv=None):
     parser = argparse.ArgumentParser(prog=__file__)
-    parser.add_argument('--image_model', type=str, default='./models/BM1684X/cn_clip_image_vit_h_14_bm1684x_f16_1b.bmodel', help='path of image bmodel')
-    parser.add_argument('--text_model', type=str, default='./models/BM1684X/cn_clip_text_vit_h_14_bm1684x_f16_1b.bmodel', help='path of text bmodel')
-    parser.add_argument('--bce_model', type=str, default='./models/BM1684X/text2vec_base_chinese_bm1684x_f16_1b.bmodel', help='path of bce bmodel')
-    parser.add_argument('--dev_id', type=int, default=0, help='dev id')
-    args = parser.parse_args()
+    inference_service.add_model_arguments(parser)
+    args = parser.parse_args(argv)
     return args
 
 
 
 # --- 应用启动 ---
 if __name__ == '__main__':
+    startup_time = time.time()
     args = argsparser()
     if getattr(sys, 'frozen', False):
         # 如果是打包后的程序，所有命令行指定的相对路径都需要
         # 转换为 _MEIPASS 临时目录下的绝对路径
         base_path = sys._MEIPASS
         
-        # 修正 image_model 路径
+        # 修正 image_model 路径 (每个模型可以有多个不同 batch 大小的 bmodel)
         # os.path.normpath an d os.path.basename are used to handle './' prefix
-        model_rel_path = os.path.normpath(args.image_model)
-        args.image_model = os.path.join(base_path, model_rel_path)
+        args.image_model = [os.path.join(base_path, os.path.normpath(path)) for path in args.image_model]
 
         # 修正 text_model 路径
-        model_rel_path = os.path.normpath(args.text_model)
-        args.text_model = os.path.join(base_path, model_rel_path)
+        args.text_model = [os.path.join(base_path, os.path.normpath(path)) for path in args.text_model]
         
         # 修正 bce_model 路径
-        model_rel_path = os.path.normpath(args.bce_model)
-        args.bce_model = os.path.join(base_path, model_rel_path)
+        args.bce_model = [os.path.join(base_path, os.path.normpath(path)) for path in args.bce_model]
 
         logging.info(f"Packaged App: Corrected image_model path to {args.image_model}")
         logging.info(f"Packaged App: Corrected text_model path to {args.text_model}")
         logging.info(f"Packaged App: Corrected bce_model path to {args.bce_model}")
     
-    load_app_config()
-    db.init_db() 
-    
-    # 清理损坏的embedding数据
-    logging.info("正在检查并清理损坏的embedding数据...")
-    try:
-        cleaned_count = db.clean_corrupted_embeddings()
-        if cleaned_count > 0:
-            logging.info(f"已清理 {cleaned_count} 条损坏的embedding记录")
-        elif cleaned_count == 0:
-            logging.info("未发现损坏的embedding数据")
-    except Exception as e:
-        logging.error(f"清理embedding数据时出错: {e}")
-    
-    fu.init_faiss_index() 
-
-    # --- 新增/修改开始 ---
-    # 初始化人脸服务和人脸FAISS索引
-    ffu_face.init_faiss_index()
-    face_service.init_face_client(app_config.get('face_api_url'))
-    # --- 新增/修改结束 ---
-
-    qwen_service.init_qwen_client(
-        api_key=app_config.get('qwen_api_key'),
-        base_url=app_config.get('qwen_base_url'),
-        model_name=app_config.get('qwen_model_name')
-    )
+    init_shared_state()
+    apply_runtime_config()
+    query_stats.load()
+    init_clip_store()
+    init_indexes()
+
+    if app_config.get("faiss_reconcile_on_startup", True):
+        # 后台对账, 不阻塞启动; 延迟加载时写入会进入只读阶段的 overlay 或等待可写索引
+        start_reconcile(trigger="startup")
+    # 后台定期核对图片文件, 检索和列表接口只根据数据库中的标志位生成URL
+    threading.Thread(target=file_verify_scheduler, daemon=True).start()
 
     load_clip_model_on_startup(args)
     load_bce_model_on_startup(args)
@@ -2203,6 +3654,9 @@ if __name__ == '__main__':
         logging.warning("BCE模型在bce_service中未能加载。请检查日志。")
     if not clip_model:
         logging.warning("CLIP模型未能加载,请检查日志。")
+    # 文本模型变化后旧的查询向量不再有效, 缓存键中带上模型版本
+    query_model_version = "|".join(model_file_version(path) for path in (*args.text_model, *args.bce_model))
+    threading.Thread(target=preload_query_embeddings, daemon=True).start()
 
-    logging.info("智能相册后端服务准备启动...")
-    app.run(host="0.0.0.0", port=18088, debug=False)
\ No newline at end of file
+    logging.info(f"智能相册后端服务准备启动... 启动耗时 {time.time() - startup_time:.2f} 秒")
+    app.run(host="0.0.0.0", port=18088, debug=False)
@@ -11,23 +11,17 @@ import os
 import time
 from transformers import BertTokenizer
 import sys
-import sophon.sail as sail
 import logging
+from bmodel_engine import BmodelEngine
 logging.basicConfig(level=logging.INFO)
 
 class BCEEmbedding:
     def __init__(self, bce_model, dev_id):
-        # bce bmodel
-        self.bce_net = sail.Engine(bce_model, dev_id, sail.IOMode.SYSIO)
-        logging.info("load {} success!".format(bce_model))
-        self.bce_net_graph_name = self.bce_net.get_graph_names()[0]
-        self.bce_net_input_name_0 = self.bce_net.get_input_names(self.bce_net_graph_name)[0]
-        self.bce_net_input_name_1 = self.bce_net.get_input_names(self.bce_net_graph_name)[1]
-        self.bce_net_output_name = self.bce_net.get_output_names(self.bce_net_graph_name)[0]
-        self.bce_net_input_shape_0 = self.bce_net.get_input_shape(self.bce_net_graph_name, self.bce_net_input_name_0)
-        self.bce_net_input_shape_1 = self.bce_net.get_input_shape(self.bce_net_graph_name, self.bce_net_input_name_1)
-        self.bce_net_output_shape = self.bce_net.get_output_shape(self.bce_net_graph_name, self.bce_net_output_name)
-        self.bce_net_batch_size = self.bce_net_input_shape_0[0]
+        # bce bmodel: 可以是同一网络不同 batch 大小的多个 bmodel, 每次推理选择能装下的最小 graph
+        self.bce_net = BmodelEngine(bce_model, dev_id, name="BCE")
+        self.bce_net_input_shape_0, self.bce_net_input_shape_1 = self.bce_net.input_shapes[:2]
+        self.bce_net_output_shape = self.bce_net.output_shape
+        self.bce_net_batch_size = self.bce_net.max_batch_size
 
         self.embed_dim = self.bce_net_output_shape[1] # 768 for text2vec_base_chinese
 
@@ -59,12 +53,28 @@ class BCEEmbedding:
         input_ids_padded = self.pad_to_512(inputs['input_ids'])
         attention_mask_padded = self.pad_to_512(inputs['attention_mask'])
 
-        bce_inputs = {
-            self.bce_net_input_name_0: input_ids_padded,
-            self.bce_net_input_name_1: attention_mask_padded
-        }
-        output = self.bce_net.process(self.bce_net_graph_name, bce_inputs)[self.bce_net_output_name]
+        output = self.bce_net.process([input_ids_padded, attention_mask_padded])
         self.encode_text_time = time.time() - self.start_time
         logging.info(f"Encode text time: {self.encode_text_time:.4f} seconds")
         output = output[0]
         return output / np.linalg.norm(output)
+
+    def get_bce_embeddings(self, texts):
+        """
+        批量计算多条文本的embedding: 一次完成分词, 按可用的batch大小分块推理 (最后一块补零)。
+        返回 (N, embed_dim) 的归一化矩阵, 第 i 行对应 texts[i]。
+        """
+        self.start_time = time.time()
+        inputs = self.tokenizer(list(texts), return_tensors='np', padding='max_length', truncation=True, max_length=32)
+        input_ids_padded = self.pad_to_512(inputs['input_ids'])
+        attention_mask_padded = self.pad_to_512(inputs['attention_mask'])
+
+        text_batch = input_ids_padded.shape[0]
+        outputs = self.bce_net.process([input_ids_padded, attention_mask_padded])
+        self.encode_text_time = time.time() - self.start_time
+        logging.info(f"Encode {text_batch} texts time: {self.encode_text_time:.4f} seconds")
+        return outputs / np.linalg.norm(outputs, axis=1, keepdims=True)
+
+    def graph_stats(self) -> dict:
+        """各 batch 大小 graph 的利用率"""
+        return {"bce": self.bce_net.stats()}
@@ -0,0 +1,133 @@
+# bmodel_engine.py
+# 同一网络不同 batch 大小的多个 bmodel (或一个 bmodel 中的多个 graph) 组成一个推理引擎:
+# 每次推理按本次的行数选择能装下的最小 graph (交互式检索用 batch 1, 批量任务用最大的 graph),
+# 超过最大 batch 的输入先按最大 graph 分块, 最后不足一块的部分再选最小的可容纳 graph, 补零后推理并去掉补零的输出。
+# 补零使用每个线程各自复用的输入缓冲, 不在每次推理时重新分配。
+# CLIP 图像/文本编码器和 BCE 编码器共用; 各 graph 的调用次数、有效行数、补零行数与耗时见 stats()。
+import logging
+import threading
+import time
+
+import numpy as np
+import sophon.sail as sail
+
+
+class EngineGraph:
+    def __init__(self, engine, graph_name: str, model_path: str):
+        self.engine = engine
+        self.name = graph_name
+        self.model_path = model_path
+        self.input_names = engine.get_input_names(graph_name)
+        self.output_name = engine.get_output_names(graph_name)[0]
+        self.input_shapes = [engine.get_input_shape(graph_name, input_name) for input_name in self.input_names]
+        self.output_shape = engine.get_output_shape(graph_name, self.output_name)
+        self.batch_size = self.input_shapes[0][0]
+        self.calls = 0
+        self.rows = 0
+        self.padded_rows = 0
+        self.busy_seconds = 0.0
+
+
+class BmodelEngine:
+    """
+    model_paths 为一个 bmodel 路径或路径列表, 各 graph 的输入除 batch 维外必须相同。
+    多个线程可以同时调用 process, 统计信息由锁保护。
+    """
+
+    def __init__(self, model_paths, dev_id: int, name: str = "bmodel"):
+        self.name = name
+        if isinstance(model_paths, str):
+            model_paths = [model_paths]
+        self.graphs = []
+        for model_path in model_paths:
+            engine = sail.Engine(model_path, dev_id, sail.IOMode.SYSIO)
+            logging.info("load {} success!".format(model_path))
+            for graph_name in engine.get_graph_names():
+                self.graphs.append(EngineGraph(engine, graph_name, model_path))
+        if not self.graphs:
+            raise ValueError(f"[{name}] 没有可用的 bmodel graph")
+        self.graphs.sort(key=lambda graph: graph.batch_size)
+        sample_shapes = [list(shape[1:]) for shape in self.graphs[0].input_shapes]
+        for graph in self.graphs[1:]:
+            if [list(shape[1:]) for shape in graph.input_shapes] != sample_shapes:
+                raise ValueError(f"[{name}] {graph.model_path} 的输入形状 {graph.input_shapes} 与其他 graph 不一致")
+        self.lock = threading.Lock()
+        self.local = threading.local() # 每个线程各自的补零输入缓冲 {(graph 序号, 输入序号): 数组}
+        logging.info(f"[{name}] 可用的 batch 大小: {[graph.batch_size for graph in self.graphs]}")
+
+    @property
+    def max_batch_size(self) -> int:
+        return self.graphs[-1].batch_size
+
+    @property
+    def input_shapes(self) -> list:
+        return self.graphs[0].input_shapes
+
+    @property
+    def output_shape(self) -> list:
+        return self.graphs[0].output_shape
+
+    def plan(self, count: int) -> list:
+        """把 count 行输入拆分为 [(graph, 起始行, 结束行)]"""
+        chunks = []
+        largest = self.graphs[-1]
+        start = 0
+        while count - start > largest.batch_size:
+            chunks.append((largest, start, start + largest.batch_size))
+            start += largest.batch_size
+        if count > start:
+            graph = next(graph for graph in self.graphs if graph.batch_size >= count - start)
+            chunks.append((graph, start, count))
+        return chunks
+
+    def _padded(self, graph_index: int, input_index: int, chunk: np.ndarray, batch_size: int) -> np.ndarray:
+        """把不足一批的 chunk 复制到本线程复用的 (batch_size, ...) 缓冲中, 其余行置零"""
+        buffers = getattr(self.local, "buffers", None)
+        if buffers is None:
+            buffers = self.local.buffers = {}
+        buffer = buffers.get((graph_index, input_index))
+        if buffer is None or buffer.dtype != chunk.dtype or buffer.shape[1:] != chunk.shape[1:]:
+            buffer = buffers[(graph_index, input_index)] = np.zeros((batch_size, *chunk.shape[1:]), dtype=chunk.dtype)
+        buffer[:len(chunk)] = chunk
+        buffer[len(chunk):] = 0
+        return buffer
+
+    def process(self, inputs: list) -> np.ndarray:
+        """inputs 为按 graph 输入顺序排列的数组列表 (第一维为行数), 返回与输入行数相同的输出"""
+        count = inputs[0].shape[0]
+        outputs = []
+        for graph, start, end in self.plan(count):
+            valid = end - start
+            feed = {}
+            for input_index, (input_name, array) in enumerate(zip(graph.input_names, inputs)):
+                chunk = array[start:end]
+                if valid < graph.batch_size:
+                    chunk = self._padded(self.graphs.index(graph), input_index, chunk, graph.batch_size)
+                feed[input_name] = chunk
+            start_time = time.time()
+            result = graph.engine.process(graph.name, feed)[graph.output_name]
+            elapsed = time.time() - start_time
+            outputs.append(result[:valid])
+            with self.lock:
+                graph.calls += 1
+                graph.rows += valid
+                graph.padded_rows += graph.batch_size - valid
+                graph.busy_seconds += elapsed
+        return np.concatenate(outputs, axis=0)
+
+    def stats(self) -> list:
+        """各 graph 的利用率: utilization 为有效行数占推理行数 (含补零) 的比例, time_share 为占总推理耗时的比例"""
+        with self.lock:
+            total_seconds = sum(graph.busy_seconds for graph in self.graphs)
+            return [{
+                "model": graph.model_path,
+                "graph": graph.name,
+                "batch_size": graph.batch_size,
+                "calls": graph.calls,
+                "rows": graph.rows,
+                "padded_rows": graph.padded_rows,
+                "utilization": round(graph.rows / (graph.calls * graph.batch_size), 3) if graph.calls else None,
+                "avg_call_ms": round(graph.busy_seconds * 1000 / graph.calls, 2) if graph.calls else None,
+                "rows_per_second": round(graph.rows / graph.busy_seconds, 1) if graph.busy_seconds else None,
+                "time_share": round(graph.busy_seconds / total_seconds, 3) if total_seconds else None,
+            } for graph in self.graphs]
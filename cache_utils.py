@@ -0,0 +1,257 @@
+# cache_utils.py
+# 进程内的有界缓存: 按最近使用淘汰 (LRU), 条目超过有效期 (TTL) 后失效。
+# 用于缓存检索结果的排序ID列表, 翻页时只需按ID查询元数据, 无需重新推理和检索;
+# 以及查询文本的 CLIP / BCE 向量, 重复的查询不再经过分词和文本模型推理。
+# 多进程部署时检索结果集还需写入所有 worker 共享的目录 (SharedTTLCache), 翻页请求可能由任意 worker 处理。
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict
+
+# 检索结果集默认保留 10 分钟, 最多缓存 256 个结果集
+DEFAULT_TTL_SECONDS = 600
+DEFAULT_MAX_ENTRIES = 256
+# 共享目录中过期文件的清理间隔
+SHARED_CLEANUP_INTERVAL_SECONDS = 60
+
+
+class TTLCache:
+    """线程安全的 LRU + TTL 缓存"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS, name: str = "cache"):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.name = name
+        self.entries = OrderedDict() # {key: (过期时间, value)}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, (expires_at, _) in self.entries.items() if expires_at <= now]
+        for key in expired:
+            del self.entries[key]
+
+    def get(self, key):
+        """取出未过期的条目并标记为最近使用, 不存在或已过期时返回 None"""
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = (now + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            self._evict_expired(now)
+            while len(self.entries) > self.max_entries:
+                evicted_key, _ = self.entries.popitem(last=False)
+                logging.debug(f"[{self.name}] 缓存已满，淘汰最久未使用的条目 {evicted_key}")
+
+    def add(self, value) -> str:
+        """以随机生成的键存入条目, 返回该键 (用作检索结果集的游标)"""
+        key = uuid.uuid4().hex
+        self.put(key, value)
+        return key
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def configure(self, max_entries: int | None = None, ttl_seconds: float | None = None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max(1, int(max_entries))
+            if ttl_seconds is not None:
+                self.ttl_seconds = max(1.0, float(ttl_seconds))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def status(self) -> dict:
+        with self.lock:
+            self._evict_expired(time.time())
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class SharedTTLCache(TTLCache):
+    """
+    TTLCache 加上可选的共享目录: share(directory) 之后, 每个条目 (必须可 JSON 序列化) 同时写入
+    <directory>/<key>.json, 本进程内存中没有的键从文件读取, 文件修改时间超过 TTL 即视为过期。
+    未调用 share 时与 TTLCache 相同。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = None
+        self.last_cleanup = 0.0
+
+    def share(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def _path(self, key) -> str | None:
+        key = str(key)
+        # 键来自客户端提交的游标, 只接受 add() 生成的十六进制键, 防止路径穿越
+        if not self.directory or not re.fullmatch(r"[0-9a-f]{32}", key):
+            return None
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        value = super().get(key)
+        path = None if value is not None else self._path(key)
+        if path is None:
+            return value
+        try:
+            if time.time() - os.path.getmtime(path) >= self.ttl_seconds:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"[{self.name}] 读取共享条目 {path} 失败: {e}")
+            return None
+        # 放入本进程的缓存, 之后的翻页不再读取文件 (不计入 put 的写文件)
+        TTLCache.put(self, key, value)
+        return value
+
+    def put(self, key, value):
+        super().put(key, value)
+        path = self._path(key)
+        if path is None:
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"[{self.name}] 写入共享条目 {path} 失败, 只能由本进程读取: {e}")
+        self._cleanup_shared()
+
+    def delete(self, key):
+        super().delete(key)
+        path = self._path(key)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _cleanup_shared(self):
+        """删除共享目录中已过期的条目, 条目数超过 max_entries 时删除最旧的"""
+        now = time.time()
+        if now - self.last_cleanup < SHARED_CLEANUP_INTERVAL_SECONDS:
+            return
+        self.last_cleanup = now
+        try:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except FileNotFoundError:
+                    continue
+            entries.sort(reverse=True)
+            for rank, (mtime, path) in enumerate(entries):
+                # 未完成的临时文件同样按修改时间清理
+                if now - mtime >= self.ttl_seconds or rank >= self.max_entries:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+        except Exception as e:
+            logging.warning(f"[{self.name}] 清理共享目录 {self.directory} 失败: {e}")
+
+
+def normalize_query_text(text: str) -> str:
+    """查询文本的缓存键: 全角/半角统一 (NFKC)、忽略大小写、合并空白"""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip().lower()
+
+
+class QueryStats:
+    """
+    统计查询文本的出现次数, 保存最常见的 max_tracked 条到 JSON 文件,
+    供下次启动时预热查询向量缓存。每记录 save_every 次查询写一次文件。
+    """
+
+    def __init__(self, path: str, max_tracked: int = 1000, save_every: int = 50):
+        self.path = path
+        self.max_tracked = max_tracked
+        self.save_every = save_every
+        self.counts = Counter()
+        self.unsaved = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                counts = json.load(f)
+            with self.lock:
+                self.counts.update({str(text): int(count) for text, count in counts.items()})
+        except Exception as e:
+            logging.warning(f"读取查询统计 {self.path} 失败: {e}")
+
+    def record(self, texts):
+        with self.lock:
+            self.counts.update(texts)
+            self.unsaved += len(texts)
+            if self.unsaved < self.save_every:
+                return
+            self.unsaved = 0
+            # 只保留最常见的查询, 避免长尾查询无限增长
+            self.counts = Counter(dict(self.counts.most_common(self.max_tracked)))
+            snapshot = dict(self.counts)
+        self._write(snapshot)
+
+    def _write(self, counts: dict):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # 多进程部署时各 worker 都会写入, 临时文件按进程区分
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(counts, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.warning(f"保存查询统计 {self.path} 失败: {e}")
+
+    def most_common(self, n: int) -> list:
+        with self.lock:
+            return [text for text, _ in self.counts.most_common(n)]
+
+
+def encode_cursor(result_set_id: str, offset: int) -> str:
+    return f"{result_set_id}:{offset}"
+
+
+def decode_cursor(cursor: str):
+    """解析游标, 返回 (结果集ID, 偏移量)。格式错误时抛出 ValueError。"""
+    result_set_id, _, offset = str(cursor).partition(":")
+    if not result_set_id or not offset.isdigit():
+        raise ValueError(f"无效的游标: {cursor}")
+    return result_set_id, int(offset)
@@ -9,8 +9,12 @@
 from .bert_tokenizer import FullTokenizer
 _tokenizer = FullTokenizer()
 from .utils import tokenize
-from .clip import CLIP
+from .clip import CLIP, ImagePreprocessor
 
 def load(image_model, text_model, dev_id):
     model = CLIP(image_model, text_model, dev_id)
-    return model, model.preprocess
\ No newline at end of file
+    return model, model.preprocess
+
+def load_preprocess(image_resolution):
+    """只创建CPU预处理 (不加载模型), 用于把推理交给其他进程的 worker"""
+    return ImagePreprocessor(image_resolution).preprocess
\ No newline at end of file
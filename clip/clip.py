@@ -11,59 +11,27 @@ import cv2
 import os
 import time
 
-import sophon.sail as sail
 import logging
+from micro_batching import MicroBatcher
+from bmodel_engine import BmodelEngine
 logging.basicConfig(level=logging.INFO)
 
 
 
-class CLIP:
-    def __init__(self, image_model, text_model, dev_id):
-        # image bmodel
-        self.image_net = sail.Engine(image_model, dev_id, sail.IOMode.SYSIO)
-        logging.info("load {} success!".format(image_model))
-        self.image_net_graph_name = self.image_net.get_graph_names()[0]
-        self.image_net_input_name = self.image_net.get_input_names(self.image_net_graph_name)[0]
-        self.image_net_output_name = self.image_net.get_output_names(self.image_net_graph_name)[0]
-        self.image_net_input_shape = self.image_net.get_input_shape(self.image_net_graph_name, self.image_net_input_name)
-        self.image_net_output_shape = self.image_net.get_output_shape(self.image_net_graph_name, self.image_net_output_name)
-        self.image_net_batch_size = self.image_net_input_shape[0]
-
-        self.image_resolution = self.image_net_input_shape[2] # 224 for vit32-b
-        self.embed_dim = self.image_net_output_shape[1] # 512 for vit32-b
-
-        # text bmodel
-        self.text_net = sail.Engine(text_model, dev_id, sail.IOMode.SYSIO)
-        logging.info("load {} success!".format(text_model))
-        self.text_net_graph_name = self.text_net.get_graph_names()[0]
-        self.text_net_input_name = self.text_net.get_input_names(self.text_net_graph_name)[0]
-        self.text_net_output_name = self.text_net.get_output_names(self.text_net_graph_name)[0]
-        self.text_net_input_shape = self.text_net.get_input_shape(self.text_net_graph_name, self.text_net_input_name)
-        self.text_net_batch_size = self.text_net_input_shape[0]
-
-        self.top_k = 5 # 前5个相似数据
-        # 使用转onnx时保存的固定数据
-        # 获取当前脚本文件的绝对路径
-        script_path = os.path.abspath(__file__)
-        # 获取当前脚本所在的目录
-        script_dir = os.path.dirname(script_path)
-        
-        # init preprocess
+class ImagePreprocessor:
+    """
+    图像编码器输入的CPU预处理, 不依赖TPU。多进程部署时 HTTP worker 在本进程中完成预处理,
+    只把预处理后的张量发送给持有 sail.Engine 的推理进程。
+    """
+    def __init__(self, image_resolution):
+        self.image_resolution = image_resolution
         self.mean = [0.48145466, 0.4578275, 0.40821073]
         self.std = [0.26862954, 0.26130258, 0.27577711]
-
-        self.encode_image_time = 0.0
-        self.encode_text_time = 0.0
         self.preprocess_time = 0.0
-
-    def softmax(self, x, axis=None):
-        e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
-        return e_x / e_x.sum(axis=axis, keepdims=True)
-
-    def topk(self, x, k):
-        indices = np.argpartition(x, -k)[-k:]
-        indices = indices[np.argsort(-x[indices])]
-        return x[indices], indices
+        # 逐通道查找表: lut[c][像素值] = (像素值/255 - mean[c]) / std[c], 在 float64 下计算后转为 float32,
+        # 归一化只需一次查表直接写入输出, 不产生 float64 的中间张量
+        pixel_values = np.arange(256, dtype=np.float64) / 255
+        self.lut = np.stack([(pixel_values - mean) / std for mean, std in zip(self.mean, self.std)]).astype(np.float32)
 
     def letterbox(self, im, new_shape, color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True, stride=32):
         # Resize and pad image while meeting stride-multiple constraints
@@ -98,15 +66,21 @@ class CLIP:
         return im, ratio, (dw, dh)
     
 
-    def preprocess_cpu(self, image):
+    def normalize_into(self, image, out):
+        """把 HWC 的 uint8 图像按通道查表归一化, 以 CHW 写入 out (float32, 形状 (3, H, W))"""
+        for channel in range(3):
+            np.take(self.lut[channel], image[:, :, channel], out=out[channel], mode='clip')
+        return out
+
+    def preprocess_cpu(self, image, out=None):
         # 此处resize和源码不一致，源码经过了center_crop
         image = cv2.resize(image, (self.image_resolution, self.image_resolution), interpolation=cv2.INTER_CUBIC)
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype('float32')
-        image = (image/255-self.mean)/self.std
-        image = np.transpose(image, (2, 0, 1))
-        return image
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if out is None:
+            out = np.empty((3, self.image_resolution, self.image_resolution), dtype=np.float32)
+        return self.normalize_into(image, out)
     
-    def preprocess_cpu_letterbox(self, image):
+    def preprocess_cpu_letterbox(self, image, out=None):
         letterbox_img, ratio, (tx1, ty1) = self.letterbox(
             image,
             new_shape=(self.image_resolution, self.image_resolution),
@@ -117,77 +91,80 @@ class CLIP:
             stride=32
         )
 
-        image = cv2.cvtColor(letterbox_img, cv2.COLOR_BGR2RGB)
-        image = letterbox_img
-        image = image.astype('float32')
-        image = (image/255-self.mean)/self.std
-        image = np.transpose(image, (2, 0, 1))
-        return image
+        # 与已入库的向量保持一致: 直接使用 letterbox 后的 BGR 图像 (不做 BGR2RGB 转换)
+        if out is None:
+            out = np.empty((3, self.image_resolution, self.image_resolution), dtype=np.float32)
+        return self.normalize_into(letterbox_img, out)
 
-    def preprocess(self, image):
+    def preprocess(self, image, out=None):
+        """返回 (3, H, W) 的 float32 输入; 传入 out 时直接写入 out (例如批量缓冲中的一行)"""
         start_time = time.time()
         # 根据实际场景选择预处理方式
-        image = self.preprocess_cpu_letterbox(image)
-        # image = self.preprocess_cpu(image)
+        image = self.preprocess_cpu_letterbox(image, out)
+        # image = self.preprocess_cpu(image, out)
         self.preprocess_time += time.time() - start_time
         return image
 
 
+class CLIP(ImagePreprocessor):
+    def __init__(self, image_model, text_model, dev_id):
+        # image bmodel: 可以是同一网络不同 batch 大小的多个 bmodel, 每次推理选择能装下的最小 graph
+        self.image_net = BmodelEngine(image_model, dev_id, name="CLIP图像")
+        self.image_net_input_shape = self.image_net.input_shapes[0]
+        self.image_net_output_shape = self.image_net.output_shape
+        self.image_net_batch_size = self.image_net.max_batch_size
+
+        self.image_resolution = self.image_net_input_shape[2] # 224 for vit32-b
+        self.embed_dim = self.image_net_output_shape[1] # 512 for vit32-b
+
+        # text bmodel
+        self.text_net = BmodelEngine(text_model, dev_id, name="CLIP文本")
+        self.text_net_input_shape = self.text_net.input_shapes[0]
+        self.text_net_batch_size = self.text_net.max_batch_size
+
+        # 逐个提交的图片 / 文本经请求合并调度器与并发的其他请求合并成一批, 多batch的bmodel一次推理多个请求
+        # 不在调度器中补零: 凑到的请求数由引擎选择最小的可容纳 graph
+        self.image_batcher = MicroBatcher(self.encode_image, self.image_net_batch_size, pad_to_batch=False, name="CLIP图像")
+        self.text_batcher = MicroBatcher(self.encode_text, self.text_net_batch_size, pad_to_batch=False, name="CLIP文本")
+
+        self.top_k = 5 # 前5个相似数据
+        # 使用转onnx时保存的固定数据
+        # 获取当前脚本文件的绝对路径
+        script_path = os.path.abspath(__file__)
+        # 获取当前脚本所在的目录
+        script_dir = os.path.dirname(script_path)
+        
+        # init preprocess
+        ImagePreprocessor.__init__(self, self.image_resolution)
+
+        self.encode_image_time = 0.0
+        self.encode_text_time = 0.0
+
+    def softmax(self, x, axis=None):
+        e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
+        return e_x / e_x.sum(axis=axis, keepdims=True)
+
+    def topk(self, x, k):
+        indices = np.argpartition(x, -k)[-k:]
+        indices = indices[np.argsort(-x[indices])]
+        return x[indices], indices
+
     def encode_image(self, image: np.ndarray):
         start_time = time.time()
-        image_batch = image.shape[0]
-        processed_outputs = []
-        if image_batch > self.image_net_batch_size:
-            for start_idx in range(0, image_batch, self.image_net_batch_size):
-                end_idx = min(start_idx + self.image_net_batch_size, image_batch)  # Ensure end_idx does not exceed image_batch
-                batch_slice = image[start_idx:end_idx]
-                if batch_slice.shape[0] < self.image_net_batch_size:
-                    padding_size = self.image_net_batch_size - batch_slice.shape[0]
-                    batch_slice = np.concatenate([batch_slice, np.zeros((padding_size, *batch_slice.shape[1:]), dtype=batch_slice.dtype)], axis=0)
-                input_data = {self.image_net_input_name: batch_slice}
-                results = self.image_net.process(self.image_net_graph_name, input_data)[self.image_net_output_name]
-                processed_outputs.append(results)
-        else:
-            padding_image = None
-            if image_batch < self.image_net_batch_size:
-                padding_image = np.concatenate([image, np.zeros((self.image_net_batch_size - image_batch, *image.shape[1:]), dtype=image.dtype)], axis=0)
-            else:
-                padding_image = image
-            input_data = {self.image_net_input_name: padding_image}
-            results = self.image_net.process(self.image_net_graph_name, input_data)[self.image_net_output_name]
-            processed_outputs.append(results)
-
-        processed_outputs = np.concatenate(processed_outputs, axis=0)
+        processed_outputs = self.image_net.process([image])
         self.encode_image_time += time.time() - start_time
-        return processed_outputs[:image_batch]  # Trim padding off the final output if it was padded
+        return processed_outputs
 
 
     def encode_text(self, text):
         start_time = time.time()
-        text_batch = text.shape[0]
-        processed_outputs = []
-        if text_batch > self.text_net_batch_size:
-            for start_idx in range(0, text_batch, self.text_net_batch_size):
-                end_idx = min(start_idx + self.text_net_batch_size, text_batch)  # Ensure end_idx does not exceed text_batch
-                batch_slice = text[start_idx:end_idx]
-                if batch_slice.shape[0] < self.text_net_batch_size:
-                    padding_size = self.text_net_batch_size - batch_slice.shape[0]
-                    batch_slice = np.concatenate([batch_slice, np.zeros((padding_size, *batch_slice.shape[1:]), dtype=batch_slice.dtype)], axis=0)
-                input_data = {self.text_net_input_name: batch_slice}
-                results = self.text_net.process(self.text_net_graph_name, input_data)[self.text_net_output_name]
-                processed_outputs.append(results)
-        else:
-            padding_text = None
-            if text_batch < self.text_net_batch_size:
-                padding_size = self.text_net_batch_size - text_batch
-                padding_text = np.concatenate([text, np.zeros((padding_size, *text.shape[1:]), dtype=text.dtype)], axis=0)
-            else:
-                padding_text = text
-            input_data = {self.text_net_input_name: padding_text}
-            results = self.text_net.process(self.text_net_graph_name, input_data)[self.text_net_output_name]
-            processed_outputs.append(results)
+        processed_outputs = self.text_net.process([text])
         self.encode_text_time += time.time() - start_time
-        return processed_outputs[0]
+        return processed_outputs
+
+    def graph_stats(self) -> dict:
+        """图像/文本编码器各 batch 大小 graph 的利用率"""
+        return {"clip_image": self.image_net.stats(), "clip_text": self.text_net.stats()}
 
 
     def predict(self, image, text):
@@ -3,11 +3,21 @@ import sqlite3
 import json
 import logging
 import os
+import re
+import threading
+import unicodedata
 import numpy as np
 from datetime import datetime
 
 DATABASE_PATH = os.path.join("data", "smart_album.db")
 
+# 数据版本号: 每次写入图片、标签、人脸等数据后递增, 检索结果缓存以它判断缓存的结果是否过期
+data_version = 0
+data_version_lock = threading.Lock()
+# 多进程部署时由 enable_multiprocess_access 创建的常驻连接: 其他连接 (包括其他进程) 提交写入后,
+# 这个连接上的 PRAGMA data_version 会变化, 据此让检索缓存感知其他 worker 的写入
+data_version_monitor = None
+
 # --- 辅助函数，用于Numpy数组和BLOB的转换 ---
 def adapt_array(arr):
     return json.dumps(arr.tolist())
@@ -22,6 +32,10 @@ def convert_array(text):
         return None
     
     try:
+        # 早期版本的 update_image_clip_embedding 以 ndarray.tobytes() 写入原始float32字节
+        if isinstance(text, bytes) and not text.lstrip().startswith(b'[') and len(text) % 4 == 0:
+            return np.frombuffer(text, dtype=np.float32).copy()
+
         # 如果是bytes类型，尝试解码为字符串
         if isinstance(text, bytes):
             try:
@@ -110,6 +124,165 @@ sqlite3.register_adapter(np.ndarray, adapt_array)
 sqlite3.register_converter("ARRAY", convert_array)
 
 
+def bump_data_version():
+    global data_version
+    with data_version_lock:
+        data_version += 1
+
+def get_data_version() -> int:
+    if data_version_monitor is None:
+        return data_version
+    with data_version_lock:
+        external_version = data_version_monitor.execute("PRAGMA data_version").fetchone()[0]
+    # 两个计数都只增不减, 其和在本进程或其他进程写入后都会变化
+    return data_version + external_version
+
+def enable_multiprocess_access():
+    """
+    多进程部署 (多个 HTTP worker 共享同一个数据库) 时在每个进程中调用:
+    切换为 WAL 模式使读取不被其他进程的写入阻塞, 并让 get_data_version 反映其他进程的写入。
+    """
+    global data_version_monitor
+    conn = get_db_connection()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    finally:
+        conn.close()
+    data_version_monitor = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+
+
+# --- 全文索引 (FTS5): Qwen描述、关键词与用户标签的倒排索引, 供关键词/标签检索与BM25打分 ---
+# FTS5 自带的分词器不切分中文 (unicode61 把整段中文当作一个词, trigram 要求至少3个字),
+# 因此写入前先在Python中分词: 中日韩文字输出单字与相邻两字 (bigram), 其余按字母数字连续串切分。
+# 索引由 update_image_enhancement / update_user_tags_for_image / hard_delete_image_from_db 增量维护。
+FTS_CJK_CHARS = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+FTS_TOKEN_RE = re.compile(f"([{FTS_CJK_CHARS}]+)|([^\\W_{FTS_CJK_CHARS}]+)")
+# bm25 列权重: 描述、关键词、用户标签 (关键词和标签是精确的短语, 权重更高)
+FTS_COLUMN_WEIGHTS = (1.0, 2.0, 3.0)
+fts_enabled = True # SQLite 未编译 FTS5 时为 False, 关键词检索返回空结果
+
+def fts_tokens(text: str, for_query: bool = False) -> list:
+    """
+    分词: 中文连续串输出单字和两字组 (查询时只输出两字组, 单个字时输出该字, 使查询的每个词都必须出现),
+    字母数字连续串转为小写后整体作为一个词。
+    """
+    tokens = []
+    for cjk, word in FTS_TOKEN_RE.findall(unicodedata.normalize("NFKC", text or "").lower()):
+        if word:
+            tokens.append(word)
+            continue
+        bigrams = [cjk[i:i + 2] for i in range(len(cjk) - 1)]
+        if for_query:
+            tokens.extend(bigrams or [cjk])
+        else:
+            tokens.extend(cjk)
+            tokens.extend(bigrams)
+    return tokens
+
+def _fts_document(description, keywords_json, tags_json):
+    """将图片的描述、关键词JSON、标签JSON转换为三列分好词的文本, 没有任何内容时返回 None"""
+    columns = [fts_tokens(description)]
+    for value in (keywords_json, tags_json):
+        try:
+            items = json.loads(value) if value else []
+        except (json.JSONDecodeError, TypeError):
+            items = []
+        columns.append(fts_tokens(" ".join(item for item in items if isinstance(item, str))))
+    if not any(columns):
+        return None
+    return tuple(" ".join(tokens) for tokens in columns)
+
+def _sync_image_fts(cursor, image_id: int):
+    """在调用方的事务中重建单张图片的全文索引条目"""
+    if not fts_enabled:
+        return
+    cursor.execute("DELETE FROM images_fts WHERE rowid = ?", (image_id,))
+    row = cursor.execute("SELECT qwen_description, qwen_keywords, user_tags FROM images WHERE id = ? AND deleted = FALSE",
+                         (image_id,)).fetchone()
+    document = _fts_document(*row) if row else None
+    if document:
+        cursor.execute("INSERT INTO images_fts (rowid, description, keywords, tags) VALUES (?, ?, ?, ?)",
+                       (image_id, *document))
+
+def _init_fts(cursor):
+    """创建全文索引表, 首次创建时从 images 表回填"""
+    global fts_enabled
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'images_fts'").fetchone() is not None
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(description, keywords, tags, tokenize='unicode61')")
+    except sqlite3.OperationalError as e:
+        fts_enabled = False
+        logging.warning(f"SQLite 不支持 FTS5，关键词检索不可用: {e}")
+        return
+    if exists:
+        return
+    rows = cursor.execute("""
+        SELECT id, qwen_description, qwen_keywords, user_tags FROM images
+        WHERE deleted = FALSE AND (qwen_description IS NOT NULL OR qwen_keywords IS NOT NULL OR user_tags != '[]')
+    """).fetchall()
+    documents = [(row["id"], *document) for row in rows
+                 for document in [_fts_document(row["qwen_description"], row["qwen_keywords"], row["user_tags"])] if document]
+    cursor.executemany("INSERT INTO images_fts (rowid, description, keywords, tags) VALUES (?, ?, ?, ?)", documents)
+    logging.info(f"全文索引已创建，回填 {len(documents)} 张图片。")
+
+def _fts_match_expression(query: str):
+    """查询文本转换为 FTS5 MATCH 表达式: 每个词加引号按字面匹配, 词之间为 AND。没有可检索的词时返回 None。"""
+    tokens = fts_tokens(query, for_query=True)
+    if not fts_enabled or not tokens:
+        return None
+    return " ".join(f'"{token}"' for token in tokens)
+
+def search_images_fts(query: str, limit: int = 200):
+    """
+    在描述、关键词和用户标签中检索查询文本的所有词, 按 BM25 排序。
+    返回 (faiss_id列表, 分数列表), 分数越高越相关; 没有可检索的词或 FTS5 不可用时返回空列表。
+    """
+    match_expression = _fts_match_expression(query)
+    if match_expression is None:
+        return [], []
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("""
+            SELECT images.faiss_id, bm25(images_fts, ?, ?, ?) AS score
+            FROM images_fts JOIN images ON images.id = images_fts.rowid
+            WHERE images_fts MATCH ? AND images.deleted = FALSE AND images.faiss_id IS NOT NULL
+            ORDER BY score
+            LIMIT ?
+        """, (*FTS_COLUMN_WEIGHTS, match_expression, limit)).fetchall()
+        # FTS5 的 bm25() 越小越相关, 取反后与向量相似度方向一致
+        return [row["faiss_id"] for row in rows], [-row["score"] for row in rows]
+    except sqlite3.OperationalError as e:
+        logging.error(f"全文检索 '{query}' 失败: {e}")
+        return [], []
+    finally:
+        conn.close()
+
+
+def get_fts_scores(query: str, faiss_ids) -> dict:
+    """只对给定的图片计算查询文本的 BM25 分数 (两阶段检索的候选重排), 返回 {faiss_id: 分数}, 未命中的图片不在结果中"""
+    match_expression = _fts_match_expression(query)
+    faiss_ids = [int(faiss_id) for faiss_id in faiss_ids]
+    if match_expression is None or not faiss_ids:
+        return {}
+    conn = get_db_connection()
+    try:
+        scores = {}
+        for start in range(0, len(faiss_ids), 900):
+            chunk = faiss_ids[start:start + 900]
+            rows = conn.execute(f"""
+                SELECT images.faiss_id, bm25(images_fts, ?, ?, ?) AS score
+                FROM images_fts JOIN images ON images.id = images_fts.rowid
+                WHERE images_fts MATCH ? AND images.faiss_id IN ({",".join("?" * len(chunk))}) AND images.deleted = FALSE
+            """, (*FTS_COLUMN_WEIGHTS, match_expression, *chunk)).fetchall()
+            scores.update((row["faiss_id"], -row["score"]) for row in rows)
+        return scores
+    except sqlite3.OperationalError as e:
+        logging.error(f"全文检索 '{query}' 的候选打分失败: {e}")
+        return {}
+    finally:
+        conn.close()
+
+
 def get_db_connection():
     os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
     conn = sqlite3.connect(DATABASE_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
@@ -140,9 +313,19 @@ def init_db():
             has_face_detection BOOLEAN DEFAULT FALSE,    -- 是否已完成人脸识别
             has_face_clustering BOOLEAN DEFAULT FALSE,   -- 是否已完成人脸聚类
             last_enhanced_timestamp TIMESTAMP,
+            -- 原图/缩略图文件是否存在 (写入时设置, 删除时清除, 由后台校验任务定期核对), 生成URL时不再逐个stat
+            original_exists BOOLEAN DEFAULT TRUE,
+            thumbnail_exists BOOLEAN DEFAULT TRUE,
             deleted BOOLEAN DEFAULT FALSE 
         )
     ''')
+    # 旧数据库升级: 补充文件存在标志位, 实际状态由启动后的文件校验任务核对
+    image_columns = {row["name"] for row in cursor.execute("PRAGMA table_info(images)").fetchall()}
+    if "original_exists" not in image_columns:
+        cursor.execute("ALTER TABLE images ADD COLUMN original_exists BOOLEAN DEFAULT TRUE")
+    if "thumbnail_exists" not in image_columns:
+        cursor.execute("ALTER TABLE images ADD COLUMN thumbnail_exists BOOLEAN DEFAULT TRUE")
+        cursor.execute("UPDATE images SET thumbnail_exists = FALSE WHERE thumbnail_path IS NULL")
 
     # ✅ 2. 创建索引
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_faiss_id ON images (faiss_id)")
@@ -152,6 +335,30 @@ def init_db():
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_is_enhanced ON images (is_enhanced)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_has_face_detection ON images (has_face_detection)")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_has_face_clustering ON images (has_face_clustering)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_upload_timestamp ON images (upload_timestamp)")
+
+    # 用户标签的倒排表 (images.user_tags 中的JSON无法走索引)，供按标签过滤检索
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS image_tags (
+            image_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (tag, image_id)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_image_tags_image_id ON image_tags (image_id)")
+    # 旧数据库首次升级时从 images.user_tags 回填
+    if cursor.execute("SELECT 1 FROM image_tags LIMIT 1").fetchone() is None:
+        rows = cursor.execute("SELECT id, user_tags FROM images WHERE user_tags IS NOT NULL AND user_tags != '[]'").fetchall()
+        for row in rows:
+            try:
+                tags = json.loads(row["user_tags"])
+            except (json.JSONDecodeError, TypeError):
+                continue
+            cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag) VALUES (?, ?)",
+                               [(row["id"], tag) for tag in tags if isinstance(tag, str)])
+
+    # 描述、关键词与用户标签的全文索引
+    _init_fts(cursor)
 
     # 人脸聚类表，代表一个唯一的人
     cursor.execute('''
@@ -200,11 +407,13 @@ def add_image_to_db(original_filename: str, original_path: str, thumbnail_path:
         
         cursor.execute('''
             INSERT INTO images (original_filename, original_path, thumbnail_path, clip_embedding, 
-                               has_clip_embedding, is_enhanced, has_face_detection, has_face_clustering, user_tags)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                               has_clip_embedding, is_enhanced, has_face_detection, has_face_clustering, user_tags,
+                               original_exists, thumbnail_exists)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (original_filename, original_path, thumbnail_path, clip_embedding, 
-              has_clip, False, False, False, json.dumps([]))) 
+              has_clip, False, False, False, json.dumps([]), True, thumbnail_path is not None)) 
         conn.commit()
+        bump_data_version()
         image_id = cursor.lastrowid
         logging.info(f"图片 '{original_filename}' (ID: {image_id}) 已初步添加到数据库，CLIP状态: {has_clip}")
         return image_id
@@ -220,6 +429,7 @@ def update_faiss_id_for_image(image_id: int, faiss_id: int):
         cursor = conn.cursor()
         cursor.execute("UPDATE images SET faiss_id = ? WHERE id = ?", (faiss_id, image_id))
         conn.commit()
+        bump_data_version()
         logging.info(f"数据库中图片 ID {image_id} 的 FAISS ID 已更新为 {faiss_id}")
         return True
     except Exception as e:
@@ -243,7 +453,10 @@ def hard_delete_image_from_db(image_id: int):
     try:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM images WHERE id = ?", (image_id,))
+        cursor.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+        _sync_image_fts(cursor, image_id)
         conn.commit()
+        bump_data_version()
         logging.info(f"已从数据库中硬删除图片 ID: {image_id}。")
         return True
     except Exception as e:
@@ -252,6 +465,49 @@ def hard_delete_image_from_db(image_id: int):
     finally:
         conn.close()
 
+def update_image_file_flags(image_id: int, original_exists: bool | None = None, thumbnail_exists: bool | None = None):
+    """设置图片的原图/缩略图文件存在标志位 (None 表示不修改)"""
+    return update_images_file_flags([(image_id, original_exists, thumbnail_exists)])
+
+def update_images_file_flags(changes: list) -> bool:
+    """批量设置文件存在标志位。changes: [(image_id, original_exists, thumbnail_exists)], None 表示不修改该项。"""
+    rows = [(original_exists, original_exists, thumbnail_exists, thumbnail_exists, int(image_id))
+            for image_id, original_exists, thumbnail_exists in changes]
+    if not rows:
+        return True
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE images SET original_exists = CASE WHEN ? IS NULL THEN original_exists ELSE ? END,
+                              thumbnail_exists = CASE WHEN ? IS NULL THEN thumbnail_exists ELSE ? END
+            WHERE id = ?
+        """, rows)
+        conn.commit()
+        bump_data_version()
+        return True
+    except Exception as e:
+        logging.error(f"更新 {len(rows)} 张图片的文件存在标志位失败: {e}")
+        return False
+    finally:
+        conn.close()
+
+def get_image_file_records(after_id: int = 0, limit: int = 1000):
+    """按ID升序分批读取图片的文件路径及存在标志位 (用于后台文件校验), 只返回 id > after_id 的记录"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, original_path, thumbnail_path, original_exists, thumbnail_exists
+            FROM images
+            WHERE id > ? AND deleted = FALSE
+            ORDER BY id
+            LIMIT ?
+        """, (after_id, limit))
+        return cursor.fetchall()
+    finally:
+        conn.close()
+
 def update_image_enhancement(image_id: int, description: str, keywords: list):
     conn = get_db_connection()
     try:
@@ -262,7 +518,9 @@ def update_image_enhancement(image_id: int, description: str, keywords: list):
             SET qwen_description = ?, qwen_keywords = ?, is_enhanced = TRUE, last_enhanced_timestamp = ?
             WHERE id = ? AND deleted = FALSE
         ''', (description, keywords_json, datetime.now(), image_id))
+        _sync_image_fts(cursor, image_id)
         conn.commit()
+        bump_data_version()
         logging.info(f"图片 ID: {image_id} 的增强信息已更新。")
         return True
     except Exception as e:
@@ -277,7 +535,13 @@ def update_user_tags_for_image(image_id: int, user_tags: list[str]):
         cursor = conn.cursor()
         tags_json = json.dumps(user_tags, ensure_ascii=False)
         cursor.execute("UPDATE images SET user_tags = ? WHERE id = ? AND deleted = FALSE", (tags_json, image_id))
+        if cursor.rowcount > 0:
+            cursor.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+            cursor.executemany("INSERT OR IGNORE INTO image_tags (image_id, tag) VALUES (?, ?)",
+                               [(image_id, tag) for tag in user_tags])
+            _sync_image_fts(cursor, image_id)
         conn.commit()
+        bump_data_version()
         logging.info(f"图片 ID: {image_id} 的用户标签已更新为: {tags_json}")
         return True
     except Exception as e:
@@ -302,12 +566,94 @@ def get_image_by_faiss_id(faiss_id: int):
     conn.close()
     return image_data
 
+# 检索结果条目用到的列，不读取 embedding 等大字段
+SEARCH_RESULT_COLUMNS = ("id", "faiss_id", "original_filename", "original_path", "thumbnail_path",
+                         "original_exists", "thumbnail_exists", "qwen_description", "qwen_keywords", "user_tags",
+                         "is_enhanced")
+
+def _get_images_by_column(column: str, keys, columns=SEARCH_RESULT_COLUMNS) -> list:
+    """
+    按 id 或 faiss_id 批量读取图片记录: 一个连接, 每 900 个ID一条 IN 查询, 只读取 columns。
+    返回与 keys 顺序一致的列表, 不存在或已删除的记录为 None。
+    """
+    keys = [int(key) for key in keys]
+    if not keys:
+        return []
+    rows_by_key = {}
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # 分批查询，避免超过SQLite的参数数量上限
+        for start in range(0, len(keys), 900):
+            chunk = keys[start:start + 900]
+            cursor.execute(f"""
+                SELECT {', '.join(columns)} FROM images
+                WHERE {column} IN ({','.join('?' for _ in chunk)}) AND deleted = FALSE
+            """, chunk)
+            for row in cursor.fetchall():
+                rows_by_key[row[column]] = row
+    finally:
+        conn.close()
+    return [rows_by_key.get(key) for key in keys]
+
+def get_images_by_faiss_ids(faiss_ids, columns=SEARCH_RESULT_COLUMNS) -> list:
+    """按FAISS ID批量读取图片记录，结果与 faiss_ids 顺序一致 (即检索排名顺序)，缺失的为 None。"""
+    return _get_images_by_column("faiss_id", faiss_ids, columns)
+
+def get_images_by_ids(image_ids, columns=SEARCH_RESULT_COLUMNS) -> list:
+    """按图片ID批量读取图片记录，结果与 image_ids 顺序一致，缺失的为 None。"""
+    return _get_images_by_column("id", image_ids, columns)
+
+def get_faiss_ids_by_filters(tags: list[str] | None = None, date_from: str | None = None, date_to: str | None = None,
+                             is_enhanced: bool | None = None, cluster_ids: list[int] | None = None,
+                             person_name: str | None = None) -> np.ndarray:
+    """
+    将检索过滤条件解析为符合条件的FAISS ID (升序int64数组)，各条件之间为 "且" 的关系，None 表示不限。
+    tags: 同时带有这些用户标签; date_from/date_to: 上传时间范围 (含两端, 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:MM:SS');
+    is_enhanced: 是否已完成增强分析; cluster_ids / person_name: 包含任一指定人物 (聚类ID / 聚类名称模糊匹配)。
+    """
+    conditions = ["deleted = FALSE", "faiss_id IS NOT NULL"]
+    params = []
+    if tags:
+        tags = list(dict.fromkeys(tags))
+        conditions.append(f"""id IN (SELECT image_id FROM image_tags WHERE tag IN ({','.join('?' for _ in tags)})
+                                     GROUP BY image_id HAVING COUNT(*) = ?)""")
+        params.extend(tags)
+        params.append(len(tags))
+    if date_from:
+        conditions.append("upload_timestamp >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("upload_timestamp <= ?")
+        # 只给出日期时包含当天全天
+        params.append(date_to + " 23:59:59" if len(date_to) == 10 else date_to)
+    if is_enhanced is not None:
+        conditions.append("is_enhanced = ?")
+        params.append(bool(is_enhanced))
+    if cluster_ids:
+        conditions.append(f"id IN (SELECT image_id FROM detected_faces WHERE cluster_id IN ({','.join('?' for _ in cluster_ids)}))")
+        params.extend(int(cluster_id) for cluster_id in cluster_ids)
+    if person_name:
+        conditions.append("""id IN (SELECT df.image_id FROM detected_faces df
+                                    JOIN face_clusters fc ON df.cluster_id = fc.cluster_id
+                                    WHERE fc.name LIKE ?)""")
+        params.append(f"%{person_name}%")
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT faiss_id FROM images WHERE {' AND '.join(conditions)} ORDER BY faiss_id", params)
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+    finally:
+        conn.close()
+
 def get_all_images(page: int = 1, limit: int = 20):
     conn = get_db_connection()
     cursor = conn.cursor()
     offset = (page - 1) * limit
     cursor.execute("""
-        SELECT id, original_filename, original_path, thumbnail_path, qwen_description, is_enhanced, user_tags
+        SELECT id, original_filename, original_path, thumbnail_path, original_exists, thumbnail_exists,
+               qwen_description, is_enhanced, user_tags
         FROM images
         WHERE deleted = FALSE
         ORDER BY upload_timestamp DESC
@@ -416,14 +762,14 @@ def update_image_clip_embedding(image_id: int, clip_embedding):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        # 将numpy数组转换为blob
-        embedding_blob = clip_embedding.tobytes() if clip_embedding is not None else None
+        # numpy数组由注册的 adapt_array 转换为JSON，与 add_image_to_db 写入的格式一致
         cursor.execute("""
             UPDATE images 
             SET clip_embedding = ?
             WHERE id = ?
-        """, (embedding_blob, image_id))
+        """, (clip_embedding, image_id))
         conn.commit()
+        bump_data_version()
         success = cursor.rowcount > 0
     except Exception as e:
         logging.error(f"更新图片 {image_id} 的CLIP embedding失败: {e}")
@@ -433,6 +779,75 @@ def update_image_clip_embedding(image_id: int, clip_embedding):
         conn.close()
     return success
 
+def update_images_clip_embeddings(rows: list) -> list:
+    """批量更新CLIP embedding (一次事务)。rows: [(image_id, clip_embedding)]，返回实际更新的图片ID (已被删除的图片不在其中)"""
+    if not rows:
+        return []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        image_ids = [int(image_id) for image_id, _ in rows]
+        placeholders = ",".join("?" * len(image_ids))
+        existing = {row[0] for row in cursor.execute(f"SELECT id FROM images WHERE id IN ({placeholders})", image_ids)}
+        cursor.executemany("UPDATE images SET clip_embedding = ? WHERE id = ?",
+                           [(clip_embedding, int(image_id)) for image_id, clip_embedding in rows if int(image_id) in existing])
+        conn.commit()
+        bump_data_version()
+        return [image_id for image_id in image_ids if image_id in existing]
+    except Exception as e:
+        logging.error(f"批量更新 {len(rows)} 张图片的CLIP embedding失败: {e}")
+        conn.rollback()
+        return []
+    finally:
+        conn.close()
+
+def update_image_bce_embedding(image_id: int, bce_embedding):
+    """保存图片描述的BCE embedding (全精度)，供压缩索引精排和索引重建使用"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE images SET bce_embedding = ? WHERE id = ?", (bce_embedding, image_id))
+        conn.commit()
+        bump_data_version()
+        success = cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"更新图片 {image_id} 的BCE embedding失败: {e}")
+        conn.rollback()
+        success = False
+    finally:
+        conn.close()
+    return success
+
+def get_embeddings_by_faiss_ids(faiss_ids, column: str = "clip_embedding"):
+    """
+    按FAISS ID批量读取全精度embedding。
+    返回 (找到的faiss_id数组, float32矩阵)，没有该embedding的ID会被跳过。
+    """
+    if column not in ("clip_embedding", "bce_embedding"):
+        raise ValueError(f"不支持的embedding字段: {column}")
+    found_ids = []
+    vectors = []
+    faiss_ids = [int(faiss_id) for faiss_id in faiss_ids]
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # 分批查询，避免超过SQLite的参数数量上限
+        for start in range(0, len(faiss_ids), 900):
+            chunk = faiss_ids[start:start + 900]
+            cursor.execute(f"""
+                SELECT faiss_id, {column} FROM images
+                WHERE faiss_id IN ({','.join('?' for _ in chunk)}) AND deleted = FALSE AND {column} IS NOT NULL
+            """, chunk)
+            for row in cursor.fetchall():
+                if row[column] is not None:
+                    found_ids.append(row['faiss_id'])
+                    vectors.append(row[column])
+    finally:
+        conn.close()
+    if not vectors:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    return np.array(found_ids, dtype=np.int64), np.vstack(vectors).astype(np.float32)
+
 def update_face_cluster(face_id: int, cluster_id: int):
     """更新人脸的聚类信息"""
     conn = get_db_connection()
@@ -444,6 +859,7 @@ def update_face_cluster(face_id: int, cluster_id: int):
             WHERE face_id = ?
         """, (cluster_id, face_id))
         conn.commit()
+        bump_data_version()
         success = cursor.rowcount > 0
     except Exception as e:
         logging.error(f"更新人脸 {face_id} 的聚类信息失败: {e}")
@@ -480,6 +896,7 @@ def update_image_status_flags(image_id: int, **flags):
     try:
         cursor.execute(update_query, values)
         conn.commit()
+        bump_data_version()
         success = cursor.rowcount > 0
         if success:
             logging.info(f"图片 {image_id} 状态标志位已更新: {flags}")
@@ -491,6 +908,37 @@ def update_image_status_flags(image_id: int, **flags):
         conn.close()
     return success
 
+def update_images_status_flags(image_ids: list[int], **flags):
+    """批量更新多张图片的状态标志位 (同一组标志位, 一次事务)，返回更新的行数"""
+    if not image_ids:
+        return 0
+    valid_flags = ['has_clip_embedding', 'is_enhanced', 'has_face_detection', 'has_face_clustering']
+    updates = []
+    values = []
+    for flag, value in flags.items():
+        if flag in valid_flags and isinstance(value, bool):
+            updates.append(f"{flag} = ?")
+            values.append(value)
+    if not updates:
+        return 0
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    update_query = f"UPDATE images SET {', '.join(updates)} WHERE id = ?"
+    try:
+        cursor.executemany(update_query, [values + [image_id] for image_id in image_ids])
+        conn.commit()
+        bump_data_version()
+        updated = cursor.rowcount
+        logging.info(f"{updated} 张图片状态标志位已更新: {flags}")
+    except Exception as e:
+        logging.error(f"批量更新图片状态标志位失败 ({len(image_ids)} 张): {e}")
+        conn.rollback()
+        updated = 0
+    finally:
+        conn.close()
+    return updated
+
 def get_clip_embedding_for_image(image_id: int) -> np.ndarray | None:
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -543,6 +991,7 @@ def create_new_face_cluster(cover_face_id: int = None):
         cursor = conn.cursor()
         cursor.execute("INSERT INTO face_clusters (cover_face_id, face_count) VALUES (?, 1)", (cover_face_id,))
         conn.commit()
+        bump_data_version()
         new_cluster_id = cursor.lastrowid
         logging.info(f"创建了新的人脸聚类，ID: {new_cluster_id}")
         return new_cluster_id
@@ -565,6 +1014,7 @@ def add_detected_face(image_id: int, cluster_id: int, face_box: list, attributes
         if cluster_id is not None:
             cursor.execute("UPDATE face_clusters SET face_count = face_count + 1 WHERE cluster_id = ?", (cluster_id,))
         conn.commit()
+        bump_data_version()
         face_id = cursor.lastrowid
         if cluster_id is not None:
             logging.info(f"已添加人脸记录 face_id: {face_id} 到图片 id: {image_id}, 聚类 id: {cluster_id}")
@@ -594,6 +1044,66 @@ def get_faces_by_image_id(image_id: int):
     conn.close()
     return faces
     
+def get_live_faiss_ids(status_flag: str | None = None) -> np.ndarray:
+    """
+    未删除图片的FAISS ID (升序int64数组)，用于与索引对账。
+    status_flag 不为 None 时只返回该状态标志位为真的图片 (has_clip_embedding: 应在CLIP索引中; is_enhanced: 应在BCE索引中)。
+    只按标志位过滤而不检查embedding字段是否为空, 避免读取每一行的大字段。
+    """
+    if status_flag not in (None, "has_clip_embedding", "is_enhanced"):
+        raise ValueError(f"不支持的状态标志位: {status_flag}")
+    condition = f" AND {status_flag} = TRUE" if status_flag else ""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"SELECT faiss_id FROM images WHERE deleted = FALSE AND faiss_id IS NOT NULL{condition}")
+        return np.sort(np.fromiter((row[0] for row in cursor), dtype=np.int64))
+    finally:
+        conn.close()
+
+def get_live_face_ids(clustered_only: bool = False) -> np.ndarray:
+    """
+    属于未删除图片的人脸ID (升序int64数组)，用于与人脸索引对账。
+    clustered_only=True 时只返回已聚类的人脸 (即应当在人脸索引中的人脸)。
+    """
+    condition = " AND df.cluster_id IS NOT NULL" if clustered_only else ""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(f"""
+            SELECT df.face_id FROM detected_faces df
+            JOIN images i ON i.id = df.image_id
+            WHERE i.deleted = FALSE{condition}
+        """)
+        return np.sort(np.fromiter((row[0] for row in cursor), dtype=np.int64))
+    finally:
+        conn.close()
+
+def get_face_features_by_ids(face_ids):
+    """按 face_id 批量读取人脸特征向量，返回 (找到的face_id数组, float32矩阵)，没有特征向量的人脸会被跳过。"""
+    found_ids = []
+    vectors = []
+    face_ids = [int(face_id) for face_id in face_ids]
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # 分批查询，避免超过SQLite的参数数量上限
+        for start in range(0, len(face_ids), 900):
+            chunk = face_ids[start:start + 900]
+            cursor.execute(f"""
+                SELECT face_id, feature_vector FROM detected_faces
+                WHERE face_id IN ({','.join('?' for _ in chunk)}) AND feature_vector IS NOT NULL
+            """, chunk)
+            for row in cursor.fetchall():
+                try:
+                    vectors.append(np.array(json.loads(row['feature_vector']), dtype=np.float32))
+                    found_ids.append(row['face_id'])
+                except (json.JSONDecodeError, TypeError, ValueError):
+                    logging.warning(f"人脸 ID {row['face_id']} 的特征向量无法解析，已跳过。")
+    finally:
+        conn.close()
+    if not vectors:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    return np.array(found_ids, dtype=np.int64), np.vstack(vectors)
+
 def get_face_ids_by_image_ids(image_ids: list[int]):
     """根据图片ID列表，获取所有相关的face_id。"""
     if not image_ids:
@@ -623,7 +1133,7 @@ def get_images_by_cluster_id(cluster_id: int, page: int = 1, limit: int = 50):
 
     # 分页查询图片信息
     cursor.execute("""
-        SELECT DISTINCT i.id, i.original_filename, i.original_path, i.thumbnail_path
+        SELECT DISTINCT i.id, i.original_filename, i.original_path, i.thumbnail_path, i.original_exists, i.thumbnail_exists
         FROM images i
         JOIN detected_faces df ON i.id = df.image_id
         WHERE df.cluster_id = ? AND i.deleted = FALSE
@@ -635,6 +1145,36 @@ def get_images_by_cluster_id(cluster_id: int, page: int = 1, limit: int = 50):
     conn.close()
     return images, total_count
 
+def get_image_ids_by_cluster_id(cluster_id: int) -> list:
+    """包含该人物的全部图片ID, 排序与 get_images_by_cluster_id 相同 (上传时间倒序), 供流式输出逐块查询"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("""
+            SELECT i.id FROM images i
+            WHERE i.deleted = FALSE AND i.id IN (SELECT image_id FROM detected_faces WHERE cluster_id = ?)
+            ORDER BY i.upload_timestamp DESC
+        """, (cluster_id,)).fetchall()
+        return [row["id"] for row in rows]
+    finally:
+        conn.close()
+
+def get_image_ids_by_cluster_name(name_query: str) -> list:
+    """人物名称模糊匹配的全部图片ID, 排序与 get_images_by_cluster_name 相同 (上传时间倒序)"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("""
+            SELECT i.id FROM images i
+            WHERE i.deleted = FALSE AND i.id IN (
+                SELECT df.image_id FROM detected_faces df
+                JOIN face_clusters fc ON df.cluster_id = fc.cluster_id
+                WHERE fc.name LIKE ?
+            )
+            ORDER BY i.upload_timestamp DESC
+        """, (f"%{name_query}%",)).fetchall()
+        return [row["id"] for row in rows]
+    finally:
+        conn.close()
+
 def get_all_face_clusters():
     """获取所有人脸聚类信息，包括每个聚类的代表性封面"""
     conn = get_db_connection()
@@ -666,6 +1206,7 @@ def update_face_cluster_name(cluster_id: int, name: str):
         cursor = conn.cursor()
         cursor.execute("UPDATE face_clusters SET name = ? WHERE cluster_id = ?", (name, cluster_id))
         conn.commit()
+        bump_data_version()
         updated = cursor.rowcount > 0
         if updated:
             logging.info(f"聚类 {cluster_id} 名称已更新为 '{name}'")
@@ -695,7 +1236,7 @@ def get_images_by_cluster_name(name_query: str, page: int = 1, limit: int = 50):
 
         # 分页查询图片信息
         cursor.execute("""
-            SELECT DISTINCT i.id, i.original_filename, i.original_path, i.thumbnail_path
+            SELECT DISTINCT i.id, i.original_filename, i.original_path, i.thumbnail_path, i.original_exists, i.thumbnail_exists
             FROM images i
             JOIN detected_faces df ON i.id = df.image_id
             JOIN face_clusters fc ON df.cluster_id = fc.cluster_id
@@ -0,0 +1,251 @@
+# embedding_store.py
+# 常驻内存的向量矩阵: 一块连续的 float32 / float16 矩阵加 ID→行号映射。
+# 压缩索引的精确重排、融合检索补算相似度等直接读取这里的向量, 不再从 SQLite 中逐条解析 JSON 文本。
+# 快照保存为矩阵与ID两个 .npy 文件 (矩阵可写时复制地 mmap 加载), 启动时与数据库核对ID集合, 只为有差异的记录读取数据库。
+# 两个文件依次替换, 因此各自末尾带有同一个随机的快照标记: 矩阵的最后一行 (前 8 个字节) 与ID数组的最后一个元素,
+# 两者不一致 (例如在两次替换之间崩溃) 时整个快照作废, 从数据库重建, 不会把旧矩阵的向量对应到新的ID上。
+# 上传、批量CLIP、删除等写入通过 faiss_utils.set_embedding_store 注册后随索引写入增量同步。
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+STORE_DTYPES = {"float32": np.float32, "float16": np.float16}
+INITIAL_CAPACITY = 1024
+GROWTH_FACTOR = 1.5
+# 启动核对时每次从数据库读取的向量数
+LOAD_CHUNK = 4096
+# 自上次保存以来变更的向量数达到 SAVE_MIN_CHANGES 且超过总数的 SAVE_CHANGE_RATIO 时, save() 才重写快照。
+# 快照过期只会让下一次启动多从数据库读取这些向量, 因此不必频繁重写整个矩阵。
+SAVE_MIN_CHANGES = 1000
+SAVE_CHANGE_RATIO = 0.1
+SNAPSHOT_TOKEN_BYTES = 8
+
+
+def _matrix_token(matrix: np.ndarray) -> int:
+    """快照矩阵最后一行前 8 个字节中的快照标记"""
+    return int(np.ascontiguousarray(matrix[-1]).view(np.uint8)[:SNAPSHOT_TOKEN_BYTES].view(np.int64)[0])
+
+
+class EmbeddingStore:
+    """
+    线程安全的向量存储。前 count 行始终连续有效, 删除时用最后一行填补空位。
+    load() 在后台执行期间的写入先记录下来, 加载完成后按顺序重放, ready 之前读取方应退回数据库。
+    """
+
+    def __init__(self, dim: int, path: str, dtype: str = "float32", name: str = "向量存储"):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"不支持的存储类型: {dtype}")
+        self.dim = dim
+        self.path = path
+        self.name = name
+        self.dtype = np.dtype(STORE_DTYPES[dtype])
+        self.matrix = np.empty((0, dim), dtype=self.dtype)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.count = 0
+        self.row_of = {} # {id: 行号}
+        self.lock = threading.RLock()
+        self.ready = False
+        self.pending = None # 加载期间的变更: [("upsert"|"remove", ids, vectors)]
+        self.mapped = False # 矩阵是否仍是快照文件的 mmap 映射
+        self.changes_since_save = 0
+        self.load_seconds = None
+        self.last_error = None
+
+    @property
+    def ids_path(self) -> str:
+        return os.path.splitext(self.path)[0] + "_ids.npy"
+
+    def __len__(self):
+        return self.count
+
+    # --- 底层操作 (调用方需持有 self.lock) ---
+    def _install(self, matrix: np.ndarray, ids: np.ndarray, mapped: bool):
+        self.matrix = matrix
+        self.ids = np.array(ids, dtype=np.int64)
+        self.count = len(ids)
+        self.row_of = dict(zip(self.ids.tolist(), range(self.count)))
+        self.mapped = mapped
+
+    def _reserve(self, extra: int):
+        # 写时复制的 mmap 矩阵可以原地修改, 只有扩容时才需要整体复制到内存
+        needed = self.count + extra
+        if needed <= len(self.matrix):
+            return
+        capacity = max(INITIAL_CAPACITY, int(needed * GROWTH_FACTOR))
+        matrix = np.empty((capacity, self.dim), dtype=self.dtype)
+        matrix[:self.count] = self.matrix[:self.count]
+        ids = np.empty(capacity, dtype=np.int64)
+        ids[:self.count] = self.ids[:self.count]
+        self.matrix, self.ids, self.mapped = matrix, ids, False
+
+    def _upsert(self, vectors: np.ndarray, ids: np.ndarray):
+        # 重复的ID以最后一个为准
+        latest = dict(zip(ids.tolist(), range(len(ids))))
+        new_ids = [vector_id for vector_id in latest if vector_id not in self.row_of]
+        self._reserve(len(new_ids))
+        for vector_id in new_ids:
+            self.row_of[vector_id] = self.count
+            self.ids[self.count] = vector_id
+            self.count += 1
+        rows = np.fromiter((self.row_of[vector_id] for vector_id in latest), dtype=np.int64, count=len(latest))
+        self.matrix[rows] = vectors[np.fromiter(latest.values(), dtype=np.int64, count=len(latest))]
+        self.changes_since_save += len(latest)
+
+    def _remove(self, ids: np.ndarray) -> int:
+        removed = 0
+        for vector_id in ids.tolist():
+            row = self.row_of.pop(vector_id, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                self.matrix[row] = self.matrix[last]
+                self.ids[row] = self.ids[last]
+                self.row_of[int(self.ids[row])] = row
+            self.count -= 1
+            removed += 1
+        self.changes_since_save += removed
+        return removed
+
+    def _read_snapshot(self, mmap: bool):
+        """读取快照, 文件不存在或损坏时返回空矩阵"""
+        empty = (np.empty((0, self.dim), dtype=self.dtype), np.empty(0, dtype=np.int64), False)
+        if not (os.path.exists(self.path) and os.path.exists(self.ids_path)):
+            return empty
+        try:
+            matrix = np.load(self.path, mmap_mode="c" if mmap else None)
+            ids = np.load(self.ids_path)
+        except Exception as e:
+            logging.warning(f"[{self.name}] 读取快照失败, 将从数据库重建: {e}")
+            return empty
+        if matrix.ndim != 2 or matrix.shape != (len(ids), self.dim) or len(ids) == 0:
+            logging.warning(f"[{self.name}] 快照形状 {matrix.shape} 与ID数量 {len(ids)} / 维度 {self.dim} 不符, 将从数据库重建。")
+            return empty
+        if matrix.itemsize * self.dim < SNAPSHOT_TOKEN_BYTES or _matrix_token(matrix) != int(ids[-1]):
+            logging.warning(f"[{self.name}] 快照矩阵与ID文件的快照标记不一致 (保存时中断或旧版快照), 将从数据库重建。")
+            return empty
+        matrix, ids = matrix[:-1], ids[:-1]
+        if matrix.dtype != self.dtype:
+            # 存储类型设置变更后的第一次启动: 转换类型, 下一次保存时写入新格式
+            matrix = matrix.astype(self.dtype)
+            mmap = False
+            self.changes_since_save = len(ids)
+        return matrix, ids, mmap
+
+    # --- 公共接口 ---
+    def load(self, expected_ids_fn, fetch_fn, mmap: bool = True):
+        """
+        加载快照后与数据库核对: expected_ids_fn() 返回应当存在的ID (int64数组),
+        fetch_fn(ids) 返回 (找到的ID数组, float32矩阵)。快照中多余的ID被删除, 缺失的ID分批从数据库读取。
+        """
+        start_time = time.time()
+        with self.lock:
+            self.ready = False
+            self.pending = []
+            self.last_error = None
+        try:
+            matrix, ids, mapped = self._read_snapshot(mmap)
+            expected = np.unique(np.asarray(expected_ids_fn(), dtype=np.int64))
+            stale = ids[~np.isin(ids, expected)]
+            missing = expected[~np.isin(expected, ids)]
+            with self.lock:
+                self._install(matrix, ids, mapped)
+                if len(stale):
+                    self._remove(stale)
+            for start in range(0, len(missing), LOAD_CHUNK):
+                found_ids, vectors = fetch_fn(missing[start:start + LOAD_CHUNK])
+                if len(found_ids):
+                    with self.lock:
+                        self._upsert(np.asarray(vectors, dtype=self.dtype), np.asarray(found_ids, dtype=np.int64))
+            logging.info(f"[{self.name}] 快照中 {len(ids)} 个向量, 删除过期 {len(stale)} 个, 从数据库补齐 {len(missing)} 个。")
+        except Exception as e:
+            self.last_error = f"加载失败: {e}"
+            logging.error(f"[{self.name}] 加载失败: {e}", exc_info=True)
+        finally:
+            with self.lock:
+                for op, op_ids, vectors in self.pending:
+                    if op == "upsert":
+                        self._upsert(vectors, op_ids)
+                    else:
+                        self._remove(op_ids)
+                self.pending = None
+                self.ready = self.last_error is None
+                self.load_seconds = round(time.time() - start_time, 3)
+        logging.info(f"[{self.name}] 已加载 {self.count} 个向量 ({self.dtype.name}{', mmap' if self.mapped else ''}), "
+                     f"耗时 {self.load_seconds:.2f} 秒。")
+
+    def upsert(self, vectors: np.ndarray, ids):
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(-1, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(("upsert", ids, vectors))
+            else:
+                self._upsert(vectors, ids)
+
+    def remove(self, ids) -> int:
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(("remove", ids, None))
+                return 0
+            return self._remove(ids)
+
+    def get_vectors(self, ids):
+        """按ID取回向量, 返回 (找到的ID数组, float32矩阵), 与 faiss_utils 的 vector_loader 签名一致"""
+        with self.lock:
+            found = [(int(vector_id), self.row_of[int(vector_id)]) for vector_id in ids if int(vector_id) in self.row_of]
+            if not found:
+                return np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32)
+            rows = np.fromiter((row for _, row in found), dtype=np.int64, count=len(found))
+            return np.fromiter((vector_id for vector_id, _ in found), dtype=np.int64, count=len(found)), \
+                self.matrix[rows].astype(np.float32)
+
+    def needs_save(self) -> bool:
+        return self.changes_since_save >= max(SAVE_MIN_CHANGES, self.count * SAVE_CHANGE_RATIO)
+
+    def save(self, force: bool = False):
+        """变更积累足够多 (或 force=True) 时原子地重写快照 (先写临时文件再重命名)"""
+        with self.lock:
+            if not self.ready or (not force and not self.needs_save()):
+                return False
+            # 两个文件的最后一行/最后一个元素为同一个快照标记
+            token = np.frombuffer(os.urandom(SNAPSHOT_TOKEN_BYTES), dtype=np.int64)
+            matrix = np.zeros((self.count + 1, self.dim), dtype=self.dtype)
+            matrix[:self.count] = self.matrix[:self.count]
+            matrix[self.count].view(np.uint8)[:SNAPSHOT_TOKEN_BYTES] = token.view(np.uint8)
+            ids = np.append(self.ids[:self.count], token)
+            saved_changes = self.changes_since_save
+            self.changes_since_save = 0
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            for path, array in ((self.ids_path, ids), (self.path, matrix)):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, array)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            logging.info(f"[{self.name}] 快照已保存: {len(ids) - 1} 个向量 -> {self.path}")
+            return True
+        except Exception as e:
+            with self.lock:
+                self.changes_since_save += saved_changes
+            logging.error(f"[{self.name}] 保存快照失败: {e}")
+            return False
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "ready": self.ready,
+                "total_vectors": self.count,
+                "dtype": self.dtype.name,
+                "memory_mb": round(self.count * self.dim * self.dtype.itemsize / 1024 ** 2, 1),
+                "mmap": self.mapped,
+                "load_seconds": self.load_seconds,
+                "changes_since_save": self.changes_since_save,
+                "last_error": self.last_error,
+            }
@@ -3,6 +3,9 @@ import faiss
 import numpy as np
 import os
 import logging
+import threading
+import time
+import faiss_log_utils as flog
 
 FAISS_FACE_INDEX_PATH = os.path.join("data", "album_face_faiss.index")
 # 假设人脸识别模型输出512维特征向量，请根据您的模型实际输出进行修改。
@@ -10,10 +13,69 @@ FAISS_FACE_INDEX_PATH = os.path.join("data", "album_face_faiss.index")
 FACE_FEATURE_DIM = 512 
 
 faiss_face_index = None
+# 人脸索引的增量日志: 每次增删追加一条记录, 索引文件只作为检查点定期重写
+face_delta_log = None
+# lazy 加载时索引先以 mmap 只读方式打开, 后台读入可写索引并重放日志后置位。
+# mmap 只读索引不能修改, 所有写操作都要等待该事件
+face_index_ready = threading.Event()
+face_index_ready.set()
+# 跟随共享日志的线程与请求线程之间互斥地修改/检索索引
+face_index_lock = threading.RLock()
+# 串行化检查点 (写文件期间不持有 face_index_lock)
+face_save_lock = threading.Lock()
+# 多进程部署: 每个进程持有一份可写的人脸索引 (规模远小于图片索引), 通过共享增量日志同步其他进程的写入
+follower_mode = False
 
-def init_faiss_index():
+def set_follower_mode(enabled: bool = True):
+    """多进程共享人脸索引文件与增量日志时, 在 init_faiss_index 之前调用"""
+    global follower_mode
+    follower_mode = enabled
+    flog.enable_shared_logs()
+
+def _apply_logged(op: int, ids: np.ndarray, vectors: np.ndarray | None):
+    # 重放日志: 先删除再添加, 重复重放同一条记录结果不变
+    faiss_face_index.remove_ids(ids)
+    if op == flog.OP_ADD:
+        faiss_face_index.add_with_ids(vectors, ids)
+
+def _promote_face_index():
+    """后台完整读取人脸索引文件并重放增量日志, 然后替换 mmap 只读索引"""
     global faiss_face_index
+    start_time = time.time()
+    try:
+        faiss_face_index = faiss.read_index(FAISS_FACE_INDEX_PATH)
+        replayed = face_delta_log.replay(_apply_logged)
+        logging.info(f"人脸FAISS索引已在后台转为可写索引，耗时 {time.time() - start_time:.2f} 秒，"
+                     f"重放变更 {replayed} 条，向量数量: {faiss_face_index.ntotal}")
+    except Exception as e:
+        logging.error(f"后台加载人脸FAISS索引失败: {e}，创建空的备用索引。", exc_info=True)
+        faiss_face_index = faiss.IndexIDMap2(faiss.IndexFlatIP(FACE_FEATURE_DIM))
+    finally:
+        face_index_ready.set()
+
+def _wait_until_writable():
+    if not face_index_ready.is_set():
+        logging.info("[Face FAISS] 人脸索引仍在后台加载，等待加载完成...")
+        face_index_ready.wait()
+
+def init_faiss_index(lazy_load: bool = False):
+    global faiss_face_index, face_delta_log
+    start_time = time.time()
     os.makedirs(os.path.dirname(FAISS_FACE_INDEX_PATH), exist_ok=True)
+    face_delta_log = flog.DeltaLog(FAISS_FACE_INDEX_PATH + ".log", FACE_FEATURE_DIM, name="Face FAISS")
+    lazy_load = lazy_load and not follower_mode and os.path.exists(FAISS_FACE_INDEX_PATH) and getattr(faiss, "IO_FLAG_MMAP_IFC", None) is not None
+    if lazy_load:
+        try:
+            faiss_face_index = faiss.read_index(FAISS_FACE_INDEX_PATH, faiss.IO_FLAG_MMAP_IFC)
+            if faiss_face_index.d == FACE_FEATURE_DIM:
+                face_index_ready.clear()
+                threading.Thread(target=_promote_face_index, daemon=True).start()
+                logging.info(f"人脸FAISS索引已以 mmap 只读方式加载，耗时 {time.time() - start_time:.2f} 秒，可写索引在后台加载。")
+                return
+        except Exception as e:
+            logging.warning(f"以 mmap 方式加载人脸FAISS索引失败，改为完整读取: {e}")
+        faiss_face_index = None
+
     try:
         if os.path.exists(FAISS_FACE_INDEX_PATH):
             logging.info(f"正在从 {FAISS_FACE_INDEX_PATH} 加载人脸FAISS索引...")
@@ -37,7 +99,19 @@ def init_faiss_index():
         faiss_face_index = faiss.IndexIDMap2(quantizer)
         logging.info("已创建一个空的备用人脸FAISS索引。")
 
-def add_vector_to_index(vector: np.ndarray, vector_id: int):
+    try:
+        replayed = face_delta_log.replay(_apply_logged)
+        if replayed:
+            logging.info(f"人脸FAISS索引已从增量日志重放 {replayed} 条变更，当前向量数量: {faiss_face_index.ntotal}")
+    except Exception as e:
+        logging.error(f"重放人脸FAISS增量日志失败: {e}", exc_info=True)
+    logging.info(f"人脸FAISS索引初始化耗时 {time.time() - start_time:.2f} 秒。")
+
+def add_vectors(vectors: np.ndarray, ids):
+    """
+    批量添加人脸向量: vectors 为 (N, dim) 矩阵, ids 为长度 N 的 face_id 数组。一次写入索引、一条日志记录。
+    索引中已存在的 face_id 会被替换 (与日志重放一致), 重复写入同一人脸不会产生重复向量。
+    """
     global faiss_face_index
     if faiss_face_index is None:
         logging.debug("[Face FAISS] 索引未初始化，尝试重新初始化...")
@@ -46,20 +120,33 @@ def add_vector_to_index(vector: np.ndarray, vector_id: int):
     if faiss_face_index is None:
         logging.error("[Face FAISS] 索引未初始化。无法添加向量。")
         return False
+    _wait_until_writable()
+    ids_np = np.asarray(ids, dtype='int64').reshape(-1)
     try:
-        # 归一化向量
-        vector = vector / np.linalg.norm(vector)
-        if vector.ndim == 1:
-            vector = np.expand_dims(vector, axis=0) # (1, dim)
-        
-        vector_id_np = np.array([vector_id], dtype='int64')
-        faiss_face_index.add_with_ids(vector.astype(np.float32), vector_id_np)
-        logging.info(f"[Face FAISS] 人脸向量 (DB face_id: {vector_id}) 已添加到索引。当前大小: {faiss_face_index.ntotal}")
+        # 逐行归一化
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = np.expand_dims(vectors, axis=0) # (1, dim)
+        if vectors.shape[1] != FACE_FEATURE_DIM or len(vectors) != len(ids_np):
+            logging.error(f"[Face FAISS] 向量形状 {vectors.shape} 与ID数量 ({len(ids_np)}) 或期望维度 ({FACE_FEATURE_DIM}) 不符。")
+            return False
+        if len(ids_np) == 0:
+            return True
+        vectors = np.ascontiguousarray(vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+
+        with face_index_lock:
+            faiss_face_index.remove_ids(ids_np)
+            faiss_face_index.add_with_ids(vectors, ids_np)
+            face_delta_log.append(flog.OP_ADD, ids_np, vectors)
+        logging.info(f"[Face FAISS] {len(ids_np)} 个人脸向量已添加到索引。当前大小: {faiss_face_index.ntotal}")
         return True
     except Exception as e:
-        logging.error(f"[Face FAISS] 添加向量到索引失败 (ID: {vector_id}): {e}")
+        logging.error(f"[Face FAISS] 批量添加向量到索引失败 ({len(ids_np)} 个): {e}")
         return False
 
+def add_vector_to_index(vector: np.ndarray, vector_id: int):
+    return add_vectors(vector, [vector_id])
+
 def search_vectors_in_index(query_vector: np.ndarray, top_k: int = 5):
     global faiss_face_index
     if faiss_face_index is None:
@@ -69,6 +156,9 @@ def search_vectors_in_index(query_vector: np.ndarray, top_k: int = 5):
     if faiss_face_index is None or faiss_face_index.ntotal == 0:
         logging.debug("[Face FAISS] 索引未初始化或为空，这在首次使用时是正常的。")
         return [], []
+    if face_delta_log.has_records():
+        # 只读索引不包含日志中的变更, 此时的检索结果可能不准确
+        _wait_until_writable()
     try:
         # 归一化查询向量
         query_vector = query_vector / np.linalg.norm(query_vector)
@@ -79,19 +169,40 @@ def search_vectors_in_index(query_vector: np.ndarray, top_k: int = 5):
         if actual_top_k == 0: return [], []
 
         # distances是内积相似度, indices是对应的face_id
-        distances, indices = faiss_face_index.search(query_vector.astype(np.float32), actual_top_k)
+        with face_index_lock:
+            distances, indices = faiss_face_index.search(query_vector.astype(np.float32), actual_top_k)
         return distances[0].tolist(), indices[0].tolist()
     except Exception as e:
         logging.error(f"[Face FAISS] 搜索向量失败: {e}", exc_info=True)
         return [], []
 
-def save_faiss_index():
+def save_faiss_index(force: bool = False):
+    """
+    变更已实时写入增量日志, 只在日志积累过多或 force=True 时写入检查点 (原子地重写索引文件)。
+    持有索引锁时只在内存中序列化索引并记下日志位置, 写文件与 fsync 不阻塞检索和写入;
+    写完后日志中只保留该位置之后 (写检查点期间) 追加的记录。
+    """
     global faiss_face_index
-    if faiss_face_index is None:
+    if faiss_face_index is None or follower_mode:
+        # worker 进程的变更已在共享日志中, 检查点由维护进程统一写入
+        return
+    _wait_until_writable()
+    if not force and not face_delta_log.needs_checkpoint(faiss_face_index.ntotal):
         return
     try:
-        faiss.write_index(faiss_face_index, FAISS_FACE_INDEX_PATH)
-        logging.info(f"人脸FAISS索引已保存到 {FAISS_FACE_INDEX_PATH}")
+        with face_save_lock:
+            with face_index_lock, face_delta_log.exclusive():
+                # 共享日志中可能有其他进程刚追加的记录, 读入后检查点才包含日志中的全部变更
+                if face_delta_log.shared and not face_delta_log.follow(_apply_logged):
+                    logging.warning("[Face FAISS] 增量日志已被其他进程的检查点替换，跳过本次检查点。")
+                    return
+                data = faiss.serialize_index(faiss_face_index)
+                position = face_delta_log.position()
+            flog.write_index_bytes_atomic(data, FAISS_FACE_INDEX_PATH)
+            if not face_delta_log.compact(position):
+                # 重放是幂等的, 保留完整的日志只会让下次启动多重放一些记录
+                logging.warning("[Face FAISS] 写检查点期间增量日志已被替换，保留现有日志。")
+        logging.info(f"人脸FAISS索引检查点已保存到 {FAISS_FACE_INDEX_PATH}")
     except Exception as e:
         logging.error(f"保存人脸FAISS索引失败: {e}", exc_info=True)
 
@@ -99,17 +210,44 @@ def remove_vectors_from_index(face_ids: list[int]):
     global faiss_face_index
     if faiss_face_index is None or not face_ids:
         return 0
+    _wait_until_writable()
     try:
         ids_to_remove_np = np.array(face_ids, dtype=np.int64)
-        num_removed = faiss_face_index.remove_ids(ids_to_remove_np)
+        with face_index_lock:
+            num_removed = faiss_face_index.remove_ids(ids_to_remove_np)
+            if num_removed > 0:
+                # 删除只追加一条日志记录，不再重写整个索引文件
+                face_delta_log.append(flog.OP_REMOVE, ids_to_remove_np)
         logging.info(f"[Face FAISS] 从索引中移除了 {num_removed} 个向量。")
-        if num_removed > 0:
-            save_faiss_index()
         return num_removed
     except Exception as e:
         logging.error(f"[Face FAISS] 从索引移除向量时出错: {e}", exc_info=True)
         return 0
 
+def follow_index_log() -> bool:
+    """多进程共享日志: 应用其他进程追加的人脸向量变更, 日志被检查点替换时重新读取索引文件。返回索引是否发生变化。"""
+    global faiss_face_index
+    if faiss_face_index is None or face_delta_log is None or not face_index_ready.is_set():
+        return False
+    with face_index_lock:
+        records = face_delta_log.records
+        if face_delta_log.follow(_apply_logged):
+            return face_delta_log.records != records
+        logging.info("[Face FAISS] 增量日志已被其他进程的检查点替换，重新加载索引文件。")
+        with face_delta_log.exclusive():
+            if os.path.exists(FAISS_FACE_INDEX_PATH):
+                faiss_face_index = faiss.read_index(FAISS_FACE_INDEX_PATH)
+            else:
+                faiss_face_index = faiss.IndexIDMap2(faiss.IndexFlatIP(FACE_FEATURE_DIM))
+            face_delta_log.replay(_apply_logged)
+        return True
+
+def get_index_ids() -> np.ndarray:
+    """人脸索引中当前所有向量的 face_id (升序int64数组)"""
+    if faiss_face_index is None or faiss_face_index.ntotal == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.sort(faiss.vector_to_array(faiss_face_index.id_map))
+
 def get_face_index_status():
     """获取人脸FAISS索引的状态信息"""
     global faiss_face_index
@@ -117,6 +255,9 @@ def get_face_index_status():
         return {"initialized": False, "total_vectors": 0, "dimension": FACE_FEATURE_DIM}
     return {
         "initialized": True, 
+        "read_only": not face_index_ready.is_set(),
         "total_vectors": faiss_face_index.ntotal, 
-        "dimension": faiss_face_index.d
+        "dimension": faiss_face_index.d,
+        "log_records": face_delta_log.records if face_delta_log is not None else 0,
+        "log_bytes": face_delta_log.size if face_delta_log is not None else 0
     }
\ No newline at end of file
@@ -0,0 +1,329 @@
+# faiss_log_utils.py
+# FAISS 索引的增量日志 (write-ahead delta log) 与原子检查点。
+# 每次增删向量只在日志末尾追加一条记录 (O(1) 磁盘写入), 完整索引文件只在日志
+# 积累到一定大小时才作为检查点重写: 先写临时文件并 fsync, 再原子地重命名覆盖。
+# 检查点写入期间不阻塞读写: 先在内存中序列化索引并记下日志当前的位置, 写完索引文件后
+# 用只包含该位置之后记录 (写检查点期间追加的变更) 的新日志替换原日志。
+# 启动时加载最近的检查点并重放日志。重放按 "先删除再添加" 执行, 是幂等的,
+# 因此即使在写完检查点、清空日志之前崩溃, 重复重放旧日志也能得到正确的索引。
+# 多进程部署 (gunicorn 多个 worker) 时各进程共享同一份日志: 追加、读取与检查点用文件锁串行化,
+# 每个进程通过 follow() 读入其他进程追加的记录, 检查点替换日志文件后由调用方重新加载索引文件。
+import contextlib
+import faiss
+import numpy as np
+import os
+import logging
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError: # Windows 不支持 flock, 只能单进程使用日志
+    fcntl = None
+
+# 日志文件头: 魔数, 版本, 向量维度
+LOG_MAGIC = b"FDLG"
+LOG_VERSION = 1
+_HEADER = struct.Struct("<4sBI")
+# 记录头: 操作类型, ID数量, payload (ids + vectors) 的 CRC32
+_RECORD = struct.Struct("<BII")
+
+OP_ADD = 1
+OP_REMOVE = 2
+OP_NAMES = {OP_ADD: "add", OP_REMOVE: "remove"}
+
+# 每条记录写入后 fsync, 保证断电时已返回的变更不丢失
+LOG_FSYNC = True
+# 日志超过该大小, 或记录的向量数超过索引大小的 CHECKPOINT_LOG_RATIO 时, 下一次保存写入检查点
+CHECKPOINT_LOG_BYTES = 64 * 1024 * 1024
+CHECKPOINT_LOG_RATIO = 0.1
+# 由 enable_shared_logs() 置位, 之后创建的日志在多个进程之间共享
+SHARED_LOGS = False
+
+
+def enable_shared_logs():
+    """多进程共享索引文件与日志时, 在创建任何 DeltaLog 之前调用"""
+    global SHARED_LOGS
+    if fcntl is None:
+        logging.warning("当前平台不支持文件锁 (fcntl)，无法在多个进程之间共享FAISS增量日志。")
+        return
+    SHARED_LOGS = True
+
+
+def _fsync_file(path: str):
+    with open(path, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(directory: str):
+    # 重命名只有在目录项落盘后才算持久化; Windows 不支持打开目录, 直接跳过
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(directory or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_index_atomic(index, path: str):
+    """将索引写入临时文件并 fsync, 再原子地替换目标文件。写入过程中崩溃不会损坏已有的索引文件。"""
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    _fsync_file(tmp_path)
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def write_index_bytes_atomic(data: np.ndarray, path: str):
+    """将 faiss.serialize_index 得到的字节写入临时文件并 fsync, 再原子地替换目标文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(memoryview(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+class DeltaLog:
+    """追加写入的索引变更日志。记录格式: 记录头 + int64 ids (+ add 时的 float32 向量)。"""
+
+    def __init__(self, path: str, dim: int, name: str = "FAISS"):
+        self.path = path
+        self.dim = dim
+        self.name = name
+        self.file = None
+        self.records = 0 # 日志中的记录数
+        self.logged_vectors = 0 # 日志中记录涉及的向量数
+        self.lock = threading.Lock()
+        self.file_pid = None # 打开 self.file 的进程, fork 出的子进程需要重新打开
+
+        # 多进程共享: 文件锁 (可重入) 与本进程已读到的位置 (日志文件的 inode 与偏移)
+        self.shared = SHARED_LOGS
+        self.lock_path = path + ".lock"
+        self.lock_fd = None
+        self.lock_pid = None
+        self.lock_depth = 0
+        self.process_lock = threading.RLock()
+        self.follow_inode = None
+        self.follow_offset = 0
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """持有跨进程的日志文件锁 (非共享日志时只是空操作)。检查点在锁内读入日志并记下位置, 写完索引文件后在锁内替换日志。"""
+        if not self.shared:
+            yield
+            return
+        with self.process_lock:
+            if self.lock_depth == 0:
+                if self.lock_pid != os.getpid():
+                    # flock 属于打开的文件描述, fork 继承的描述符与父进程共用同一把锁, 必须重新打开
+                    self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    self.lock_pid = os.getpid()
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    # --- 文件操作 ---
+    def _create(self):
+        """以临时文件 + 重命名的方式创建只有文件头的空日志"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(LOG_MAGIC, LOG_VERSION, self.dim))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        _fsync_dir(os.path.dirname(self.path))
+
+    def _open(self):
+        if self.file is not None and (self.file_pid != os.getpid() or (self.shared and self._replaced())):
+            # 其他进程写入检查点后日志已被替换, 继续追加到旧文件的记录会丢失
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            if not os.path.exists(self.path):
+                self._create()
+            self.file = open(self.path, "ab")
+            self.file_pid = os.getpid()
+
+    def _replaced(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def close(self):
+        with self.exclusive(), self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    # --- 写入 ---
+    def append(self, op: int, ids: np.ndarray, vectors: np.ndarray | None = None):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        payload = ids.tobytes()
+        if op == OP_ADD:
+            payload += np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+        record = _RECORD.pack(op, len(ids), zlib.crc32(payload)) + payload
+        with self.exclusive(), self.lock:
+            self._open()
+            start = os.fstat(self.file.fileno()).st_size
+            self.file.write(record)
+            self.file.flush()
+            if LOG_FSYNC:
+                os.fsync(self.file.fileno())
+            self.records += 1
+            self.logged_vectors += len(ids)
+            if self.shared and start == self.follow_offset and os.fstat(self.file.fileno()).st_ino == self.follow_inode:
+                # 本进程已读到日志末尾: 自己的记录已经作用于索引, follow() 时跳过
+                self.follow_offset = start + len(record)
+
+    def position(self):
+        """当前日志文件的 (inode, 末尾偏移), 作为检查点覆盖到的位置; 调用方需保证期间没有新的追加"""
+        with self.exclusive(), self.lock:
+            if not os.path.exists(self.path):
+                self._create()
+            stat = os.stat(self.path)
+            return stat.st_ino, stat.st_size
+
+    def compact(self, position) -> bool:
+        """
+        检查点已包含 position (position() 的返回值) 之前的全部记录: 用只含其后记录的新日志原子地替换当前日志。
+        日志已被其他进程的检查点替换时不做修改, 返回 False。
+        """
+        inode, offset = position
+        with self.exclusive(), self.lock:
+            try:
+                if os.stat(self.path).st_ino != inode:
+                    return False
+            except FileNotFoundError:
+                return False
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(LOG_MAGIC, LOG_VERSION, self.dim))
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            _fsync_dir(os.path.dirname(self.path))
+            # 重新统计保留下来的记录 (写检查点期间追加的变更)
+            self.records = 0
+            self.logged_vectors = 0
+            self._apply_records(tail, 0, lambda op, ids, vectors: None)
+            followed = self.follow_offset - offset if self.follow_inode == inode else 0
+            self._mark_followed(_HEADER.size + max(0, followed))
+            return True
+
+    def has_records(self) -> bool:
+        """日志文件中是否有记录 (不必先重放)"""
+        return self.size > _HEADER.size
+
+    def needs_checkpoint(self, ntotal: int) -> bool:
+        if self.records == 0:
+            return False
+        return self.size >= CHECKPOINT_LOG_BYTES or self.logged_vectors > ntotal * CHECKPOINT_LOG_RATIO
+
+    # --- 重放 ---
+    def _mark_followed(self, offset: int):
+        """记录本进程已读到当前日志文件的 offset 处"""
+        self.follow_inode = os.stat(self.path).st_ino
+        self.follow_offset = offset
+
+    def _apply_records(self, data: bytes, offset: int, apply) -> int:
+        """从 offset 开始依次 apply 完整且校验通过的记录, 返回第一条无效记录 (或数据末尾) 的偏移"""
+        while offset < len(data):
+            if offset + _RECORD.size > len(data):
+                break
+            op, count, crc = _RECORD.unpack_from(data, offset)
+            if op not in OP_NAMES:
+                break
+            payload_size = count * 8 + (count * self.dim * 4 if op == OP_ADD else 0)
+            start = offset + _RECORD.size
+            payload = data[start:start + payload_size]
+            if len(payload) != payload_size or zlib.crc32(payload) != crc:
+                break
+            ids = np.frombuffer(payload, dtype=np.int64, count=count)
+            vectors = None
+            if op == OP_ADD:
+                vectors = np.frombuffer(payload, dtype=np.float32, offset=count * 8).reshape(count, self.dim)
+            apply(op, ids, vectors)
+            self.records += 1
+            self.logged_vectors += count
+            offset = start + payload_size
+        return offset
+
+    def replay(self, apply) -> int:
+        """
+        依次以 apply(op, ids, vectors) 重放日志中的记录, 返回重放的记录数。
+        末尾不完整或校验失败的记录 (写入时崩溃) 会被截断。
+        """
+        with self.exclusive(), self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.records = 0
+            self.logged_vectors = 0
+            if not os.path.exists(self.path):
+                self._create()
+
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if len(data) < _HEADER.size:
+                logging.warning(f"[{self.name}] 增量日志 {self.path} 文件头不完整，已重新创建。")
+                self._create()
+                self._mark_followed(_HEADER.size)
+                return 0
+            magic, version, dim = _HEADER.unpack_from(data, 0)
+            if magic != LOG_MAGIC or version != LOG_VERSION or dim != self.dim:
+                logging.error(f"[{self.name}] 增量日志 {self.path} 格式或维度 ({dim}) 不匹配，已备份为 .corrupt 并重新创建。")
+                os.replace(self.path, self.path + ".corrupt")
+                self._create()
+                self._mark_followed(_HEADER.size)
+                return 0
+
+            offset = self._apply_records(data, _HEADER.size, apply)
+            if offset < len(data):
+                logging.warning(f"[{self.name}] 增量日志末尾有 {len(data) - offset} 字节不完整的记录 (可能是写入时崩溃)，已截断。")
+                with open(self.path, "r+b") as f:
+                    f.truncate(offset)
+                    os.fsync(f.fileno())
+            self._mark_followed(offset)
+            return self.records
+
+    def follow(self, apply) -> bool:
+        """
+        多进程共享日志: 以 apply(op, ids, vectors) 依次应用其他进程在上次读取之后追加的记录。
+        返回 False 表示日志已被其他进程的检查点替换, 调用方应重新加载索引文件并 replay()。
+        """
+        with self.exclusive(), self.lock:
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return False
+            if stat.st_ino != self.follow_inode or stat.st_size < self.follow_offset:
+                return False
+            if stat.st_size == self.follow_offset:
+                return True
+            with open(self.path, "rb") as f:
+                f.seek(self.follow_offset)
+                data = f.read()
+            # 写入都在文件锁内完成, 这里不会读到写了一半的记录
+            self.follow_offset += self._apply_records(data, 0, apply)
+            return True
@@ -3,140 +3,1405 @@ import faiss
 import numpy as np
 import os
 import logging
+import threading
+import time
+import faiss_log_utils as flog
 
-FAISS_INDEX_PATH = os.path.join("data", "album_faiss.index")
+# 旧版本将 CLIP 与 BCE 向量拼接后存入同一个索引, 启动时会被自动拆分为下面两个索引
+LEGACY_FAISS_INDEX_PATH = os.path.join("data", "album_faiss.index")
+CLIP_FAISS_INDEX_PATH = os.path.join("data", "album_clip_faiss.index")
+BCE_FAISS_INDEX_PATH = os.path.join("data", "album_bce_faiss.index")
 # 假设Chinese-CLIP输出768维 (ViT-H-14), BCE输出512维
 # 您需要根据实际使用的CLIP模型调整这里的维度
 CLIP_EMBEDDING_DIM = 1024 # 请根据您的 Chinese-CLIP ViT-H-14 模型输出维度确认 (通常是768或1024)
 BCE_EMBEDDING_DIM = 768
 TOTAL_EMBEDDING_DIM = CLIP_EMBEDDING_DIM + BCE_EMBEDDING_DIM
 
-faiss_index = None
+# --- 索引自动扩展配置 ---
+# 根据索引中的向量数量选择索引类型: 小图库使用精确的 Flat 检索,
+# 超过 IVF_THRESHOLD 后迁移到 IVF-Flat, 超过 HNSW_THRESHOLD 后迁移到 HNSW。
+# 阈值设为 0 表示禁用对应的索引类型。
+INDEX_TIER_FLAT = "flat"
+INDEX_TIER_IVF = "ivf"
+INDEX_TIER_HNSW = "hnsw"
+INDEX_TIER_ORDER = [INDEX_TIER_FLAT, INDEX_TIER_IVF, INDEX_TIER_HNSW]
+
+IVF_THRESHOLD = 50000
+HNSW_THRESHOLD = 1000000
+# 向量数量回落到当前阈值的该比例以下才降级, 避免在阈值附近反复迁移
+TIER_DOWNGRADE_RATIO = 0.5
+
+# 检索参数 (可通过 set_search_params 在运行时调整)
+IVF_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+
+# HNSW 不支持物理删除: 被删除或更新的旧向量在 id_map 中标记为 -1 (墓碑), 检索时过滤;
+# 墓碑占比超过该值时在后台重建索引
+HNSW_TOMBSTONE_REBUILD_RATIO = 0.2
+# 构建新索引时每次添加的向量数量
+MIGRATION_ADD_CHUNK = 20000
+
+# --- 向量压缩存储 ---
+# float32: 原始精度; fp16: 半精度, 内存减半; sq8: 8bit 标量量化, 内存为原来的 1/4。
+# 压缩格式与索引层级正交, 对 Flat / IVF / HNSW 均适用, 修改后在后台迁移。
+STORAGE_FLOAT32 = "float32"
+STORAGE_FP16 = "fp16"
+STORAGE_SQ8 = "sq8"
+STORAGE_MODES = [STORAGE_FLOAT32, STORAGE_FP16, STORAGE_SQ8]
+STORAGE_BYTES_PER_DIM = {STORAGE_FLOAT32: 4, STORAGE_FP16: 2, STORAGE_SQ8: 1}
+STORAGE_CODECS = {STORAGE_FLOAT32: "Flat", STORAGE_FP16: "SQfp16", STORAGE_SQ8: "SQ8"}
+# SQ8 需要用已有向量训练每一维的取值范围, 向量数量不足时先以 float32 存储
+SQ8_MIN_TRAIN_VECTORS = 1000
+# 压缩存储时先取 top_k * RERANK_FACTOR 个候选, 再用全精度向量精确重排 (1 表示不重排)
+RERANK_FACTOR = 4
+RERANK_MAX_CANDIDATES = 2000
+# 压缩存储时范围检索以 threshold - RANGE_RERANK_MARGIN 取候选, 精确打分后再按 threshold 过滤, 避免近似误差漏掉边界结果
+RANGE_RERANK_MARGIN = 0.02
+
+# 带过滤条件的检索: 符合条件的ID不超过 FILTER_EXACT_MAX_IDS 个时直接取回向量精确计算,
+# 否则以 IDSelector 下推到 FAISS。IVF/HNSW 返回结果不足 top_k 时按倍数放大 nprobe/efSearch 重试。
+FILTER_EXACT_MAX_IDS = 4096
+FILTER_MAX_SEARCH_SCALE = 64
+
+# 索引名称: CLIP 索引保存所有有图像embedding的图片, BCE 索引只保存完成增强分析的图片
+CLIP_INDEX = "clip"
+BCE_INDEX = "bce"
+INDEX_DIMS = {CLIP_INDEX: CLIP_EMBEDDING_DIM, BCE_INDEX: BCE_EMBEDDING_DIM}
+INDEX_PATHS = {CLIP_INDEX: CLIP_FAISS_INDEX_PATH, BCE_INDEX: BCE_FAISS_INDEX_PATH}
+
+# 批量任务累积到 WRITE_BATCH_SIZE 个向量, 或距上次写入超过 WRITE_BATCH_MAX_DELAY 秒时一次性写入索引
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_MAX_DELAY = 5.0
+
+# 多路检索结果的融合方式
+FUSION_WEIGHTED = "weighted" # 加权相似度之和
+FUSION_RRF = "rrf" # Reciprocal Rank Fusion
+RRF_K = 60
+# 关键词检索 (描述/关键词/标签的全文索引) 在融合权重中的名称
+LEXICAL_SOURCE = "lexical"
+# 检索方式: fused 在每个索引中分别检索后融合; two_stage 只在CLIP索引中取候选, 再对候选计算BCE相似度等分数重排
+RETRIEVAL_FUSED = "fused"
+RETRIEVAL_TWO_STAGE = "two_stage"
+TWO_STAGE_CANDIDATES = 300
+
+indexes = {} # {索引名称: ManagedIndex}
+clip_index = None
+bce_index = None
 use_gpu = False # 在SOC设备上通常不使用GPU进行FAISS，除非有特定硬件支持
 # gpu_res = None # 如果要用GPU，取消注释
 
-def init_faiss_index():
-    global faiss_index #, gpu_res
-    os.makedirs(os.path.dirname(FAISS_INDEX_PATH), exist_ok=True)
-    try:
-        if os.path.exists(FAISS_INDEX_PATH):
-            logging.info(f"正在从 {FAISS_INDEX_PATH} 加载现有的FAISS索引...")
-            cpu_index = faiss.read_index(FAISS_INDEX_PATH)
-            if use_gpu:
-                # gpu_res = faiss.StandardGpuResources()
-                # faiss_index = faiss.index_cpu_to_gpu(gpu_res, 0, cpu_index)
-                pass # 当前禁用GPU
-            else:
-                faiss_index = cpu_index
-            logging.info(f"FAISS索引加载成功。索引中向量数量: {faiss_index.ntotal}, 维度: {faiss_index.d}")
-            if faiss_index.d != TOTAL_EMBEDDING_DIM:
-                logging.warning(f"警告: 加载的FAISS索引维度 ({faiss_index.d}) 与期望维度 ({TOTAL_EMBEDDING_DIM}) 不符! 可能需要重建索引。")
-                # 考虑是否在此处强制重建或抛出错误
-                faiss_index = None # 清除不匹配的索引
-        
-        if faiss_index is None: # 如果加载失败或文件不存在或维度不匹配
-            logging.info(f"未找到兼容的FAISS索引或需要重建。正在创建新的FAISS索引，维度: {TOTAL_EMBEDDING_DIM}")
+# 由 configure_index 设置, 在 init_faiss_index 创建索引时生效
+index_settings = {
+    "ivf_threshold": IVF_THRESHOLD,
+    "hnsw_threshold": HNSW_THRESHOLD,
+    "nprobe": IVF_NPROBE,
+    "ef_search": HNSW_EF_SEARCH,
+    "storage": STORAGE_FLOAT32,
+    "rerank_factor": RERANK_FACTOR,
+}
+# 以 mmap 方式零拷贝加载索引文件 (faiss >= 1.10), 旧版本 faiss 不支持时退回完整读取
+MMAP_IO_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+
+# 全精度向量来源 {索引名称: loader}, loader(ids) 返回 (找到的ID数组, float32矩阵)
+vector_loaders = {}
+# 与索引同步写入的常驻向量矩阵 {索引名称: embedding_store.EmbeddingStore}
+embedding_stores = {}
+# 索引版本号: 每次添加、更新、移除向量或修改检索参数时递增, 检索结果缓存以它判断缓存的排序结果是否过期
+index_version = 0
+index_version_lock = threading.Lock()
+# 多进程部署时的 HTTP worker 进程: 索引始终以 mmap 只读方式打开并跟随共享增量日志中其他进程的写入,
+# 不在本进程迁移索引或写检查点 (由持有可写索引的维护进程负责), 多个 worker 共享操作系统页缓存中的同一份索引文件
+follower_mode = False
+
+
+def detect_index_tier(index) -> str:
+    """根据FAISS索引对象的实际类型判断其所属的层级。"""
+    if isinstance(index, faiss.IndexIVF):
+        return INDEX_TIER_IVF
+    if isinstance(index, faiss.IndexIDMap2):
+        if isinstance(faiss.downcast_index(index.index), faiss.IndexHNSW):
+            return INDEX_TIER_HNSW
+    return INDEX_TIER_FLAT
+
+
+def detect_index_storage(index) -> str:
+    """根据FAISS索引对象判断其向量的存储格式。"""
+    base = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return STORAGE_FP16 if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else STORAGE_SQ8
+    return STORAGE_FLOAT32
+
+
+def _ivf_nlist_for(n: int) -> int:
+    # 经验值 4*sqrt(n), 同时保证每个聚类中心至少有 39 个训练样本
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+
+class ManagedIndex:
+    """
+    对单个FAISS索引的封装。根据向量数量自动在 Flat / IVF-Flat / HNSW 之间切换:
+    新索引在后台线程中利用已存储的向量训练和构建, 完成后原子地替换当前索引。
+    迁移期间的增删改照常作用于当前索引, 同时被记录下来, 切换前在新索引上重放。
+    向量以 fp16 / sq8 压缩存储时, 检索结果会用 vector_loader 取回的全精度向量精确重排。
+    每次变更追加到增量日志 (path + ".log"), 索引文件只作为检查点定期原子地重写。
+    lazy 加载时索引文件以 mmap 只读方式打开, 启动后即可检索; 日志中和之后的变更写入内存中的
+    overlay 索引并在只读索引中屏蔽旧ID, 后台读入可写索引并重放这些变更后再替换。
+    """
+
+    def __init__(self, dim: int, path: str, name: str = "FAISS"):
+        self.dim = dim
+        self.path = path
+        self.name = name
+        self.index = None
+        self.tier = INDEX_TIER_FLAT
+        self.index_storage = STORAGE_FLOAT32 # 当前索引实际的存储格式
+        self.tombstones = 0
+        self.lock = threading.RLock()
+        self.save_lock = threading.Lock() # 串行化检查点 (写文件期间不持有 self.lock)
+        self.vector_loader = None
+        self.log = flog.DeltaLog(path + ".log", dim, name) if path else None
+
+        self.ivf_threshold = index_settings["ivf_threshold"]
+        self.hnsw_threshold = index_settings["hnsw_threshold"]
+        self.nprobe = index_settings["nprobe"]
+        self.ef_search = index_settings["ef_search"]
+        self.storage = index_settings["storage"] # 配置的存储格式
+        self.rerank_factor = index_settings["rerank_factor"]
+
+        self.migration_thread = None
+        self.pending_ops = None # 迁移期间记录的变更: [("add"|"remove", ids, vectors)]
+
+        # mmap 只读阶段的状态 (只读索引不能修改, 否则 faiss 会直接终止进程)
+        self.read_only = False
+        self.overlay = None # 只读阶段新增的向量
+        self.masked = None # 只读阶段被删除或更新过的ID, 检索只读索引时过滤
+        self.base_ids = None # 只读索引中的ID (已排序)
+        self.masked_in_base = 0
+        self.load_seconds = None
+        self.promote_seconds = None
+        self.last_migration = None
+
+    # --- 索引构建 ---
+    def _new_index(self, tier: str, n_hint: int = 0, storage: str = STORAGE_FLOAT32):
+        codec = STORAGE_CODECS[storage]
+        if tier == INDEX_TIER_IVF:
+            # IVF 直接存储自定义ID; 哈希表 direct map 支持按ID删除与重建向量
+            index = faiss.index_factory(self.dim, f"IVF{_ivf_nlist_for(n_hint)},{codec}", faiss.METRIC_INNER_PRODUCT)
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif tier == INDEX_TIER_HNSW:
+            # HNSW 不支持 add_with_ids, 通过 IndexIDMap2 使用自定义ID
+            hnsw_key = f"HNSW{HNSW_M},Flat" if storage == STORAGE_FLOAT32 else f"HNSW{HNSW_M}_{codec}"
+            base = faiss.index_factory(self.dim, hnsw_key, faiss.METRIC_INNER_PRODUCT)
+            base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index = faiss.IndexIDMap2(base)
+        elif storage == STORAGE_FLOAT32:
             # 使用 IndexFlatIP (内积) 进行相似度搜索，因为CLIP和BCE向量通常已归一化
-            # IndexFlatL2 对应欧氏距离
-            cpu_quantizer = faiss.IndexFlatIP(TOTAL_EMBEDDING_DIM)
             # IndexIDMap2 允许我们使用自定义的ID
-            cpu_index = faiss.IndexIDMap2(cpu_quantizer)
-            if use_gpu:
-                # gpu_res = faiss.StandardGpuResources()
-                # faiss_index = faiss.index_cpu_to_gpu(gpu_res, 0, cpu_index)
-                pass # 当前禁用GPU
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        else:
+            index = faiss.IndexIDMap2(faiss.index_factory(self.dim, codec, faiss.METRIC_INNER_PRODUCT))
+        self._apply_search_params(index, tier)
+        return index
+
+    def _apply_search_params(self, index, tier: str):
+        if tier == INDEX_TIER_IVF:
+            index.nprobe = self.nprobe
+        elif tier == INDEX_TIER_HNSW:
+            faiss.downcast_index(index.index).hnsw.efSearch = self.ef_search
+
+    def _build(self, tier: str, storage: str, ids: np.ndarray, vectors: np.ndarray):
+        index = self._new_index(tier, len(ids), storage)
+        if not index.is_trained:
+            # IVF 训练聚类中心, SQ8 训练每一维的量化范围
+            n_train = min(len(ids), index.nlist * 256 if tier == INDEX_TIER_IVF else 100000)
+            sample = np.random.default_rng(0).choice(len(ids), n_train, replace=False)
+            index.train(vectors[np.sort(sample)])
+        for start in range(0, len(ids), MIGRATION_ADD_CHUNK):
+            end = start + MIGRATION_ADD_CHUNK
+            index.add_with_ids(vectors[start:end], ids[start:end])
+        return index
+
+    # --- 底层操作 (调用方需持有 self.lock) ---
+    def _live_ids(self, index=None) -> np.ndarray:
+        if index is None and self.read_only:
+            base_ids = self.base_ids[~np.isin(self.base_ids, np.fromiter(self.masked, dtype=np.int64))]
+            return np.concatenate([base_ids, faiss.vector_to_array(self.overlay.id_map)])
+        index = self.index if index is None else index
+        if index.ntotal == 0:
+            return np.empty(0, dtype=np.int64)
+        if isinstance(index, faiss.IndexIVF):
+            invlists = index.invlists
+            parts = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+                     for l in range(index.nlist) if invlists.list_size(l) > 0]
+            return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        ids = faiss.vector_to_array(index.id_map)
+        return ids[ids >= 0]
+
+    def _snapshot(self):
+        ids = self._live_ids()
+        if len(ids) == 0:
+            return ids, np.empty((0, self.dim), dtype=np.float32)
+        return ids, self.index.reconstruct_batch(ids)
+
+    def _load_full_vectors(self, ids: np.ndarray):
+        """通过 vector_loader 取回全精度向量, 返回 (找到的ID数组, 向量矩阵)。"""
+        empty = (np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=np.float32))
+        if self.vector_loader is None or len(ids) == 0:
+            return empty
+        try:
+            found_ids, vectors = self.vector_loader(ids)
+        except Exception as e:
+            logging.warning(f"[{self.name}] 读取全精度向量失败: {e}")
+            return empty
+        if len(found_ids) == 0 or vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            return empty
+        return np.asarray(found_ids, dtype=np.int64), np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def _rerank(self, query: np.ndarray, distances: np.ndarray, labels: np.ndarray, top_k: int):
+        """用全精度向量重新计算候选的相似度并截取 top_k, 取不到全精度向量的候选保留近似分数。"""
+        out_distances = np.full((len(query), top_k), -np.finfo(np.float32).max, dtype=np.float32)
+        out_labels = np.full((len(query), top_k), -1, dtype=np.int64)
+        found_ids, vectors = self._load_full_vectors(np.unique(labels[labels >= 0]))
+        rows_of = dict(zip(found_ids.tolist(), range(len(found_ids))))
+        for row in range(len(query)):
+            valid = labels[row] >= 0
+            candidates = labels[row][valid]
+            scores = distances[row][valid].copy()
+            rows = np.array([rows_of.get(vector_id, -1) for vector_id in candidates.tolist()], dtype=np.int64)
+            exact = rows >= 0
+            if exact.any():
+                scores[exact] = vectors[rows[exact]] @ query[row]
+            order = np.argsort(-scores, kind="stable")[:top_k]
+            out_distances[row, :len(order)] = scores[order]
+            out_labels[row, :len(order)] = candidates[order]
+        return out_distances, out_labels
+
+    @staticmethod
+    def _count_tombstones(index, tier: str) -> int:
+        if tier != INDEX_TIER_HNSW or index.ntotal == 0:
+            return 0
+        return int(np.count_nonzero(faiss.vector_to_array(index.id_map) < 0))
+
+    @staticmethod
+    def _raw_remove(index, tier: str, ids: np.ndarray) -> int:
+        if index.ntotal == 0:
+            return 0
+        if tier != INDEX_TIER_HNSW:
+            return index.remove_ids(ids)
+        # 在 id_map 上原地打墓碑, 并重建反向映射使 reconstruct 不再命中旧向量
+        id_map = faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+        mask = np.isin(id_map, ids)
+        removed = int(np.count_nonzero(mask))
+        if removed:
+            id_map[mask] = -1
+            index.construct_rev_map()
+        return removed
+
+    def _record(self, op: str, ids: np.ndarray, vectors: np.ndarray | None = None):
+        if self.log is not None:
+            self.log.append(flog.OP_ADD if op == "add" else flog.OP_REMOVE, ids, vectors)
+        if self.pending_ops is not None:
+            self.pending_ops.append((op, ids.copy(), None if vectors is None else vectors.copy()))
+
+    def _apply_logged(self, op: int, ids: np.ndarray, vectors: np.ndarray | None):
+        # 重放日志 (或跟随其他进程的写入): 先删除再添加, 重复重放同一条记录结果不变
+        op_name = "add" if op == flog.OP_ADD else "remove"
+        if self.read_only:
+            self._overlay_apply(op_name, ids, vectors)
+        else:
+            removed = self._raw_remove(self.index, self.tier, ids)
+            if self.tier == INDEX_TIER_HNSW:
+                self.tombstones += removed
+            if op == flog.OP_ADD:
+                self.index.add_with_ids(vectors, ids)
+        if self.pending_ops is not None:
+            # 只读阶段或迁移期间: 转为可写索引 / 切换到新索引时重放
+            self.pending_ops.append((op_name, ids.copy(), None if vectors is None else vectors.copy()))
+
+    def _replay_ops(self, index, tier: str, ops: list):
+        for op, op_ids, op_vectors in ops:
+            self._raw_remove(index, tier, op_ids)
+            if op == "add":
+                index.add_with_ids(op_vectors, op_ids)
+
+    # --- mmap 只读阶段 ---
+    def _overlay_apply(self, op: str, ids: np.ndarray, vectors: np.ndarray | None = None) -> int:
+        """只读阶段的增删: 在只读索引中屏蔽这些ID, 新向量写入 overlay。返回移除的向量数。"""
+        new_ids = np.array([vector_id for vector_id in ids.tolist() if vector_id not in self.masked], dtype=np.int64)
+        removed = self.overlay.remove_ids(ids)
+        if len(new_ids):
+            self.masked.update(new_ids.tolist())
+            positions = np.searchsorted(self.base_ids, new_ids)
+            in_base = int(np.count_nonzero(self.base_ids[np.minimum(positions, len(self.base_ids) - 1)] == new_ids)) \
+                if len(self.base_ids) else 0
+            self.masked_in_base += in_base
+            removed += in_base
+        if op == "add":
+            self.overlay.add_with_ids(vectors, ids)
+        return removed
+
+    def _read_only_search(self, query: np.ndarray, top_k: int, allowed_ids: np.ndarray | None = None, scale: int = 1):
+        params = None
+        overlay_params = None
+        if allowed_ids is not None:
+            # 只读索引中被屏蔽的ID以 overlay 中的版本为准
+            base_allowed = allowed_ids[~np.isin(allowed_ids, np.fromiter(self.masked, dtype=np.int64))] if self.masked else allowed_ids
+            params = self._search_params(faiss.IDSelectorBatch(base_allowed), scale)
+            overlay_params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(allowed_ids))
+        else:
+            excluded = list(self.masked)
+            if self.tier == INDEX_TIER_HNSW and self.tombstones > 0:
+                excluded.append(-1)
+            if excluded:
+                params = self._search_params(faiss.IDSelectorNot(faiss.IDSelectorBatch(np.array(excluded, dtype=np.int64))))
+        distances, labels = self.index.search(query, top_k, params=params)
+        if self.overlay.ntotal == 0:
+            return distances, labels
+        overlay_distances, overlay_labels = self.overlay.search(query, top_k, params=overlay_params)
+        distances = np.hstack([distances, overlay_distances])
+        labels = np.hstack([labels, overlay_labels])
+        order = np.argsort(-distances, axis=1, kind="stable")[:, :top_k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    def _reconstruct(self, vector_id: int):
+        if self.read_only:
+            try:
+                return self.overlay.reconstruct(vector_id)
+            except RuntimeError:
+                if vector_id in self.masked:
+                    raise
+        return self.index.reconstruct(vector_id)
+
+    def _promote(self):
+        """后台完整读取索引文件, 重放只读阶段记录的变更后替换 mmap 只读索引"""
+        start_time = time.time()
+        try:
+            index = faiss.read_index(self.path)
+            self._apply_search_params(index, self.tier)
+            with self.lock:
+                replayed = len(self.pending_ops)
+                self._replay_ops(index, self.tier, self.pending_ops)
+                self.index = index
+                self.tombstones = self._count_tombstones(index, self.tier)
+                self.read_only = False
+                self.overlay = None
+                self.masked = None
+                self.base_ids = None
+                self.masked_in_base = 0
+                self.pending_ops = None
+                self.promote_seconds = round(time.time() - start_time, 2)
+                logging.info(f"[{self.name}] 已在后台转为可写索引，耗时 {self.promote_seconds} 秒，重放变更 {replayed} 条，向量数量: {self.ntotal}")
+                self._maybe_migrate()
+        except Exception as e:
+            # 保持只读状态继续服务, 变更仍写入 overlay 和增量日志, 下次启动时重放
+            logging.error(f"[{self.name}] 后台加载可写索引失败，继续以只读索引 + overlay 提供服务: {e}", exc_info=True)
+
+    # --- 对外接口 ---
+    @property
+    def ntotal(self) -> int:
+        if self.index is None:
+            return 0
+        if self.read_only:
+            return len(self.base_ids) - self.masked_in_base + self.overlay.ntotal
+        return self.index.ntotal - self.tombstones
+
+    def load_or_create(self, lazy: bool = False):
+        """加载索引并重放增量日志。lazy=True 时以 mmap 只读方式打开索引文件, 在后台转为可写索引。"""
+        start_time = time.time()
+        with self.lock:
+            self.index = None
+            self.read_only = False
+            self.overlay = None
+            self.masked = None
+            self.base_ids = None
+            self.masked_in_base = 0
+            self.pending_ops = None
+            lazy = (lazy or follower_mode) and MMAP_IO_FLAG is not None
+            if os.path.exists(self.path):
+                logging.info(f"正在从 {self.path} 加载现有的{self.name}索引{' (mmap)' if lazy else ''}...")
+                index = faiss.read_index(self.path, MMAP_IO_FLAG) if lazy else faiss.read_index(self.path)
+                if index.d != self.dim:
+                    logging.warning(f"警告: 加载的{self.name}索引维度 ({index.d}) 与期望维度 ({self.dim}) 不符! 可能需要重建索引。")
+                else:
+                    self.tier = detect_index_tier(index)
+                    self.index_storage = detect_index_storage(index)
+                    self.tombstones = self._count_tombstones(index, self.tier)
+                    self._apply_search_params(index, self.tier)
+                    self.index = index
+                    if lazy:
+                        self.read_only = True
+                        self.overlay = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+                        self.masked = set()
+                        self.base_ids = np.sort(self._live_ids(index))
+                        self.masked_in_base = 0
+                        # 只读阶段的所有变更 (包括日志重放) 都记录下来, 转为可写索引时重放;
+                        # worker 进程始终保持只读, 不需要记录
+                        self.pending_ops = None if follower_mode else []
+                    logging.info(f"{self.name}索引加载成功。类型: {self.tier}, 存储格式: {self.index_storage}, 向量数量: {self.ntotal}, 维度: {index.d}")
+
+            if self.index is None:
+                logging.info(f"正在创建新的{self.name}索引，维度: {self.dim}")
+                self.tier = INDEX_TIER_FLAT
+                self.index_storage = self._target_storage(0)
+                self.tombstones = 0
+                self.index = self._new_index(INDEX_TIER_FLAT, storage=self.index_storage)
+
+            if self.log is not None:
+                replayed = self.log.replay(self._apply_logged)
+                if replayed:
+                    logging.info(f"{self.name}已从增量日志重放 {replayed} 条变更，当前向量数量: {self.ntotal}")
+            self.load_seconds = round(time.time() - start_time, 2)
+            if self.read_only and not follower_mode:
+                threading.Thread(target=self._promote, daemon=True).start()
             else:
-                faiss_index = cpu_index
-            logging.info("新的FAISS索引创建成功。")
+                self._maybe_migrate()
 
-    except Exception as e:
-        logging.error(f"初始化或加载FAISS索引失败: {e}")
-        # 创建一个空的备用索引
-        cpu_quantizer = faiss.IndexFlatIP(TOTAL_EMBEDDING_DIM)
-        faiss_index = faiss.IndexIDMap2(cpu_quantizer)
-        logging.info("已创建一个空的备用FAISS索引。")
+    def follow(self) -> bool:
+        """
+        多进程共享日志: 应用其他进程追加的变更。日志已被检查点替换时重新加载索引文件
+        (worker 进程据此丢弃 overlay, 改为 mmap 新的检查点)。返回索引是否发生变化。
+        """
+        with self.lock:
+            if self.log is None or self.index is None:
+                return False
+            records = self.log.records
+            if self.log.follow(self._apply_logged):
+                return self.log.records != records
+            logging.info(f"[{self.name}] 增量日志已被其他进程的检查点替换，重新加载索引文件。")
+            self.load_or_create(lazy=follower_mode)
+            return True
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        with self.lock:
+            if self.read_only:
+                self._overlay_apply("add", ids, vectors)
+            else:
+                self.index.add_with_ids(vectors, ids)
+            self._record("add", ids, vectors)
+            self._maybe_migrate()
+
+    def remove(self, ids: np.ndarray) -> int:
+        with self.lock:
+            if self.read_only:
+                removed = self._overlay_apply("remove", ids)
+            else:
+                removed = self._raw_remove(self.index, self.tier, ids)
+            if self.tier == INDEX_TIER_HNSW and not self.read_only:
+                self.tombstones += removed
+            self._record("remove", ids)
+            self._maybe_migrate()
+            return removed
+
+    def upsert(self, vectors: np.ndarray, ids: np.ndarray):
+        """批量更新: 一次删除所有旧向量再一次添加, 日志中只记录一条 add (重放时本身就是先删后加)"""
+        with self.lock:
+            if self.read_only:
+                self._overlay_apply("add", ids, vectors)
+            else:
+                removed = self._raw_remove(self.index, self.tier, ids)
+                if self.tier == INDEX_TIER_HNSW:
+                    self.tombstones += removed
+                self.index.add_with_ids(vectors, ids)
+            self._record("add", ids, vectors)
+            self._maybe_migrate()
+
+    def _search_params(self, selector, scale: int = 1):
+        """带 IDSelector 的检索参数; scale 放大 IVF 的 nprobe / HNSW 的 efSearch"""
+        if self.tier == INDEX_TIER_IVF:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=min(self.nprobe * scale, self.index.nlist))
+        if self.tier == INDEX_TIER_HNSW:
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search * scale)
+        return faiss.SearchParameters(sel=selector)
+
+    def _raw_search(self, query: np.ndarray, top_k: int, allowed_ids: np.ndarray | None = None, scale: int = 1):
+        with self.lock:
+            if self.read_only:
+                return self._read_only_search(query, top_k, allowed_ids, scale)
+            params = None
+            if allowed_ids is not None:
+                # 允许的ID中不会有 -1, HNSW 的墓碑自然被排除
+                params = self._search_params(faiss.IDSelectorBatch(allowed_ids), scale)
+            elif self.tier == INDEX_TIER_HNSW and self.tombstones > 0:
+                not_tombstone = faiss.IDSelectorNot(faiss.IDSelectorBatch(np.array([-1], dtype=np.int64)))
+                params = self._search_params(not_tombstone)
+            return self.index.search(query, top_k, params=params)
+
+    def _filtered_exact_search(self, query: np.ndarray, top_k: int, allowed_ids: np.ndarray):
+        """符合条件的ID较少时, 取回这些向量 (压缩存储时为全精度向量) 直接计算内积"""
+        out_distances = np.full((len(query), top_k), -np.finfo(np.float32).max, dtype=np.float32)
+        out_labels = np.full((len(query), top_k), -1, dtype=np.int64)
+        vectors = self.get_vectors(allowed_ids.tolist())
+        if not vectors:
+            return out_distances, out_labels
+        ids = np.fromiter(vectors.keys(), dtype=np.int64, count=len(vectors))
+        scores = query @ np.vstack(list(vectors.values())).astype(np.float32).T
+        for row in range(len(query)):
+            order = np.argsort(-scores[row], kind="stable")[:top_k]
+            out_distances[row, :len(order)] = scores[row][order]
+            out_labels[row, :len(order)] = ids[order]
+        return out_distances, out_labels
+
+    def _rerank_enabled(self) -> bool:
+        return self.index_storage != STORAGE_FLOAT32 and self.rerank_factor > 1 and self.vector_loader is not None
+
+    def search(self, query: np.ndarray, top_k: int, allowed_ids: np.ndarray | None = None):
+        """
+        检索 top_k 个最相似的向量。allowed_ids 不为 None 时只在这些ID中检索,
+        开销取决于过滤后的数量, 而不是先多取再逐个丢弃。
+        """
+        if allowed_ids is not None:
+            allowed_ids = np.unique(np.asarray(allowed_ids, dtype=np.int64))
+            if len(allowed_ids) <= FILTER_EXACT_MAX_IDS:
+                return self._filtered_exact_search(query, top_k, allowed_ids)
+        rerank = self._rerank_enabled()
+        fetch_k = max(top_k, min(top_k * self.rerank_factor, RERANK_MAX_CANDIDATES)) if rerank else top_k
+        scale = 1
+        while True:
+            distances, labels = self._raw_search(query, fetch_k, allowed_ids, scale)
+            if allowed_ids is None or self.tier == INDEX_TIER_FLAT or scale >= FILTER_MAX_SEARCH_SCALE:
+                break
+            # IVF 只检索 nprobe 个聚类、HNSW 只扩展 efSearch 个节点, 过滤条件较严时可能不足 top_k
+            if np.count_nonzero(labels >= 0, axis=1).min() >= min(top_k, len(allowed_ids)):
+                break
+            scale *= 4
+        if not rerank:
+            return distances, labels
+        # 全精度向量的读取不持有索引锁
+        return self._rerank(query, distances, labels, top_k)
+
+    def _raw_range_search(self, query: np.ndarray, threshold: float, allowed_ids: np.ndarray | None = None):
+        """在当前索引 (只读阶段为只读索引 + overlay) 中查找相似度大于 threshold 的向量, 返回未排序的 (distances, labels)"""
+        with self.lock:
+            if self.read_only:
+                if allowed_ids is not None:
+                    base_allowed = allowed_ids[~np.isin(allowed_ids, np.fromiter(self.masked, dtype=np.int64))] if self.masked else allowed_ids
+                    params = self._search_params(faiss.IDSelectorBatch(base_allowed))
+                    overlay_params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(allowed_ids))
+                else:
+                    excluded = np.fromiter(self.masked, dtype=np.int64) if self.masked else None
+                    params = self._search_params(faiss.IDSelectorNot(faiss.IDSelectorBatch(excluded))) if excluded is not None else None
+                    overlay_params = None
+                targets = [(self.index, params), (self.overlay, overlay_params)]
+            else:
+                params = self._search_params(faiss.IDSelectorBatch(allowed_ids)) if allowed_ids is not None else None
+                targets = [(self.index, params)]
+            distances = []
+            labels = []
+            for index, params in targets:
+                if index.ntotal == 0:
+                    continue
+                _, index_distances, index_labels = index.range_search(query, threshold, params=params)
+                distances.append(index_distances)
+                labels.append(index_labels)
+        if not labels:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        distances = np.concatenate(distances)
+        labels = np.concatenate(labels)
+        # HNSW 的墓碑ID为 -1
+        valid = labels >= 0
+        return distances[valid], labels[valid]
+
+    def range_search(self, query: np.ndarray, threshold: float, max_results: int | None = None,
+                     allowed_ids: np.ndarray | None = None):
+        """
+        返回与单个查询向量相似度大于 threshold 的所有向量 (按相似度降序, 最多 max_results 个)。
+        IVF 只检索 nprobe 个聚类, 结果是近似的; 压缩存储时候选用全精度向量精确打分后再按 threshold 过滤。
+        """
+        query = np.ascontiguousarray(query, dtype=np.float32).reshape(1, -1)
+        if allowed_ids is not None:
+            allowed_ids = np.unique(np.asarray(allowed_ids, dtype=np.int64))
+        rerank = self._rerank_enabled()
+        distances, labels = self._raw_range_search(query, threshold - RANGE_RERANK_MARGIN if rerank else threshold, allowed_ids)
+        if rerank and len(labels):
+            # 全精度向量的读取不持有索引锁
+            found_ids, vectors = self._load_full_vectors(labels)
+            exact = dict(zip(found_ids.tolist(), (vectors @ query[0]).tolist()))
+            distances = np.array([exact.get(label, distance) for label, distance in zip(labels.tolist(), distances.tolist())],
+                                 dtype=np.float32)
+            keep = distances > threshold
+            distances, labels = distances[keep], labels[keep]
+        order = np.argsort(-distances, kind="stable")
+        if max_results is not None:
+            order = order[:max_results]
+        return distances[order], labels[order]
+
+    def get_vectors(self, ids) -> dict:
+        """按ID取回向量 (压缩存储时优先取全精度向量), 不在索引中的ID会被跳过。返回 {id: vector}。"""
+        vectors = {}
+        if self.index_storage != STORAGE_FLOAT32:
+            found_ids, full_vectors = self._load_full_vectors(np.array(list(ids), dtype=np.int64))
+            vectors.update(zip(found_ids.tolist(), full_vectors))
+        with self.lock:
+            for vector_id in ids:
+                if int(vector_id) in vectors:
+                    continue
+                try:
+                    vectors[int(vector_id)] = self._reconstruct(int(vector_id))
+                except RuntimeError:
+                    continue
+        return vectors
+
+    def save(self):
+        """
+        写入检查点: 持有索引锁时只在内存中序列化索引并记下日志位置, 写文件与 fsync 不阻塞检索和写入;
+        写完索引文件后, 日志中只保留该位置之后 (写检查点期间) 追加的记录。
+        """
+        with self.save_lock:
+            with self.lock:
+                if self.read_only:
+                    # 只读阶段的变更只存在于 overlay 和日志中, 转为可写索引之前不能写检查点
+                    if not follower_mode:
+                        logging.info(f"[{self.name}] 索引仍在后台加载，跳过检查点，变更已保存在增量日志中。")
+                    return
+                if self.log is None:
+                    data = faiss.serialize_index(self.index)
+                    position = None
+                else:
+                    with self.log.exclusive():
+                        # 共享日志中可能有其他进程刚追加的记录, 读入后检查点才包含日志中的全部变更
+                        if self.log.shared and not self.log.follow(self._apply_logged):
+                            logging.warning(f"[{self.name}] 增量日志已被其他进程的检查点替换，跳过本次检查点。")
+                            return
+                        data = faiss.serialize_index(self.index)
+                        position = self.log.position()
+            flog.write_index_bytes_atomic(data, self.path)
+            if position is not None and not self.log.compact(position):
+                # 重放是幂等的, 保留完整的日志只会让下次启动多重放一些记录
+                logging.warning(f"[{self.name}] 写检查点期间增量日志已被替换，保留现有日志。")
+
+    def needs_checkpoint(self) -> bool:
+        with self.lock:
+            return self.log is not None and not self.read_only and self.log.needs_checkpoint(self.index.ntotal)
+
+    def set_search_params(self, nprobe: int | None = None, ef_search: int | None = None):
+        with self.lock:
+            if nprobe is not None:
+                self.nprobe = max(1, int(nprobe))
+            if ef_search is not None:
+                self.ef_search = max(1, int(ef_search))
+            if self.index is not None:
+                self._apply_search_params(self.index, self.tier)
+
+    def set_storage(self, storage: str | None = None, rerank_factor: int | None = None):
+        with self.lock:
+            if storage is not None:
+                if storage not in STORAGE_MODES:
+                    raise ValueError(f"不支持的向量存储格式: {storage}")
+                self.storage = storage
+            if rerank_factor is not None:
+                self.rerank_factor = max(1, int(rerank_factor))
+            if self.index is not None:
+                self._maybe_migrate()
+
+    def set_thresholds(self, ivf_threshold: int | None = None, hnsw_threshold: int | None = None):
+        with self.lock:
+            if ivf_threshold is not None:
+                self.ivf_threshold = max(0, int(ivf_threshold))
+            if hnsw_threshold is not None:
+                self.hnsw_threshold = max(0, int(hnsw_threshold))
+            if self.index is not None:
+                self._maybe_migrate()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "tier": self.tier,
+                "storage": self.index_storage,
+                "configured_storage": self.storage,
+                "rerank_factor": self.rerank_factor,
+                "rerank_enabled": self._rerank_enabled(),
+                "vector_bytes": self.index.ntotal * self.dim * STORAGE_BYTES_PER_DIM[self.index_storage],
+                "total_vectors": self.ntotal,
+                "tombstones": self.tombstones,
+                "dimension": self.dim,
+                "ivf_threshold": self.ivf_threshold,
+                "hnsw_threshold": self.hnsw_threshold,
+                "nprobe": self.nprobe,
+                "ef_search": self.ef_search,
+                "nlist": self.index.nlist if isinstance(self.index, faiss.IndexIVF) else None,
+                "log_records": self.log.records if self.log is not None else 0,
+                "log_bytes": self.log.size if self.log is not None else 0,
+                "read_only": self.read_only,
+                "load_seconds": self.load_seconds,
+                "promote_seconds": self.promote_seconds,
+                "migrating": self.pending_ops is not None and not self.read_only,
+                "last_migration": self.last_migration,
+            }
+
+    def compression_report(self, n_queries: int = 100, top_k: int = 10) -> dict:
+        """
+        估算当前存储格式的向量内存占用, 并以全精度向量的暴力检索为基准,
+        评估压缩索引在重排前后的 recall@top_k 和平均检索耗时。
+        """
+        with self.lock:
+            ids = self._live_ids()
+            storage = self.index_storage
+        n = len(ids)
+        report = {
+            "storage": storage,
+            "total_vectors": n,
+            "dimension": self.dim,
+            "float32_bytes": n * self.dim * STORAGE_BYTES_PER_DIM[STORAGE_FLOAT32],
+            "vector_bytes": n * self.dim * STORAGE_BYTES_PER_DIM[storage],
+            "rerank_factor": self.rerank_factor,
+        }
+        if n == 0:
+            return report
+        found_ids, full_vectors = self._load_full_vectors(ids)
+        if len(found_ids) == 0:
+            report["error"] = "没有可用的全精度向量，无法评估召回率"
+            return report
+
+        rng = np.random.default_rng(0)
+        queries = full_vectors[rng.choice(len(found_ids), min(n_queries, len(found_ids)), replace=False)]
+        k = min(top_k, len(found_ids))
+        # 分批计算精确的 top_k, 避免一次生成 (查询数 x 向量数) 的大矩阵
+        exact = []
+        for start in range(0, len(queries), 16):
+            scores = queries[start:start + 16] @ full_vectors.T
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            exact.extend(set(found_ids[row].tolist()) for row in top)
+
+        def _evaluate(search_fn):
+            start_time = time.time()
+            _, labels = search_fn(queries, k)
+            elapsed_ms = (time.time() - start_time) * 1000 / len(queries)
+            hits = sum(len(truth & set(row.tolist())) for truth, row in zip(exact, labels))
+            return round(hits / (len(queries) * k), 4), round(elapsed_ms, 3)
 
+        report["recall"], report["search_ms"] = _evaluate(self._raw_search)
+        if self._rerank_enabled():
+            report["recall_reranked"], report["search_ms_reranked"] = _evaluate(self.search)
+        report.update({"queries": len(queries), "top_k": k, "full_precision_vectors": len(found_ids)})
+        return report
 
-def add_vector_to_index(vector: np.ndarray, vector_id: int):
-    global faiss_index
-    if faiss_index is None:
-        logging.error("FAISS索引未初始化。无法添加向量。")
+    # --- 后台迁移 ---
+    def _target_tier(self, n: int) -> str:
+        target = INDEX_TIER_FLAT
+        if self.hnsw_threshold and n >= self.hnsw_threshold:
+            target = INDEX_TIER_HNSW
+        elif self.ivf_threshold and n >= self.ivf_threshold:
+            target = INDEX_TIER_IVF
+        if INDEX_TIER_ORDER.index(target) < INDEX_TIER_ORDER.index(self.tier):
+            current_threshold = self.hnsw_threshold if self.tier == INDEX_TIER_HNSW else self.ivf_threshold
+            if current_threshold and n >= current_threshold * TIER_DOWNGRADE_RATIO:
+                return self.tier
+        return target
+
+    def _target_storage(self, n: int) -> str:
+        # SQ8 训练样本不足时暂时保持 float32, 达到数量后再迁移
+        if self.storage == STORAGE_SQ8 and self.index_storage != STORAGE_SQ8 and n < SQ8_MIN_TRAIN_VECTORS:
+            return STORAGE_FLOAT32
+        return self.storage
+
+    def _maybe_migrate(self):
+        if follower_mode or self.pending_ops is not None:
+            return
+        target = self._target_tier(self.ntotal)
+        target_storage = self._target_storage(self.ntotal)
+        if target != self.tier:
+            self._start_migration(target, target_storage, f"向量数量 {self.ntotal} 触发 {self.tier} -> {target} 迁移")
+        elif target_storage != self.index_storage:
+            self._start_migration(target, target_storage, f"存储格式 {self.index_storage} -> {target_storage}")
+        elif self.tier == INDEX_TIER_HNSW and self.tombstones > self.index.ntotal * HNSW_TOMBSTONE_REBUILD_RATIO:
+            self._start_migration(target, target_storage, f"墓碑数量 {self.tombstones} 超过阈值，重建HNSW索引")
+
+    def _start_migration(self, target: str, target_storage: str, reason: str):
+        logging.info(f"[{self.name}] {reason}，开始后台构建新索引...")
+        self.pending_ops = []
+        self.migration_thread = threading.Thread(target=self._migrate, args=(target, target_storage), daemon=True)
+        self.migration_thread.start()
+
+    def _migrate(self, target: str, target_storage: str):
+        start_time = time.time()
+        source_tier = self.tier
+        source_storage = self.index_storage
+        try:
+            with self.lock:
+                ids, vectors = self._snapshot()
+            if source_storage != STORAGE_FLOAT32:
+                # 压缩存储中的向量是有损的, 尽量使用全精度向量重建, 避免每次迁移累积误差
+                found_ids, full_vectors = self._load_full_vectors(ids)
+                if len(found_ids):
+                    order = np.argsort(ids)
+                    positions = order[np.searchsorted(ids, found_ids, sorter=order)]
+                    vectors[positions] = full_vectors
+            new_index = self._build(target, target_storage, ids, vectors)
+
+            with self.lock:
+                # 重放构建期间发生的变更, 然后原子地切换到新索引
+                replayed = len(self.pending_ops)
+                self._replay_ops(new_index, target, self.pending_ops)
+                self.index = new_index
+                self.tier = target
+                self.index_storage = target_storage
+                self.tombstones = self._count_tombstones(new_index, target)
+                self.pending_ops = None
+                self.last_migration = {
+                    "from": source_tier,
+                    "to": target,
+                    "from_storage": source_storage,
+                    "to_storage": target_storage,
+                    "vectors": self.ntotal,
+                    "replayed_ops": replayed,
+                    "seconds": round(time.time() - start_time, 2),
+                    "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                bump_index_version()
+                logging.info(f"[{self.name}] 索引迁移完成: {self.last_migration}")
+            # 检查点 (写入并 fsync 整个新索引) 在索引锁之外写入, 期间检索与写入照常进行;
+            # 写入失败时新索引仍在使用, 变更都在增量日志中, 下一次保存时再写检查点
+            try:
+                self.save()
+            except Exception as e:
+                logging.error(f"[{self.name}] 迁移完成后写入检查点失败: {e}", exc_info=True)
+            with self.lock:
+                # 迁移期间配置可能已被修改, 检查是否需要继续迁移
+                self._maybe_migrate()
+        except Exception as e:
+            logging.error(f"[{self.name}] 后台索引迁移失败 ({source_tier}/{source_storage} -> {target}/{target_storage}): {e}", exc_info=True)
+            with self.lock:
+                self.pending_ops = None
+                self.last_migration = {"from": source_tier, "to": target, "from_storage": source_storage,
+                                       "to_storage": target_storage, "error": str(e)}
+        finally:
+            with self.lock:
+                if self.migration_thread is threading.current_thread():
+                    self.migration_thread = None
+
+
+def bump_index_version():
+    global index_version
+    with index_version_lock:
+        index_version += 1
+
+
+def get_index_version() -> int:
+    return index_version
+
+
+def configure_index(ivf_threshold: int | None = None, hnsw_threshold: int | None = None,
+                    nprobe: int | None = None, ef_search: int | None = None,
+                    storage: str | None = None, rerank_factor: int | None = None):
+    """更新索引自动扩展阈值、检索参数与存储格式 (作用于所有索引)。在 init_faiss_index 之前调用时作为初始值, 之后调用则立即生效。"""
+    if storage is not None and storage not in STORAGE_MODES:
+        raise ValueError(f"不支持的向量存储格式: {storage}")
+    for key, value in (("ivf_threshold", ivf_threshold), ("hnsw_threshold", hnsw_threshold),
+                       ("nprobe", nprobe), ("ef_search", ef_search), ("rerank_factor", rerank_factor)):
+        if value is not None:
+            index_settings[key] = int(value)
+    if storage is not None:
+        index_settings["storage"] = storage
+    for managed in indexes.values():
+        managed.set_thresholds(ivf_threshold, hnsw_threshold)
+        managed.set_search_params(nprobe, ef_search)
+        managed.set_storage(storage, rerank_factor)
+    bump_index_version()
+
+
+def set_follower_mode(enabled: bool = True):
+    """
+    多进程部署: 所有进程共享索引文件与增量日志, 在 init_faiss_index 之前调用。
+    enabled=True 的进程 (HTTP worker) 以 mmap 只读方式打开索引, 写入进入 overlay 与共享日志;
+    enabled=False 的进程 (维护进程) 持有可写索引, 负责迁移和写检查点。两者都需要定期调用 follow_index_logs。
+    """
+    global follower_mode
+    follower_mode = enabled
+    flog.enable_shared_logs()
+
+
+def follow_index_logs() -> bool:
+    """应用其他进程写入共享增量日志的变更, 有变化时递增索引版本号使检索缓存失效。返回是否有变化。"""
+    changed = False
+    for managed in list(indexes.values()):
+        try:
+            changed = managed.follow() or changed
+        except Exception as e:
+            logging.error(f"[{managed.name}] 跟随增量日志失败: {e}", exc_info=True)
+    if changed:
+        bump_index_version()
+    return changed
+
+
+def set_vector_loader(index_name: str, loader):
+    """
+    注册索引的全精度向量来源, 用于压缩存储时的精确重排和迁移重建。
+    loader(ids: np.ndarray) 返回 (找到的ID数组, float32矩阵)。应在 init_faiss_index 之前调用。
+    """
+    vector_loaders[index_name] = loader
+    if index_name in indexes:
+        indexes[index_name].vector_loader = loader
+
+
+def set_embedding_store(index_name: str, store):
+    """
+    注册与索引同步的向量存储: 之后通过 add_vectors / upsert_vectors / remove_vectors 成功写入索引的变更
+    都会同样写入 store, save_faiss_index 时一并保存其快照。
+    """
+    embedding_stores[index_name] = store
+
+
+def _split_legacy_index():
+    """将旧版 1792 维拼接索引拆分为 CLIP 索引和 BCE 索引 (BCE 部分为零向量的图片不写入 BCE 索引)。"""
+    logging.info(f"检测到旧版拼接FAISS索引 {LEGACY_FAISS_INDEX_PATH}，正在拆分为CLIP索引和BCE索引...")
+    legacy = ManagedIndex(TOTAL_EMBEDDING_DIM, LEGACY_FAISS_INDEX_PATH, name="旧版拼接FAISS")
+    legacy.index = faiss.read_index(LEGACY_FAISS_INDEX_PATH)
+    legacy.tier = detect_index_tier(legacy.index)
+    if legacy.index.d != TOTAL_EMBEDDING_DIM:
+        logging.warning(f"旧版FAISS索引维度 ({legacy.index.d}) 与期望维度 ({TOTAL_EMBEDDING_DIM}) 不符，跳过拆分。")
+        return
+    ids, vectors = legacy._snapshot()
+    if len(ids) > 0:
+        clip_vectors = np.ascontiguousarray(vectors[:, :CLIP_EMBEDDING_DIM])
+        bce_vectors = np.ascontiguousarray(vectors[:, CLIP_EMBEDDING_DIM:])
+        enhanced = np.linalg.norm(bce_vectors, axis=1) > 1e-6
+        clip_index.add(clip_vectors, ids)
+        if enhanced.any():
+            bce_index.add(bce_vectors[enhanced], ids[enhanced])
+    clip_index.save()
+    bce_index.save()
+    os.replace(LEGACY_FAISS_INDEX_PATH, LEGACY_FAISS_INDEX_PATH + ".bak")
+    logging.info(f"旧版索引拆分完成: CLIP向量 {clip_index.ntotal} 个, BCE向量 {bce_index.ntotal} 个。原文件已备份为 {LEGACY_FAISS_INDEX_PATH}.bak")
+
+
+def init_faiss_index(lazy_load: bool = False):
+    """
+    加载/创建 CLIP 索引和 BCE 索引。lazy_load=True 时以 mmap 只读方式打开索引文件,
+    几乎不占用启动时间, 热点数据由操作系统页缓存保留; 可写索引在后台加载完成后自动替换。
+    """
+    global clip_index, bce_index #, gpu_res
+    start_time = time.time()
+    os.makedirs(os.path.dirname(CLIP_FAISS_INDEX_PATH), exist_ok=True)
+    for index_name, dim in INDEX_DIMS.items():
+        managed = ManagedIndex(dim, INDEX_PATHS[index_name], name=f"{index_name.upper()} FAISS")
+        managed.vector_loader = vector_loaders.get(index_name)
+        try:
+            managed.load_or_create(lazy=lazy_load)
+            # if use_gpu:
+            #     gpu_res = faiss.StandardGpuResources()
+            #     managed.index = faiss.index_cpu_to_gpu(gpu_res, 0, managed.index)
+            logging.info(f"{managed.name}索引就绪。类型: {managed.tier}, 向量数量: {managed.ntotal}, 维度: {dim}")
+        except Exception as e:
+            logging.error(f"初始化或加载{managed.name}索引失败: {e}")
+            # 创建一个空的备用索引
+            managed.tier = INDEX_TIER_FLAT
+            managed.index_storage = STORAGE_FLOAT32
+            managed.tombstones = 0
+            managed.read_only = False
+            managed.pending_ops = None
+            managed.index = managed._new_index(INDEX_TIER_FLAT)
+            logging.info(f"已创建一个空的备用{managed.name}索引。")
+        indexes[index_name] = managed
+    clip_index = indexes[CLIP_INDEX]
+    bce_index = indexes[BCE_INDEX]
+
+    if os.path.exists(LEGACY_FAISS_INDEX_PATH) and clip_index.ntotal == 0 and bce_index.ntotal == 0:
+        try:
+            _split_legacy_index()
+        except Exception as e:
+            logging.error(f"拆分旧版FAISS索引失败: {e}", exc_info=True)
+
+    logging.info(f"FAISS索引初始化耗时 {time.time() - start_time:.2f} 秒"
+                 f"{' (mmap 只读加载，可写索引在后台加载)' if lazy_load and MMAP_IO_FLAG is not None else ''}。")
+
+
+def _get_index(index_name: str):
+    managed = indexes.get(index_name)
+    if managed is None:
+        logging.error(f"FAISS索引 '{index_name}' 未初始化。")
+    return managed
+
+
+def _as_batch(managed, vectors: np.ndarray, ids):
+    """整理为 (N, dim) float32 向量矩阵和 int64 ID 数组, 形状不符时抛出 ValueError"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = np.expand_dims(vectors, axis=0) # (1, dim)
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    if vectors.ndim != 2 or vectors.shape[1] != managed.dim:
+        raise ValueError(f"向量维度 ({vectors.shape[-1]}) 与{managed.name}索引期望维度 ({managed.dim}) 不符。")
+    if len(vectors) != len(ids):
+        raise ValueError(f"向量数量 ({len(vectors)}) 与ID数量 ({len(ids)}) 不一致。")
+    return np.ascontiguousarray(vectors), ids
+
+def add_vectors(vectors: np.ndarray, ids, index_name: str = CLIP_INDEX):
+    """批量添加向量: vectors 为 (N, dim) 矩阵, ids 为长度 N 的ID数组。"""
+    managed = _get_index(index_name)
+    if managed is None:
         return False
     try:
-        if vector.ndim == 1:
-            vector = np.expand_dims(vector, axis=0) # (1, dim)
-        if vector.shape[1] != TOTAL_EMBEDDING_DIM:
-            logging.error(f"向量维度 ({vector.shape[1]}) 与索引期望维度 ({TOTAL_EMBEDDING_DIM}) 不符。")
-            return False
-        
-        vector_id_np = np.array([vector_id], dtype='int64')
-        faiss_index.add_with_ids(vector.astype(np.float32), vector_id_np)
-        logging.info(f"向量 (ID: {vector_id}) 已添加到FAISS索引。当前索引大小: {faiss_index.ntotal}")
+        vectors, ids = _as_batch(managed, vectors, ids)
+        if len(ids) == 0:
+            return True
+        managed.add(vectors, ids)
+        logging.info(f"{len(ids)} 个向量已添加到{managed.name}索引。当前索引大小: {managed.ntotal}")
+        if index_name in embedding_stores:
+            embedding_stores[index_name].upsert(vectors, ids)
+        bump_index_version()
         return True
     except Exception as e:
-        logging.error(f"添加向量到FAISS索引失败 (ID: {vector_id}): {e}")
+        logging.error(f"批量添加向量到{managed.name}索引失败 ({len(ids)} 个): {e}")
         return False
 
-def update_vector_in_index(vector: np.ndarray, vector_id: int):
-    """更新索引中的向量。FAISS通常通过先删除再添加实现。"""
-    global faiss_index
-    if faiss_index is None:
-        logging.error("FAISS索引未初始化。无法更新向量。")
+def upsert_vectors(vectors: np.ndarray, ids, index_name: str = CLIP_INDEX):
+    """批量更新向量 (不存在的ID直接添加)。所有旧向量一次删除、新向量一次添加; 重复的ID以最后一个为准。"""
+    managed = _get_index(index_name)
+    if managed is None:
         return False
     try:
-        # 1. 删除旧向量 (如果存在)
-        faiss_index.remove_ids(np.array([vector_id], dtype='int64'))
-        logging.debug(f"从FAISS中移除了旧向量 (ID: {vector_id}) 以便更新。")
-        
-        # 2. 添加新向量
-        return add_vector_to_index(vector, vector_id)
+        vectors, ids = _as_batch(managed, vectors, ids)
+        if len(ids) == 0:
+            return True
+        _, last_positions = np.unique(ids[::-1], return_index=True)
+        if len(last_positions) != len(ids):
+            keep = np.sort(len(ids) - 1 - last_positions)
+            vectors, ids = vectors[keep], ids[keep]
+        managed.upsert(vectors, ids)
+        logging.info(f"{len(ids)} 个向量已更新到{managed.name}索引。当前索引大小: {managed.ntotal}")
+        if index_name in embedding_stores:
+            embedding_stores[index_name].upsert(vectors, ids)
+        bump_index_version()
+        return True
     except Exception as e:
-        logging.error(f"更新FAISS索引中的向量失败 (ID: {vector_id}): {e}")
+        logging.error(f"批量更新{managed.name}索引中的向量失败 ({len(ids)} 个): {e}")
         return False
 
+def remove_vectors(ids, index_names: tuple = (CLIP_INDEX, BCE_INDEX)):
+    """从指定的索引中批量移除向量 (默认同时从CLIP索引和BCE索引中移除)，返回移除的向量总数。"""
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    if len(ids) == 0:
+        return 0
+    total_removed = 0
+    for index_name in index_names:
+        managed = _get_index(index_name)
+        if managed is None:
+            continue
+        try:
+            num_removed = managed.remove(ids)
+            logging.info(f"从{managed.name}索引中移除了 {num_removed} 个向量。")
+            total_removed += num_removed
+            if index_name in embedding_stores:
+                embedding_stores[index_name].remove(ids)
+            if num_removed:
+                bump_index_version()
+        except Exception as e:
+            logging.error(f"从{managed.name}索引移除向量时出错: {e}")
+    return total_removed
+
+def add_vector_to_index(vector: np.ndarray, vector_id: int, index_name: str = CLIP_INDEX):
+    return add_vectors(vector, [vector_id], index_name)
+
+def update_vector_in_index(vector: np.ndarray, vector_id: int, index_name: str = CLIP_INDEX):
+    """更新索引中的向量 (不存在时直接添加)。"""
+    return upsert_vectors(vector, [vector_id], index_name)
+
+def remove_vectors_from_index(vector_ids: list[int], index_names: tuple = (CLIP_INDEX, BCE_INDEX)):
+    """从指定的索引中移除向量 (默认同时从CLIP索引和BCE索引中移除)，返回移除的向量总数。"""
+    return remove_vectors(vector_ids, index_names)
+
 
-def search_vectors_in_index(query_vector: np.ndarray, top_k: int = 10):
-    global faiss_index
-    if faiss_index is None or faiss_index.ntotal == 0:
-        logging.warning("FAISS索引未初始化或为空。")
+class VectorBatch:
+    """
+    批量写入缓冲: 批量任务逐个 append 向量, 累积到 batch_size 个或超过 max_delay 秒后由 flush 一次性写入。
+    默认 upsert 到 index_name 索引; flush_fn(vectors, ids) -> bool 可替换为其他索引的批量写入函数 (例如人脸索引)。
+    """
+
+    def __init__(self, index_name: str = CLIP_INDEX, flush_fn=None,
+                 batch_size: int = WRITE_BATCH_SIZE, max_delay: float = WRITE_BATCH_MAX_DELAY):
+        self.index_name = index_name
+        self.flush_fn = flush_fn or (lambda vectors, ids: upsert_vectors(vectors, ids, index_name))
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.vectors = []
+        self.ids = []
+        self.last_flush = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, vector: np.ndarray, vector_id: int):
+        self.vectors.append(np.asarray(vector, dtype=np.float32).reshape(-1))
+        self.ids.append(int(vector_id))
+
+    def discard(self, vector_ids):
+        """丢弃尚未写入的指定ID (对应的记录已回滚)"""
+        vector_ids = set(int(vector_id) for vector_id in vector_ids)
+        keep = [i for i, vector_id in enumerate(self.ids) if vector_id not in vector_ids]
+        self.vectors = [self.vectors[i] for i in keep]
+        self.ids = [self.ids[i] for i in keep]
+
+    def should_flush(self) -> bool:
+        return len(self.ids) >= self.batch_size or (len(self.ids) > 0 and time.time() - self.last_flush >= self.max_delay)
+
+    def best_match(self, query: np.ndarray):
+        """在尚未写入的向量中查找余弦相似度最高的一个, 返回 (相似度, ID), 缓冲为空时返回 (None, None)"""
+        if not self.ids:
+            return None, None
+        matrix = np.vstack(self.vectors)
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        sims = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(sims))
+        return float(sims[best]), self.ids[best]
+
+    def flush(self):
+        """写入缓冲中的全部向量, 返回 (写入的ID列表, 是否成功)"""
+        ids = self.ids
+        if not ids:
+            return [], True
+        vectors = np.vstack(self.vectors)
+        self.vectors = []
+        self.ids = []
+        self.last_flush = time.time()
+        return ids, bool(self.flush_fn(vectors, np.array(ids, dtype=np.int64)))
+
+
+def search_vectors_in_index(query_vector: np.ndarray, top_k: int = 10, index_name: str = CLIP_INDEX,
+                            allowed_ids=None):
+    """检索单个查询向量。allowed_ids 为符合过滤条件的ID (例如 db.get_faiss_ids_by_filters 的结果), None 表示不过滤。"""
+    return search_vectors_batch(np.asarray(query_vector).reshape(1, -1), top_k, index_name, allowed_ids)[0]
+
+
+def search_vectors_batch(query_matrix: np.ndarray, top_k: int = 10, index_name: str = CLIP_INDEX,
+                         allowed_ids=None) -> list:
+    """
+    一次检索 (N, d) 个查询向量: 整个矩阵只调用一次 index.search, 由 BLAS 以矩阵乘完成打分。
+    返回长度为 N 的列表, 每项为 (distances, ids), 与 search_vectors_in_index 的格式相同。
+    """
+    query_matrix = np.asarray(query_matrix, dtype=np.float32)
+    if query_matrix.ndim == 1:
+        query_matrix = np.expand_dims(query_matrix, axis=0)
+    empty = [([], []) for _ in range(len(query_matrix))]
+    managed = indexes.get(index_name)
+    if managed is None or managed.ntotal == 0:
+        logging.warning(f"FAISS索引 '{index_name}' 未初始化或为空。")
+        return empty
+    try:
+        actual_top_k = min(top_k, managed.ntotal)
+        if actual_top_k == 0: return empty
+
+        distances, indices = managed.search(np.ascontiguousarray(query_matrix), actual_top_k, allowed_ids)
+        results = []
+        for row in range(len(query_matrix)):
+            # IVF/HNSW 在候选不足时会以 -1 填充
+            valid = indices[row] >= 0
+            results.append((distances[row][valid].tolist(), indices[row][valid].tolist()))
+        return results
+    except Exception as e:
+        logging.error(f"在{managed.name}中搜索向量失败: {e}")
+        return empty
+
+
+def range_search_vectors(query_vector: np.ndarray, threshold: float, index_name: str = CLIP_INDEX,
+                         max_results: int | None = None, allowed_ids=None):
+    """检索与查询向量相似度大于 threshold 的所有向量, 返回 (distances, ids), 按相似度降序。"""
+    managed = indexes.get(index_name)
+    if managed is None or managed.ntotal == 0:
+        logging.warning(f"FAISS索引 '{index_name}' 未初始化或为空。")
         return [], []
     try:
-        if query_vector.ndim == 1:
-            query_vector = np.expand_dims(query_vector, axis=0)
-        
-        actual_top_k = min(top_k, faiss_index.ntotal)
-        if actual_top_k == 0: return [], []
-
-        distances, indices = faiss_index.search(query_vector.astype(np.float32), actual_top_k)
-        return distances[0].tolist(), indices[0].tolist() # 返回单个查询的结果
+        distances, ids = managed.range_search(query_vector, threshold, max_results, allowed_ids)
+        return distances.tolist(), ids.tolist()
     except Exception as e:
-        logging.error(f"在FAISS中搜索向量失败: {e}")
+        logging.error(f"在{managed.name}中范围检索失败: {e}")
+        return [], []
+
+
+def search_fused(query_vectors: dict, top_k: int = 10, weights: dict | None = None,
+                 method: str = FUSION_WEIGHTED, rrf_k: int = RRF_K, allowed_ids=None):
+    """
+    分别在多个索引中检索, 再将结果融合为一个排序列表。
+    query_vectors: {索引名称: 查询向量}; weights: {索引名称: 权重}, 默认均为 1.0。
+    - weighted: 分数为各索引相似度的加权和。候选只在部分索引中命中时, 其余索引的相似度
+      通过取回该图片存储的向量精确计算 (不在该索引中的图片记为 0), 与旧版拼接向量的内积一致。
+    - rrf: 分数为 sum(weight / (rrf_k + rank))。
+    allowed_ids 不为 None 时每个索引都只在这些ID中检索。
+    返回 (scores, ids), 与 search_vectors_in_index 相同的格式。
+    """
+    query_matrices = {index_name: np.asarray(query_vector).reshape(1, -1)
+                      for index_name, query_vector in query_vectors.items()}
+    return search_fused_batch(query_matrices, top_k, weights, method, rrf_k, allowed_ids)[0]
+
+
+def search_fused_batch(query_matrices: dict, top_k: int = 10, weights: dict | None = None,
+                       method: str = FUSION_WEIGHTED, rrf_k: int = RRF_K, allowed_ids=None) -> list:
+    """
+    search_fused 的多查询版本。query_matrices: {索引名称: (N, d) 查询矩阵}, 各矩阵的第 i 行属于同一个查询。
+    每个索引只检索一次; weighted 融合时各查询缺失的相似度合并为一次向量读取。
+    返回长度为 N 的列表, 每项为 (scores, ids)。
+    """
+    weights = weights or {}
+    query_matrices = {index_name: np.asarray(matrix, dtype=np.float32).reshape(len(matrix), -1)
+                      for index_name, matrix in query_matrices.items()}
+    num_queries = max((len(matrix) for matrix in query_matrices.values()), default=0)
+    hits = {} # {索引名称: [每个查询的 {id: 相似度}]}
+    for index_name, query_matrix in query_matrices.items():
+        if weights.get(index_name, 1.0) == 0:
+            continue
+        hits[index_name] = [dict(zip(ids, distances)) for distances, ids in
+                            search_vectors_batch(query_matrix, top_k, index_name, allowed_ids)]
+    if not hits:
+        return [([], []) for _ in range(num_queries)]
+
+    candidates = [set().union(*(index_hits[row] for index_hits in hits.values())) for row in range(num_queries)]
+    if method != FUSION_RRF:
+        for index_name, index_hits in hits.items():
+            missing = set()
+            for row in range(num_queries):
+                missing.update(vector_id for vector_id in candidates[row] if vector_id not in index_hits[row])
+            if not missing:
+                continue
+            stored = indexes[index_name].get_vectors(list(missing))
+            for row in range(num_queries):
+                query_vector = query_matrices[index_name][row]
+                for vector_id in candidates[row]:
+                    if vector_id not in index_hits[row] and vector_id in stored:
+                        index_hits[row][vector_id] = float(np.dot(stored[vector_id], query_vector))
+
+    results = []
+    for row in range(num_queries):
+        if method == FUSION_RRF:
+            results.append(fuse_ranked_lists({index_name: list(index_hits[row]) for index_name, index_hits in hits.items()},
+                                             weights, rrf_k, top_k))
+            continue
+        fused_scores = {}
+        for vector_id in candidates[row]:
+            fused_scores[vector_id] = sum(weights.get(index_name, 1.0) * index_hits[row].get(vector_id, 0.0)
+                                          for index_name, index_hits in hits.items())
+        ranked = sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        results.append(([score for _, score in ranked], [vector_id for vector_id, _ in ranked]))
+    return results
+
+
+def search_two_stage(query_vectors: dict, top_k: int = 10, weights: dict | None = None,
+                     num_candidates: int = TWO_STAGE_CANDIDATES, allowed_ids=None, extra_scores_fn=None):
+    """
+    两阶段检索: 先在CLIP索引中取 num_candidates 个候选 (不少于 top_k), 再只对这些候选取回其他索引中存储的向量,
+    以一次矩阵乘法计算相似度, 与 extra_scores_fn 提供的分数一起按权重加和重排。
+    只有CLIP候选会进入结果; 权重只作用于候选, 每次查询都可以不同。
+    extra_scores_fn(candidate_ids) 返回 {来源名称: 与候选对齐的分数数组}, 其权重同样取自 weights。
+    返回 (scores, ids), 与 search_fused 的格式相同。
+    """
+    weights = weights or {}
+    clip_scores, candidate_ids = search_vectors_in_index(query_vectors[CLIP_INDEX], max(num_candidates, top_k),
+                                                         CLIP_INDEX, allowed_ids)
+    if not candidate_ids:
         return [], []
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    scores = weights.get(CLIP_INDEX, 1.0) * np.asarray(clip_scores, dtype=np.float32)
+    for index_name, query_vector in query_vectors.items():
+        weight = weights.get(index_name, 1.0)
+        if index_name == CLIP_INDEX or weight == 0 or index_name not in indexes:
+            continue
+        stored = indexes[index_name].get_vectors(candidate_ids.tolist())
+        if not stored:
+            continue
+        # 不在该索引中的候选 (例如未增强的图片没有BCE向量) 相似度记为 0
+        positions = np.array([row for row, vector_id in enumerate(candidate_ids.tolist()) if vector_id in stored], dtype=np.int64)
+        matrix = np.stack([stored[vector_id] for vector_id in candidate_ids[positions].tolist()])
+        scores[positions] += weight * (matrix @ np.asarray(query_vector, dtype=np.float32).reshape(-1))
+    if extra_scores_fn is not None:
+        for source, extra_scores in extra_scores_fn(candidate_ids).items():
+            scores += weights.get(source, 1.0) * np.asarray(extra_scores, dtype=np.float32)
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return scores[order].tolist(), candidate_ids[order].tolist()
+
+
+def score_ids(query_vectors: dict, ids, weights: dict | None = None) -> list:
+    """
+    取回给定ID在各索引中存储的向量, 精确计算与查询的加权相似度之和 (与 weighted 融合的分数一致,
+    不在某个索引中的图片该项记为 0)。返回与 ids 对齐的分数列表。
+    """
+    weights = weights or {}
+    ids = [int(vector_id) for vector_id in ids]
+    scores = np.zeros(len(ids), dtype=np.float32)
+    for index_name, query_vector in query_vectors.items():
+        weight = weights.get(index_name, 1.0)
+        if weight == 0 or index_name not in indexes:
+            continue
+        stored = indexes[index_name].get_vectors(ids)
+        query_vector = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        for row, vector_id in enumerate(ids):
+            if vector_id in stored:
+                scores[row] += weight * float(np.dot(stored[vector_id], query_vector))
+    return scores.tolist()
 
-def save_faiss_index():
-    global faiss_index
-    if faiss_index is None:
+
+def fuse_ranked_lists(ranked_lists: dict, weights: dict | None = None, rrf_k: int = RRF_K, top_k: int | None = None):
+    """
+    Reciprocal Rank Fusion: ranked_lists 为 {来源名称: 按相关度降序的ID列表}, 分数为 sum(weight / (rrf_k + rank))。
+    返回 (scores, ids), 只取前 top_k 个 (None 表示全部)。
+    """
+    weights = weights or {}
+    fused_scores = {}
+    for source, ranked_ids in ranked_lists.items():
+        weight = weights.get(source, 1.0)
+        for rank, vector_id in enumerate(ranked_ids):
+            fused_scores[vector_id] = fused_scores.get(vector_id, 0.0) + weight / (rrf_k + rank + 1)
+    ranked = sorted(fused_scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [score for _, score in ranked], [vector_id for vector_id, _ in ranked]
+
+def set_search_params(nprobe: int | None = None, ef_search: int | None = None):
+    configure_index(nprobe=nprobe, ef_search=ef_search)
+
+def save_faiss_index(force: bool = False):
+    """
+    持久化索引。每次变更都已实时写入增量日志, 这里只在日志积累过多时写入检查点
+    (重写索引文件并清空日志); force=True 时总是写入检查点。
+    """
+    if not indexes:
         logging.error("FAISS索引未初始化。无法保存。")
         return
-    try:
-        if use_gpu:
-            # cpu_index = faiss.index_gpu_to_cpu(faiss_index)
-            pass # 当前禁用GPU
-        else:
-            cpu_index = faiss_index
-        faiss.write_index(cpu_index, FAISS_INDEX_PATH)
-        logging.info(f"FAISS索引已保存到 {FAISS_INDEX_PATH}")
-    except Exception as e:
-        logging.error(f"保存FAISS索引失败: {e}")
+    for managed in indexes.values():
+        try:
+            if not force and not managed.needs_checkpoint():
+                continue
+            # if use_gpu:
+            #     cpu_index = faiss.index_gpu_to_cpu(managed.index)
+            managed.save()
+            logging.info(f"{managed.name}索引检查点已保存到 {managed.path}")
+        except Exception as e:
+            logging.error(f"保存{managed.name}索引失败: {e}")
+    for store in embedding_stores.values():
+        store.save(force)
+
+def get_index_ids(index_name: str = CLIP_INDEX) -> np.ndarray:
+    """索引中当前所有向量的ID (升序int64数组, 不含 HNSW 的墓碑)"""
+    managed = indexes.get(index_name)
+    if managed is None or managed.index is None:
+        return np.empty(0, dtype=np.int64)
+    with managed.lock:
+        return np.sort(managed._live_ids())
 
-def get_faiss_index_ntotal():
-    if faiss_index:
-        return faiss_index.ntotal
+def get_faiss_index_ntotal(index_name: str = CLIP_INDEX):
+    managed = indexes.get(index_name)
+    if managed:
+        return managed.ntotal
     return 0
 
+def get_index_status():
+    """获取各FAISS索引的状态信息 (类型、数量、迁移进度和检索参数)"""
+    status = {}
+    for index_name, dim in INDEX_DIMS.items():
+        managed = indexes.get(index_name)
+        if managed is None:
+            status[index_name] = {"initialized": False, "total_vectors": 0, "dimension": dim}
+        else:
+            status[index_name] = {"initialized": True, **managed.status()}
+    return status
+
+def get_compression_report(index_name: str = CLIP_INDEX, n_queries: int = 100, top_k: int = 10):
+    """评估指定索引压缩存储的内存占用与召回率, 索引未初始化时返回 None"""
+    managed = indexes.get(index_name)
+    if managed is None:
+        return None
+    return managed.compression_report(n_queries, top_k)
 
 
 if __name__ == '__main__':
     # 初始化时加载/创建索引
     init_faiss_index()
-    print(f"FAISS索引初始化完毕。当前向量数: {get_faiss_index_ntotal()}, 维度: {TOTAL_EMBEDDING_DIM}")
\ No newline at end of file
+    print(f"FAISS索引初始化完毕。CLIP向量数: {get_faiss_index_ntotal(CLIP_INDEX)}, BCE向量数: {get_faiss_index_ntotal(BCE_INDEX)}")
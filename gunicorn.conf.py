@@ -0,0 +1,57 @@
+# gunicorn.conf.py
+# 多进程部署: 多个 HTTP worker 进程 + 一个集中推理进程 (inference_service.py, 唯一持有TPU, 同时负责索引检查点)。
+# worker 以 mmap 只读方式共享FAISS索引文件, 写入通过共享增量日志同步; CLIP/BCE 推理经本地 Unix 套接字发送给推理进程。
+# 用法 (在项目根目录执行):
+#   gunicorn -c gunicorn.conf.py wsgi:application
+#   SMART_ALBUM_WORKERS=8 SMART_ALBUM_ARGS="--dev_id 0 --bce_model ./models/BM1684X/xxx.bmodel" gunicorn -c gunicorn.conf.py wsgi:application
+# SMART_ALBUM_ARGS 与 app.py 的命令行参数相同 (模型路径、设备号), 同时传给推理进程。
+import multiprocessing
+import os
+import secrets
+import shlex
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+ALBUM_ARGS = shlex.split(os.environ.get("SMART_ALBUM_ARGS", ""))
+AUTHKEY_ENV = "SMART_ALBUM_INFERENCE_AUTHKEY"
+INFERENCE_STOP_TIMEOUT = 30
+
+chdir = PROJECT_DIR
+bind = os.environ.get("SMART_ALBUM_BIND", "0.0.0.0:18088")
+workers = int(os.environ.get("SMART_ALBUM_WORKERS", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("SMART_ALBUM_THREADS", 4))
+# 上传时同步调用 Qwen, 单个请求可能持续较长时间
+timeout = 300
+graceful_timeout = 30
+# 主进程加载一次应用 (初始化配置与数据库), worker fork 后共享已导入模块的内存
+preload_app = True
+
+inference_process = None
+
+
+def on_starting(server):
+    """在 fork worker 之前启动集中推理进程; 连接密钥经环境变量传给推理进程和之后 fork 的 worker"""
+    global inference_process
+    os.environ.setdefault(AUTHKEY_ENV, secrets.token_hex(16))
+    inference_process = subprocess.Popen([sys.executable, os.path.join(PROJECT_DIR, "inference_service.py"), *ALBUM_ARGS],
+                                         cwd=PROJECT_DIR)
+    server.log.info(f"集中推理进程已启动 (pid {inference_process.pid})")
+
+
+def post_fork(server, worker):
+    import app as album_app
+    album_app.init_worker(album_app.argsparser(ALBUM_ARGS))
+
+
+def on_exit(server):
+    if inference_process is None or inference_process.poll() is not None:
+        return
+    # 推理进程收到 SIGTERM 后退出; 可写索引的变更都已在增量日志中, 下次启动时重放
+    inference_process.terminate()
+    try:
+        inference_process.wait(INFERENCE_STOP_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        inference_process.kill()
+    server.log.info("集中推理进程已停止")
@@ -0,0 +1,62 @@
+# image_loader.py
+# 图片解码层: CLIP 推理只需要 letterbox 到 224 的输入, 缩略图只需要 256, 而手机照片通常有 12~48MP。
+# JPEG 可以在 DCT 域按 1/2、1/4、1/8 缩小解码, 这里为每次解码选择仍能覆盖目标尺寸 (最长边不小于 target) 的最小比例:
+# OpenCV 使用 IMREAD_REDUCED_COLOR_* (与 cv2.imread 一样按 EXIF 方向旋转), PIL 使用 Image.draft。
+# 其他格式 (PNG、WebP 等) 不支持缩小解码, 仍按原尺寸解码。
+import io
+import logging
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# 支持 DCT 缩小解码的 PIL 格式 (MPO 为部分相机的多图 JPEG)
+JPEG_FORMATS = ("JPEG", "MPO")
+REDUCED_COLOR_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def reduction_factor(size, target: int) -> int:
+    """size 为 (宽, 高); 返回缩小后最长边仍不小于 target 的最大比例 (1 表示原尺寸解码)"""
+    longest = max(size)
+    for factor, _ in REDUCED_COLOR_FLAGS:
+        if longest // factor >= target:
+            return factor
+    return 1
+
+
+def read_bgr(source, target: int | None = None) -> np.ndarray | None:
+    """
+    解码为 BGR 图像 (与 cv2.imread / cv2.imdecode 的 IMREAD_COLOR 相同), source 为文件路径或图片的字节数据。
+    指定 target 且为 JPEG 时按能覆盖 target 的最小比例解码; 无法解码时返回 None。
+    """
+    flag = cv2.IMREAD_COLOR
+    if target:
+        factor = 1
+        try:
+            # Image.open 只读取文件头, 用于判断格式和原图尺寸
+            with Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as header:
+                if header.format in JPEG_FORMATS:
+                    factor = reduction_factor(header.size, target)
+        except Exception as e:
+            logging.debug(f"读取图片头失败, 按原尺寸解码: {e}")
+        if factor > 1:
+            flag = dict(REDUCED_COLOR_FLAGS)[factor]
+    if isinstance(source, (bytes, bytearray)):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), flag) if source else None
+    return cv2.imread(source, flag)
+
+
+def open_pil(path: str, target_size=None) -> Image.Image:
+    """
+    打开图片 (PIL); 指定 target_size=(宽, 高) 且为 JPEG 时, 按缩小到 target_size 框内后
+    仍能覆盖该尺寸的最小比例解码 (Image.draft), 其他格式在 load 时按原尺寸解码。
+    """
+    img = Image.open(path)
+    if target_size and img.format in JPEG_FORMATS:
+        width, height = img.size
+        scale = min(target_size[0] / width, target_size[1] / height)
+        if scale < 1:
+            # 缩放后恰好放进 target_size 框内的尺寸, draft 选择不小于该尺寸的最小比例
+            requested = (max(1, int(np.ceil(width * scale))), max(1, int(np.ceil(height * scale))))
+            img.draft(None, requested)
+    return img
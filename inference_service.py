@@ -0,0 +1,402 @@
+# inference_service.py
+# 多进程部署时的集中推理进程: 唯一持有TPU (sail.Engine) 的进程, 通过本地 Unix 套接字为各 HTTP worker
+# 提供 CLIP 图像/文本编码和 BCE 文本编码。不同 worker 同时发来的同类请求合并成一批推理, TPU 访问始终串行。
+# 同时作为索引维护进程: 持有可写的 FAISS 索引, 跟随 worker 写入共享增量日志的变更, 负责迁移和写检查点。
+# worker 端使用 InferenceClient / RemoteCLIP / RemoteBCE, 接口与 clip.CLIP、BCEEmbedding 一致。
+# 用法 (通常由 gunicorn.conf.py 自动启动, 在项目根目录执行):
+#   SMART_ALBUM_INFERENCE_AUTHKEY=<密钥> python inference_service.py --dev_id 0
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import database_utils as db
+import faiss_face_utils as ffu
+import faiss_utils as fu
+
+DEFAULT_ADDRESS = os.path.join("data", "run", "inference.sock")
+# 连接认证密钥 (十六进制字符串) 由启动方生成, 通过环境变量传给推理进程和各 worker
+AUTHKEY_ENV = "SMART_ALBUM_INFERENCE_AUTHKEY"
+ADDRESS_ENV = "SMART_ALBUM_INFERENCE_ADDRESS"
+APP_CONFIG_FILE = os.path.join("data", "app_config.json")
+
+OP_CLIP_IMAGE = "clip_image"
+OP_CLIP_TEXT = "clip_text"
+OP_BCE = "bce"
+OP_INFO = "info"
+OP_STATUS = "status"
+BATCH_OPS = (OP_CLIP_IMAGE, OP_CLIP_TEXT, OP_BCE)
+
+# 收到第一个请求后最多再等待这么久, 把其他 worker 同时发来的请求合并进同一批
+BATCH_WAIT_SECONDS = 0.005
+# 一批合并的最大行数 (图片数 / 文本数), 单个请求超过该值时单独推理
+MAX_BATCH_ROWS = 64
+# 维护循环: 跟随共享日志、按需写检查点的间隔
+MAINTENANCE_INTERVAL_SECONDS = 1.0
+# worker 等待推理结果的超时时间
+CLIENT_TIMEOUT_SECONDS = 120
+
+
+class InferenceServiceError(RuntimeError):
+    """推理进程不可用或推理失败"""
+
+
+def add_model_arguments(parser: argparse.ArgumentParser):
+    # 每个模型可以指定同一网络不同 batch 大小的多个 bmodel (例如 _1b 与 _4b), 推理时按本次的数量选择最小的可容纳 graph
+    parser.add_argument('--image_model', type=str, nargs='+', default=['./models/BM1684X/cn_clip_image_vit_h_14_bm1684x_f16_1b.bmodel'], help='path(s) of image bmodel')
+    parser.add_argument('--text_model', type=str, nargs='+', default=['./models/BM1684X/cn_clip_text_vit_h_14_bm1684x_f16_1b.bmodel'], help='path(s) of text bmodel')
+    parser.add_argument('--bce_model', type=str, nargs='+', default=['./models/BM1684X/text2vec_base_chinese_bm1684x_f16_1b.bmodel'], help='path(s) of bce bmodel')
+    parser.add_argument('--dev_id', type=int, default=0, help='dev id')
+
+
+# --- 推理进程 ---
+clip_model = None
+bce_service = None
+model_info = {}
+request_queue = queue.Queue()
+
+service_status = {
+    "pid": None,
+    "start_time": None,
+    "clip_loaded": False,
+    "bce_loaded": False,
+    "connections": 0,
+    "requests": {op: 0 for op in BATCH_OPS},
+    "batches": {op: 0 for op in BATCH_OPS},
+    "rows": {op: 0 for op in BATCH_OPS},
+    "inference_seconds": {op: 0.0 for op in BATCH_OPS},
+    "queue_size": 0,
+    "last_checkpoint_time": None,
+    "last_error": None
+}
+service_status_lock = threading.Lock()
+
+
+class _PendingRequest:
+    def __init__(self, op: str, payload):
+        self.op = op
+        self.payload = payload
+        self.rows = len(payload)
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def load_models(args):
+    global clip_model, bce_service
+    import clip
+    import bce_embedding
+    try:
+        logging.info(f"[推理服务] 正在加载 Chinese-CLIP 模型: {args.image_model} (设备: {args.dev_id})")
+        clip_model, _ = clip.load(args.image_model, args.text_model, args.dev_id)
+        model_info.update({"image_resolution": int(clip_model.image_resolution), "embed_dim": int(clip_model.embed_dim)})
+    except Exception as e:
+        logging.error(f"[推理服务] 加载 Chinese-CLIP 模型失败: {e}", exc_info=True)
+        clip_model = None
+    try:
+        logging.info(f"[推理服务] 正在加载 BCE 模型: {args.bce_model} (设备: {args.dev_id})")
+        bce_service = bce_embedding.load(args.bce_model, args.dev_id)
+    except Exception as e:
+        logging.error(f"[推理服务] 加载 BCE 模型失败: {e}", exc_info=True)
+        bce_service = None
+    model_info.update({"clip_loaded": clip_model is not None, "bce_loaded": bce_service is not None})
+    with service_status_lock:
+        service_status["clip_loaded"] = clip_model is not None
+        service_status["bce_loaded"] = bce_service is not None
+
+
+def _run_batch(op: str, requests: list):
+    """对同一类请求整批推理, 结果按行数拆分回各个请求"""
+    start_time = time.time()
+    try:
+        if op == OP_BCE:
+            if bce_service is None:
+                raise InferenceServiceError("BCE模型未加载")
+            texts = [text for request in requests for text in request.payload]
+            outputs = bce_service.get_bce_embeddings(texts)
+        else:
+            if clip_model is None:
+                raise InferenceServiceError("CLIP模型未加载")
+            inputs = np.concatenate([request.payload for request in requests], axis=0)
+            outputs = clip_model.encode_image(inputs) if op == OP_CLIP_IMAGE else clip_model.encode_text(inputs)
+        offset = 0
+        for request in requests:
+            request.result = np.asarray(outputs[offset:offset + request.rows], dtype=np.float32)
+            offset += request.rows
+    except Exception as e:
+        logging.error(f"[推理服务] {op} 推理失败 ({len(requests)} 个请求): {e}", exc_info=True)
+        for request in requests:
+            request.error = str(e)
+        with service_status_lock:
+            service_status["last_error"] = f"{op}: {e}"
+    finally:
+        with service_status_lock:
+            service_status["batches"][op] += 1
+            service_status["rows"][op] += sum(request.rows for request in requests)
+            service_status["inference_seconds"][op] += time.time() - start_time
+        for request in requests:
+            request.done.set()
+
+
+def inference_loop():
+    """唯一访问TPU的线程: 取出第一个请求后短暂等待, 把队列中的请求按类型分组, 每组合并为一批推理"""
+    while True:
+        first = request_queue.get()
+        collected = [first]
+        rows = first.rows
+        deadline = time.time() + BATCH_WAIT_SECONDS
+        while rows < MAX_BATCH_ROWS:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            collected.append(request)
+            rows += request.rows
+        for op in BATCH_OPS:
+            group = [request for request in collected if request.op == op]
+            if group:
+                _run_batch(op, group)
+
+
+def _status_snapshot() -> dict:
+    with service_status_lock:
+        status = json.loads(json.dumps(service_status))
+    status["queue_size"] = request_queue.qsize()
+    status["uptime_seconds"] = round(time.time() - status["start_time"], 1) if status["start_time"] else None
+    status["batch_wait_ms"] = BATCH_WAIT_SECONDS * 1000
+    status["max_batch_rows"] = MAX_BATCH_ROWS
+    status["graphs"] = {**(clip_model.graph_stats() if clip_model is not None else {}),
+                        **(bce_service.graph_stats() if bce_service is not None else {})}
+    status["index_status"] = fu.get_index_status()
+    return status
+
+
+def handle_connection(conn):
+    """每个 worker 连接一个线程: 请求 (op, payload) 与响应 ("ok"|"error", result) 一一对应"""
+    with service_status_lock:
+        service_status["connections"] += 1
+    try:
+        while True:
+            try:
+                op, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            if op == OP_INFO:
+                conn.send(("ok", dict(model_info)))
+                continue
+            if op == OP_STATUS:
+                conn.send(("ok", _status_snapshot()))
+                continue
+            if op not in BATCH_OPS:
+                conn.send(("error", f"未知的请求类型: {op}"))
+                continue
+            request = _PendingRequest(op, payload)
+            with service_status_lock:
+                service_status["requests"][op] += 1
+            if request.rows == 0:
+                request.result = np.empty((0, 0), dtype=np.float32)
+            else:
+                request_queue.put(request)
+                request.done.wait()
+            conn.send(("error", request.error) if request.error else ("ok", request.result))
+    except Exception as e:
+        logging.warning(f"[推理服务] 连接处理出错: {e}")
+    finally:
+        conn.close()
+        with service_status_lock:
+            service_status["connections"] -= 1
+
+
+def apply_index_config(config_path: str):
+    """读取应用配置中的FAISS参数 (与 app.apply_faiss_index_config 相同的键), 迁移阈值和存储格式由维护进程执行"""
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except Exception as e:
+        logging.warning(f"[推理服务] 读取应用配置 {config_path} 失败: {e}")
+        return {}
+    fu.configure_index(
+        ivf_threshold=config.get("faiss_ivf_threshold"),
+        hnsw_threshold=config.get("faiss_hnsw_threshold"),
+        nprobe=config.get("faiss_nprobe"),
+        ef_search=config.get("faiss_ef_search"),
+        storage=config.get("faiss_storage"),
+        rerank_factor=config.get("faiss_rerank_factor")
+    )
+    return config
+
+
+def maintenance_loop(config_path: str):
+    """持有可写索引: 跟随各 worker 追加到共享日志的变更, 日志积累足够多时写检查点 (worker 随后重新 mmap 检查点)"""
+    fu.set_follower_mode(False)
+    ffu.set_follower_mode(False)
+    config = apply_index_config(config_path)
+    config_mtime = os.path.getmtime(config_path) if os.path.exists(config_path) else None
+    fu.set_vector_loader(fu.CLIP_INDEX, lambda ids: db.get_embeddings_by_faiss_ids(ids, "clip_embedding"))
+    fu.set_vector_loader(fu.BCE_INDEX, lambda ids: db.get_embeddings_by_faiss_ids(ids, "bce_embedding"))
+    fu.init_faiss_index(lazy_load=config.get("faiss_lazy_load", True))
+    ffu.init_faiss_index(lazy_load=config.get("faiss_lazy_load", True))
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            mtime = os.path.getmtime(config_path) if os.path.exists(config_path) else None
+            if mtime != config_mtime:
+                config_mtime = mtime
+                apply_index_config(config_path)
+            fu.follow_index_logs()
+            ffu.follow_index_log()
+            fu.save_faiss_index()
+            ffu.save_faiss_index()
+            with service_status_lock:
+                service_status["last_checkpoint_time"] = time.time()
+        except Exception as e:
+            logging.error(f"[推理服务] 索引维护出错: {e}", exc_info=True)
+            with service_status_lock:
+                service_status["last_error"] = f"索引维护: {e}"
+
+
+def serve(args):
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise SystemExit(f"未设置环境变量 {AUTHKEY_ENV}")
+    with service_status_lock:
+        service_status["pid"] = os.getpid()
+        service_status["start_time"] = time.time()
+    load_models(args)
+    threading.Thread(target=inference_loop, daemon=True).start()
+    threading.Thread(target=maintenance_loop, args=(args.config,), daemon=True).start()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.address)), exist_ok=True)
+    if os.path.exists(args.address):
+        os.remove(args.address)
+    listener = Listener(args.address, family="AF_UNIX", authkey=bytes.fromhex(authkey))
+    os.chmod(args.address, 0o600)
+    logging.info(f"[推理服务] 已在 {args.address} 上监听 (pid {os.getpid()})。")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # 认证失败等单个连接的错误不影响服务
+            logging.warning(f"[推理服务] 接受连接失败: {e}")
+            continue
+        threading.Thread(target=handle_connection, args=(conn,), daemon=True).start()
+
+
+# --- worker 端 ---
+class InferenceClient:
+    """
+    worker 进程中的连接池: 每个请求线程借用一条连接, 同一连接上的请求与响应一一对应。
+    推理进程重启导致连接断开时自动重连一次; 等待结果超时的连接直接关闭, 不再放回连接池。
+    """
+
+    def __init__(self, address: str, authkey: str, timeout: float = CLIENT_TIMEOUT_SECONDS):
+        self.address = address
+        self.authkey = bytes.fromhex(authkey)
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            return Client(self.address, family="AF_UNIX", authkey=self.authkey)
+        except Exception as e:
+            raise InferenceServiceError(f"无法连接推理服务 {self.address}: {e}") from e
+
+    def call(self, op: str, payload=None):
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.send((op, payload))
+                if not conn.poll(self.timeout):
+                    conn.close()
+                    raise InferenceServiceError(f"等待推理服务响应超时 ({self.timeout} 秒)")
+                status, result = conn.recv()
+            except (EOFError, OSError) as e:
+                conn.close()
+                if attempt == 0:
+                    continue
+                raise InferenceServiceError(f"推理服务连接断开: {e}") from e
+            with self.lock:
+                self.idle.append(conn)
+            if status != "ok":
+                raise InferenceServiceError(result)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class RemoteCLIP:
+    """与 clip.CLIP 相同的 encode_image / encode_text 接口, 推理在集中推理进程中执行 (预处理与分词在 worker 中完成)"""
+
+    def __init__(self, client: InferenceClient, info: dict):
+        self.client = client
+        self.image_resolution = info["image_resolution"]
+        self.embed_dim = info["embed_dim"]
+
+    def encode_image(self, image: np.ndarray):
+        return self.client.call(OP_CLIP_IMAGE, np.ascontiguousarray(image, dtype=np.float32))
+
+    def encode_text(self, text):
+        return self.client.call(OP_CLIP_TEXT, np.ascontiguousarray(text))
+
+
+class RemoteBCE:
+    """与 BCEEmbedding 相同的 get_bce_embedding / get_bce_embeddings 接口, 返回归一化向量"""
+
+    def __init__(self, client: InferenceClient):
+        self.client = client
+
+    def get_bce_embedding(self, text):
+        return self.client.call(OP_BCE, [text])[0]
+
+    def get_bce_embeddings(self, texts):
+        return self.client.call(OP_BCE, list(texts))
+
+
+def connect(address: str | None = None, authkey: str | None = None, timeout: float = CLIENT_TIMEOUT_SECONDS):
+    """
+    连接推理服务, 返回 (client, 模型信息)。推理进程启动时要先加载模型,
+    在 timeout 秒内每秒重试一次, 仍无法连接时抛出 InferenceServiceError。
+    """
+    address = address or os.environ.get(ADDRESS_ENV, DEFAULT_ADDRESS)
+    authkey = authkey or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise InferenceServiceError(f"未设置环境变量 {AUTHKEY_ENV}")
+    client = InferenceClient(address, authkey)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return client, client.call(OP_INFO)
+        except InferenceServiceError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(1)
+
+
+def argsparser():
+    parser = argparse.ArgumentParser(prog=__file__, description="智能相册集中推理进程 (TPU 推理 + 索引维护)")
+    add_model_arguments(parser)
+    parser.add_argument('--address', type=str, default=os.environ.get(ADDRESS_ENV, DEFAULT_ADDRESS), help='Unix 套接字路径')
+    parser.add_argument('--config', type=str, default=APP_CONFIG_FILE, help='应用配置文件 (读取FAISS参数)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s')
+    serve(argsparser())
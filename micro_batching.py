@@ -0,0 +1,147 @@
+# micro_batching.py
+# 请求合并调度器: 调用方逐张图片 / 逐条文本提交, 立即得到 Future;
+# 后台线程把等待中的请求凑成一批 (达到引擎的 batch 大小, 或最早的请求已等待 max_wait_ms) 后调用一次编码函数,
+# 再按提交顺序把每一行结果分发回对应的 Future。并发的上传和检索因此共用一次 sail.Engine.process。
+# 只依赖 numpy, 不导入 clip 包 (分词器、OpenCV、sophon), 可以在没有 TPU 的环境中单独测试。
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+DEFAULT_MAX_WAIT_MS = 5.0
+
+
+class MicroBatcher:
+    """
+    encode_fn(batch) 接收 (batch_size, ...) 的输入, 返回第一维与输入对应的输出。
+    pad_to_batch=True 时不足一批的输入补零到 batch_size (bmodel 的输入形状固定), 输出只保留有效的前 n 行。
+    """
+
+    def __init__(self, encode_fn, batch_size: int, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 pad_to_batch: bool = True, name: str = "批处理"):
+        self.encode_fn = encode_fn
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.pad_to_batch = pad_to_batch
+        self.name = name
+        self.pending = collections.deque() # (输入, Future, 提交时间)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        # 吞吐与延迟统计: 平均批大小越接近 batch_size 吞吐越高, 代价是等待凑批的排队时间
+        self.requests = 0
+        self.batches = 0
+        self.items = 0
+        self.padded_slots = 0
+        self.errors = 0
+        self.engine_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+
+    def submit(self, item) -> Future:
+        """提交单个输入 (不含 batch 维), 返回的 Future 结果为对应的一行输出"""
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError(f"[{self.name}] 调度器已关闭")
+            self.pending.append((np.asarray(item), future, time.perf_counter()))
+            self.requests += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=f"MicroBatcher-{self.name}", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def submit_many(self, items) -> list:
+        return [self.submit(item) for item in items]
+
+    def encode(self, items) -> np.ndarray:
+        """同步接口: 提交多个输入并等待, 返回按输入顺序堆叠的输出"""
+        return np.stack([future.result() for future in self.submit_many(items)])
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            # 截止时间从最早的请求提交时算起: 上一批推理期间积压的请求不再额外等待
+            deadline = self.pending[0][2] + self.max_wait
+            while len(self.pending) < self.batch_size and not self.closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            count = min(self.batch_size, len(self.pending))
+            return [self.pending.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # 已被调用方取消的请求不再推理
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if batch:
+                self._process(batch)
+
+    def _process(self, batch: list):
+        start_time = time.perf_counter()
+        count = len(batch)
+        try:
+            inputs = np.stack([item for item, _, _ in batch])
+            if self.pad_to_batch and count < self.batch_size:
+                inputs = np.concatenate([inputs, np.zeros((self.batch_size - count, *inputs.shape[1:]), dtype=inputs.dtype)])
+            outputs = self.encode_fn(inputs)
+            if len(outputs) < count:
+                raise ValueError(f"编码函数返回 {len(outputs)} 行, 少于输入的 {count} 行")
+        except Exception as e:
+            logging.error(f"[{self.name}] 批量推理失败 ({count} 个请求): {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            with self.condition:
+                self.errors += 1
+            return
+        finish_time = time.perf_counter()
+        for row, (_, future, _) in enumerate(batch):
+            future.set_result(outputs[row])
+        with self.condition:
+            self.batches += 1
+            self.items += count
+            if self.pad_to_batch:
+                self.padded_slots += max(0, self.batch_size - count)
+            self.engine_seconds += finish_time - start_time
+            for _, _, submit_time in batch:
+                self.queue_wait_seconds += start_time - submit_time
+                self.latency_seconds += finish_time - submit_time
+                self.max_latency_seconds = max(self.max_latency_seconds, finish_time - submit_time)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "batch_size": self.batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "queued": len(self.pending),
+                "requests": self.requests,
+                "batches": self.batches,
+                "items": self.items,
+                "padded_slots": self.padded_slots,
+                "errors": self.errors,
+                "avg_batch_size": round(self.items / self.batches, 2) if self.batches else None,
+                "items_per_engine_second": round(self.items / self.engine_seconds, 1) if self.engine_seconds else None,
+                "avg_queue_wait_ms": round(self.queue_wait_seconds * 1000 / self.items, 2) if self.items else None,
+                "avg_latency_ms": round(self.latency_seconds * 1000 / self.items, 2) if self.items else None,
+                "max_latency_ms": round(self.max_latency_seconds * 1000, 2),
+            }
+
+    def close(self):
+        """停止后台线程: 已提交的请求仍会完成, 之后的 submit 抛出 RuntimeError"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
@@ -69,6 +69,10 @@ document.addEventListener('DOMContentLoaded', () => {
     const GALLERY_IMAGES_PER_FETCH = 40;
     
     let currentSearchResults = [], displayedSearchResultsCount = 0, isLoadingMoreSearchResults = false;
+    // 服务端返回的下一页游标 (null 表示没有更多结果), 以及文搜图结果的相似度阈值
+    let searchCursor = null, searchResultsThreshold = null;
+    // 正在读取的流式检索 (NDJSON) 请求; 开始新的检索时中止旧的请求
+    let searchStreamController = null, searchStreaming = false;
     const searchResultsBatchSize = 40;
     
     const ENHANCED_SEARCH_THRESHOLD = 0.50; 
@@ -168,10 +172,13 @@ document.addEventListener('DOMContentLoaded', () => {
         galleryTitle.innerHTML = `图片库 (<span id="total-images-count">${galleryTotalImages}</span> 张) <span id="search-results-title" style="display:none;">- 搜索结果</span>`;
 
         // 清理搜索状态
+        cancelSearchStream();
         clearImageSearchFile();
         clearFaceSearchFile();
         currentSearchResults = []; 
         displayedSearchResultsCount = 0;
+        searchCursor = null;
+        searchResultsThreshold = null;
         searchInput.value = '';
         searchStatus.textContent = '';
         mainUploadStatus.textContent = ''; 
@@ -292,7 +299,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function performFaceSearch() {
         clearAllSelections();
+        cancelSearchStream();
         imageGallery.innerHTML = '';
+        currentSearchResults = [];
+        displayedSearchResultsCount = 0;
+        searchCursor = null;
+        searchResultsThreshold = null;
+        noMoreResultsDiv.style.display = 'none';
         loadingGallery.style.display = 'flex';
         faceSearchStatus.textContent = '正在搜索...';
 
@@ -300,22 +313,19 @@ document.addEventListener('DOMContentLoaded', () => {
             // 人脸图片搜索
             const formData = new FormData();
             formData.append('face_query_file', uploadedImageForFaceSearchFile);
+            formData.append('page_size', searchResultsBatchSize);
             faceSearchStatus.textContent = `正在通过图片 "${uploadedImageForFaceSearchFile.name}" 搜索...`;
 
-            fetch('/faces/search_by_face', { method: 'POST', body: formData })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) throw new Error(data.error);
-                    faceSearchStatus.textContent = data.message;
-                    currentSearchResults = data.results || [];
-                    displayedSearchResultsCount = 0;
-                    if(currentSearchResults.length > 0) {
-                        loadMoreSearchResults();
-                    } else {
+            streamSearch('/faces/search_by_face_stream', { method: 'POST', body: formData }, {
+                onMeta: meta => { faceSearchStatus.textContent = meta.message; }
+            })
+                .then(() => {
+                    if (currentSearchResults.length === 0) {
                          imageGallery.innerHTML = `<p>未找到匹配的相似人脸。</p>`;
                     }
                 })
                 .catch(error => {
+                    if (error.name === 'AbortError') return;
                     faceSearchStatus.textContent = `人脸搜索失败: ${error.message}`;
                 })
                 .finally(() => loadingGallery.style.display = 'none');
@@ -328,21 +338,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
             faceSearchStatus.textContent = `正在搜索人名: "${queryName}"...`;
-            // TODO: 后端需要实现 /faces/search?name=... API
-            fetch(`/faces/search?name=${encodeURIComponent(queryName)}`)
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) throw new Error(data.error);
-                    faceSearchStatus.textContent = `为 "${queryName}" 找到 ${data.results.length} 张照片。`;
-                    currentSearchResults = data.results || [];
-                    displayedSearchResultsCount = 0;
-                    if(currentSearchResults.length > 0) {
-                        loadMoreSearchResults();
-                    } else {
+            streamSearch(`/faces/search_stream?name=${encodeURIComponent(queryName)}&page_size=${searchResultsBatchSize}`, {}, {
+                onMeta: meta => { faceSearchStatus.textContent = `为 "${queryName}" 找到 ${meta.total_results || 0} 张照片。`; }
+            })
+                .then(() => {
+                    if (currentSearchResults.length === 0) {
                         imageGallery.innerHTML = `<p>未找到与人名 "${queryName}" 相关的照片。</p>`;
                     }
                 })
                 .catch(error => {
+                    if (error.name === 'AbortError') return;
                     faceSearchStatus.textContent = `人名搜索失败: ${error.message}`;
                 })
                 .finally(() => loadingGallery.style.display = 'none');
@@ -424,9 +429,12 @@ document.addEventListener('DOMContentLoaded', () => {
     // Re-pasting performSearch from your original file for completeness, as it's needed for gallery view.
     function performSearch() {
         clearAllSelections();
+        cancelSearchStream();
         imageGallery.innerHTML = '';
         currentSearchResults = [];
         displayedSearchResultsCount = 0;
+        searchCursor = null;
+        searchResultsThreshold = null;
         loadingGallery.style.display = 'flex';
         searchButton.disabled = true;
         searchStatus.textContent = '正在搜索...';
@@ -440,6 +448,8 @@ document.addEventListener('DOMContentLoaded', () => {
             formData.append('image_query_file', uploadedImageForSearchFile);
             searchStatus.textContent = `正在以图搜图: ${uploadedImageForSearchFile.name}...`;
 
+            formData.append('page_size', searchResultsBatchSize);
+            formData.append('threshold', IMAGE_SEARCH_SIMILARITY_THRESHOLD);
             fetch('/search_by_uploaded_image', { method: 'POST', body: formData })
             .then(response => response.json())
             .then(data => {
@@ -448,9 +458,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     imageGallery.innerHTML = `<p>图搜图失败: ${data.error}</p>`;
                 } else {
                     currentSearchResults = data.results; 
+                    searchCursor = data.cursor || null;
                     const queryFileNameDisplay = data.query_filename || "上传的图片";
                     if (currentSearchResults.length > 0) {
-                        searchStatus.textContent = `图搜图 "${queryFileNameDisplay}": 找到 ${currentSearchResults.length} 张相似图片。`;
+                        searchStatus.textContent = `图搜图 "${queryFileNameDisplay}": 找到 ${data.total_results || currentSearchResults.length} 张相似图片。`;
                         loadMoreSearchResults();
                     } else {
                         searchStatus.textContent = `图搜图 "${queryFileNameDisplay}": 未找到相似度足够高的图片。`;
@@ -478,33 +489,35 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             searchStatus.textContent = `正在文搜图: "${queryText}"...`;
 
-            fetch('/search_images', {
+            streamSearch('/search_images_stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ query_text: queryText, top_k: 200 }) 
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.error) {
-                    searchStatus.textContent = `搜索失败: ${data.error}`;
-                    imageGallery.innerHTML = `<p>搜索失败: ${data.error}</p>`;
-                } else {
-                    const activeSimilarityThreshold = data.search_mode_is_enhanced ? ENHANCED_SEARCH_THRESHOLD : CLIP_ONLY_SEARCH_THRESHOLD;
-                    currentSearchResults = data.results.filter(img => img.similarity >= activeSimilarityThreshold);
-                    
-                    if (currentSearchResults.length > 0) {
-                        searchStatus.textContent = `文搜图 "${queryText}": 找到 ${currentSearchResults.length} 张相关图片。`;
-                        loadMoreSearchResults(); 
+                body: JSON.stringify({ query_text: queryText, top_k: 200, page_size: searchResultsBatchSize }) 
+            }, {
+                onMeta: meta => {
+                    // RRF 融合后的分数是排名分数而不是相似度, 不能按相似度阈值过滤
+                    if (meta.score_type === 'rank') {
+                        searchResultsThreshold = null;
                     } else {
-                        searchStatus.textContent = `文搜图 "${queryText}": 未找到相似度足够高的图片。`;
-                        imageGallery.innerHTML = `<p>未找到与描述 "${queryText}" 匹配且相似度足够高的图片。</p>`;
+                        searchResultsThreshold = meta.search_mode_is_enhanced ? ENHANCED_SEARCH_THRESHOLD : CLIP_ONLY_SEARCH_THRESHOLD;
                     }
+                },
+                // 结果按相似度降序排列, 出现低于阈值的结果后不再读取后续结果
+                filter: img => searchResultsThreshold === null || img.similarity >= searchResultsThreshold
+            })
+            .then(() => {
+                if (currentSearchResults.length > 0) {
+                    searchStatus.textContent = `文搜图 "${queryText}": 找到 ${currentSearchResults.length} 张相关图片。`;
+                } else {
+                    searchStatus.textContent = `文搜图 "${queryText}": 未找到相似度足够高的图片。`;
+                    imageGallery.innerHTML = `<p>未找到与描述 "${queryText}" 匹配且相似度足够高的图片。</p>`;
                 }
             })
             .catch(error => {
+                if (error.name === 'AbortError') return;
                 console.error('文搜图API错误:', error);
-                searchStatus.textContent = '文搜图过程中发生网络错误。';
-                imageGallery.innerHTML = '<p>文搜图过程中发生网络错误。</p>';
+                searchStatus.textContent = `文搜图失败: ${error.message}`;
+                imageGallery.innerHTML = `<p>文搜图失败: ${error.message}</p>`;
             })
             .finally(() => {
                 loadingGallery.style.display = 'none';
@@ -513,8 +526,124 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    function readNdjsonStream(response, onMessage) {
+        // 逐行解析 NDJSON 响应体, 每收到完整的一行即回调; onMessage 返回 false 时取消读取
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!contentType.includes('application/x-ndjson')) {
+            // 参数错误等情况服务端返回普通 JSON
+            return response.json().then(data => { throw new Error(data.error || `HTTP ${response.status}`); });
+        }
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        const pump = () => reader.read().then(({ done, value }) => {
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            const lines = buffer.split('\n');
+            buffer = done ? '' : lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                if (onMessage(JSON.parse(line)) === false) {
+                    reader.cancel();
+                    return;
+                }
+            }
+            if (!done) return pump();
+        });
+        return pump().catch(error => {
+            reader.cancel().catch(() => {});
+            throw error;
+        });
+    }
+
+    function cancelSearchStream() {
+        if (searchStreamController) searchStreamController.abort();
+        searchStreamController = null;
+        searchStreaming = false;
+    }
+
+    function streamSearch(url, fetchOptions, { onMeta, filter } = {}) {
+        // 流式检索: 服务端逐块生成结果, 每收到一块立即渲染, 首屏不必等全部结果生成。
+        // filter 淘汰了一块中的部分结果时 (低于相似度阈值) 停止读取后续结果。
+        cancelSearchStream();
+        const controller = new AbortController();
+        searchStreamController = controller;
+        searchStreaming = true;
+        return fetch(url, { ...fetchOptions, signal: controller.signal })
+            .then(response => readNdjsonStream(response, message => {
+                if (controller !== searchStreamController) return false;
+                if (message.type === 'meta') {
+                    if (onMeta) onMeta(message);
+                } else if (message.type === 'results') {
+                    const passed = filter ? message.results.filter(filter) : message.results;
+                    appendStreamedResults(passed);
+                    return passed.length === message.results.length;
+                } else if (message.type === 'error') {
+                    throw new Error(message.error);
+                }
+                return true;
+            }))
+            .then(() => {
+                if (controller !== searchStreamController) return;
+                searchStreaming = false;
+                if (currentSearchResults.length > 0 && displayedSearchResultsCount >= currentSearchResults.length) {
+                    noMoreResultsDiv.style.display = 'block';
+                }
+            })
+            .finally(() => {
+                if (controller === searchStreamController) {
+                    searchStreamController = null;
+                    searchStreaming = false;
+                }
+            });
+    }
+
+    function appendStreamedResults(results) {
+        currentSearchResults = currentSearchResults.concat(results);
+        // 首屏未填满或已滚动到底部时立即渲染, 其余结果随滚动加载
+        if (displayedSearchResultsCount < searchResultsBatchSize || isNearPageBottom()) {
+            loadMoreSearchResults();
+        }
+    }
+
+    function fetchNextSearchPage() {
+        // 本地结果已展示完, 按游标从服务端取下一页 (服务端只查询元数据, 不重新检索)
+        isLoadingMoreSearchResults = true;
+        loadingGallery.style.display = 'flex';
+        fetch(`/search_results?cursor=${encodeURIComponent(searchCursor)}&page_size=${searchResultsBatchSize}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) throw new Error(data.error);
+                let pageResults = data.results || [];
+                searchCursor = data.cursor || null;
+                if (searchResultsThreshold !== null) {
+                    const passed = pageResults.filter(img => img.similarity >= searchResultsThreshold);
+                    if (passed.length < pageResults.length) searchCursor = null;
+                    pageResults = passed;
+                }
+                currentSearchResults = currentSearchResults.concat(pageResults);
+            })
+            .catch(error => {
+                console.error('加载更多检索结果失败:', error);
+                searchStatus.textContent = `加载更多结果失败: ${error.message}`;
+                searchCursor = null;
+            })
+            .finally(() => {
+                isLoadingMoreSearchResults = false;
+                loadingGallery.style.display = 'none';
+                if (displayedSearchResultsCount < currentSearchResults.length) {
+                    loadMoreSearchResults();
+                } else if (!searchCursor) {
+                    noMoreResultsDiv.style.display = 'block';
+                }
+            });
+    }
+
     function loadMoreSearchResults() {
-        if (isLoadingMoreSearchResults || displayedSearchResultsCount >= currentSearchResults.length) return;
+        if (isLoadingMoreSearchResults) return;
+        if (displayedSearchResultsCount >= currentSearchResults.length) {
+            if (searchCursor) fetchNextSearchPage();
+            return;
+        }
         isLoadingMoreSearchResults = true;
         loadingGallery.style.display = 'flex';
 
@@ -526,7 +655,7 @@ document.addEventListener('DOMContentLoaded', () => {
             noMoreResultsDiv.style.display = 'none';
         }
         
-        if (displayedSearchResultsCount >= currentSearchResults.length) {
+        if (displayedSearchResultsCount >= currentSearchResults.length && !searchCursor && !searchStreaming) {
             noMoreResultsDiv.style.display = 'block';
         }
 
@@ -599,14 +728,14 @@ document.addEventListener('DOMContentLoaded', () => {
             item.dataset.imageId = img.id; 
             item.dataset.originalUrl = img.original_url;
             item.dataset.filename = img.filename;
-            if (isSearchResult && img.similarity !== undefined) {
+            if (isSearchResult && img.similarity != null) {
                 item.dataset.similarity = img.similarity.toFixed(4);
             }
 
             item.innerHTML = `
                 <img src="${img.thumbnail_url || 'https://placehold.co/160x130/eee/ccc?text=NoThumb'}" alt="${img.filename}" onerror="this.onerror=null;this.src='https://placehold.co/160x130/eee/ccc?text=Error';">
                 <p>${img.filename.length > 20 ? img.filename.substring(0, 17) + '...' : img.filename}</p>
-                ${isSearchResult && img.similarity !== undefined ? `<p class="similarity">相似度: ${img.similarity.toFixed(4)}</p>` : ''}
+                ${isSearchResult && img.similarity != null ? `<p class="similarity">相似度: ${img.similarity.toFixed(4)}</p>` : ''}
                 ${img.is_enhanced ? `<span class="enhanced-badge">已增强</span>` : ''}
             `;
 
@@ -621,9 +750,12 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    function isNearPageBottom() {
+        return (window.innerHeight + window.scrollY) >= document.body.offsetHeight - 400;
+    }
+
     function handleInfiniteScroll() {
-        const nearBottom = (window.innerHeight + window.scrollY) >= document.body.offsetHeight - 400;
-        if (!nearBottom) return;
+        if (!isNearPageBottom()) return;
 
         if (currentView === 'gallery') {
             const isSearching = currentSearchResults.length > 0;
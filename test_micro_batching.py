@@ -0,0 +1,128 @@
+# 请求合并调度器 (micro_batching.py) 的测试, 用模拟的固定batch引擎代替 sail.Engine, 不需要TPU。
+# 用法 (在项目根目录执行): python -m pytest -q test_micro_batching.py
+import threading
+import time
+
+import numpy as np
+
+from micro_batching import MicroBatcher
+
+EMBED_DIM = 4
+
+
+class FakeEngine:
+    """模拟输入形状固定的 bmodel: 只接受恰好 batch_size 行的输入, 输出同样 batch_size 行 (包括补零的行)"""
+
+    def __init__(self, batch_size: int, delay: float = 0.0):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.calls = []
+
+    def process(self, batch: np.ndarray) -> np.ndarray:
+        assert batch.shape[0] == self.batch_size, f"引擎收到 {batch.shape[0]} 行, 期望 {self.batch_size}"
+        self.calls.append(batch.copy())
+        time.sleep(self.delay)
+        # 每一行的输出由输入唯一决定, 补零的行输出 -1, 便于检查结果没有错位
+        flat = batch.reshape(batch.shape[0], -1)
+        outputs = np.tile(flat[:, :1], (1, EMBED_DIM)).astype(np.float32)
+        outputs[~flat.any(axis=1)] = -1
+        return outputs
+
+
+def make_item(value: int) -> np.ndarray:
+    return np.full((3, 2, 2), value, dtype=np.float32)
+
+
+def test_results_follow_submission_order():
+    engine = FakeEngine(batch_size=4)
+    batcher = MicroBatcher(engine.process, engine.batch_size, max_wait_ms=50, name="测试")
+    futures = batcher.submit_many([make_item(value) for value in range(1, 11)])
+    results = [future.result(timeout=5) for future in futures]
+    batcher.close()
+    for value, result in zip(range(1, 11), results):
+        assert result.shape == (EMBED_DIM,)
+        assert np.all(result == value)
+    # 10 个请求: 两个满批 + 一个补零到 4 行的批
+    assert len(engine.calls) == 3
+    stats = batcher.stats()
+    assert stats["batches"] == 3 and stats["items"] == 10 and stats["padded_slots"] == 2
+
+
+def test_partial_batch_is_padded_and_trimmed():
+    engine = FakeEngine(batch_size=8)
+    batcher = MicroBatcher(engine.process, engine.batch_size, max_wait_ms=10, name="测试")
+    start_time = time.perf_counter()
+    result = batcher.submit(make_item(7)).result(timeout=5)
+    batcher.close()
+    # 凑不满一批时在截止时间后单独推理
+    assert time.perf_counter() - start_time < 1
+    assert np.all(result == 7)
+    assert len(engine.calls) == 1
+    assert not engine.calls[0][1:].any()
+    assert batcher.stats()["padded_slots"] == 7
+
+
+def test_concurrent_callers_share_batches():
+    engine = FakeEngine(batch_size=4, delay=0.02)
+    batcher = MicroBatcher(engine.process, engine.batch_size, max_wait_ms=20, name="测试")
+    errors = []
+
+    def caller(value):
+        result = batcher.submit(make_item(value)).result(timeout=5)
+        if not np.all(result == value):
+            errors.append(value)
+
+    threads = [threading.Thread(target=caller, args=(value,)) for value in range(1, 17)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert not errors
+    assert batcher.stats()["items"] == 16
+    # 16 个并发请求至少有一部分被合并, 推理次数少于请求数
+    assert len(engine.calls) < 16
+
+
+def test_encode_returns_stacked_rows():
+    engine = FakeEngine(batch_size=3)
+    batcher = MicroBatcher(engine.process, engine.batch_size, max_wait_ms=5, name="测试")
+    outputs = batcher.encode([make_item(value) for value in (5, 6, 7, 8)])
+    batcher.close()
+    assert outputs.shape == (4, EMBED_DIM)
+    assert outputs[:, 0].tolist() == [5, 6, 7, 8]
+
+
+def test_engine_error_fails_whole_batch():
+    def failing_engine(batch):
+        raise RuntimeError("模拟推理失败")
+
+    batcher = MicroBatcher(failing_engine, 2, max_wait_ms=20, name="测试")
+    futures = batcher.submit_many([make_item(1), make_item(2)])
+    for future in futures:
+        try:
+            future.result(timeout=5)
+        except RuntimeError as e:
+            assert "模拟推理失败" in str(e)
+        else:
+            raise AssertionError("推理失败时 Future 应当抛出异常")
+    batcher.close()
+    assert batcher.stats()["errors"] == 1
+
+
+def test_unpadded_batches_keep_actual_size():
+    # CLIP 使用 pad_to_batch=False: 不足一批时按实际行数调用编码函数 (由 BmodelEngine 选择最小的 graph)
+    calls = []
+
+    def variable_engine(batch):
+        calls.append(len(batch))
+        return FakeEngine(batch_size=len(batch)).process(batch)
+
+    batcher = MicroBatcher(variable_engine, 4, max_wait_ms=20, pad_to_batch=False, name="测试")
+    futures = batcher.submit_many([make_item(value) for value in range(1, 7)])
+    results = [future.result(timeout=5) for future in futures]
+    batcher.close()
+    assert [int(result[0]) for result in results] == [1, 2, 3, 4, 5, 6]
+    assert calls == [4, 2]
+    stats = batcher.stats()
+    assert stats["items"] == 6 and stats["padded_slots"] == 0
@@ -0,0 +1,88 @@
+# 对比完整读取与 mmap 延迟加载两种方式的 FAISS 索引冷启动耗时
+# 用法 (在项目根目录执行):
+#   python tools/bench_cold_start.py --sizes 10000,100000,1000000
+#   python tools/bench_cold_start.py --sizes 100000 --tier ivf --workdir /data/bench
+# 注意: 1M x 1024 维的 float32 索引约 4GB, 生成时需要约两倍于此的内存和同样大小的磁盘空间。
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import faiss_log_utils as flog
+import faiss_utils as fu
+
+
+def drop_file_cache(path):
+    """尽量将索引文件移出页缓存以模拟冷启动 (不需要root权限, 仅Linux有效)"""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def build_index_file(path, num, dim, tier):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((num, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    builder = fu.ManagedIndex(dim, path="", name="bench")
+    index = builder._build(tier, fu.STORAGE_FLOAT32, np.arange(1, num + 1, dtype=np.int64), vectors)
+    flog.write_index_atomic(index, path)
+    return vectors[rng.choice(num, 10, replace=False)]
+
+
+def measure(path, dim, queries, lazy):
+    drop_file_cache(path)
+    managed = fu.ManagedIndex(dim, path, name="bench")
+    start_time = time.time()
+    managed.load_or_create(lazy=lazy)
+    load_seconds = time.time() - start_time
+    managed.search(queries[:1], 10)
+    first_search_seconds = time.time() - start_time
+    if lazy:
+        while managed.read_only and managed.promote_seconds is None:
+            time.sleep(0.05)
+    writable_seconds = time.time() - start_time
+    return load_seconds, first_search_seconds, writable_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FAISS 索引冷启动基准测试")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="逗号分隔的向量数量")
+    parser.add_argument("--dim", type=int, default=fu.CLIP_EMBEDDING_DIM)
+    parser.add_argument("--tier", choices=fu.INDEX_TIER_ORDER, default=fu.INDEX_TIER_FLAT)
+    parser.add_argument("--workdir", default=None, help="存放测试索引文件的目录 (默认系统临时目录)")
+    args = parser.parse_args()
+
+    if fu.MMAP_IO_FLAG is None:
+        print("当前 faiss 版本不支持 IO_FLAG_MMAP_IFC, 延迟加载会退回完整读取。")
+    # 测试期间不触发自动迁移
+    fu.index_settings.update(ivf_threshold=0, hnsw_threshold=0)
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        print(f"{'向量数量':>10}{'文件(MB)':>10}{'模式':>8}{'加载(s)':>10}{'首次检索(s)':>14}{'可写(s)':>10}")
+        for num in [int(size) for size in args.sizes.split(",")]:
+            path = os.path.join(workdir, f"bench_{num}.index")
+            queries = build_index_file(path, num, args.dim, args.tier)
+            size_mb = os.path.getsize(path) / 1024 ** 2
+            for lazy in (False, True):
+                load_seconds, first_search_seconds, writable_seconds = measure(path, args.dim, queries, lazy)
+                print(f"{num:>10}{size_mb:>10.1f}{'mmap' if lazy else 'full':>8}"
+                      f"{load_seconds:>10.3f}{first_search_seconds:>14.3f}{writable_seconds:>10.3f}")
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# 对比 /images?limit=100 构建响应时逐个 stat 文件与读取数据库文件标志位两种方式的耗时
+# 用法 (在项目根目录执行):
+#   python tools/bench_image_list.py --images 10000 --limit 100
+#   python tools/bench_image_list.py --workdir /mnt/nas/bench --repeat 50
+#   python tools/bench_image_list.py --stat-delay-ms 0.5   # 模拟 NAS 上每次 stat 的往返延迟
+# 两种方式的行格式化逻辑与 app.get_images_list_api 修改前后一致; 数据库查询 (db.get_all_images) 两者相同。
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import database_utils as db
+
+
+def build_album(workdir, num_images, missing_ratio):
+    """生成 num_images 条图片记录及对应的原图/缩略图文件, 其中 missing_ratio 比例的缩略图文件不存在"""
+    os.makedirs(os.path.join(workdir, "uploads"), exist_ok=True)
+    os.makedirs(os.path.join(workdir, "thumbnails"), exist_ok=True)
+    db.DATABASE_PATH = os.path.join(workdir, "data", "bench.db")
+    db.init_db()
+    missing_every = int(1 / missing_ratio) if missing_ratio > 0 else 0
+    rows = []
+    for i in range(1, num_images + 1):
+        original_path = os.path.join("uploads", f"{i}.jpg")
+        thumbnail_path = os.path.join("thumbnails", f"{i}_thumb.jpg")
+        open(os.path.join(workdir, original_path), "wb").close()
+        thumbnail_exists = not (missing_every and i % missing_every == 0)
+        if thumbnail_exists:
+            open(os.path.join(workdir, thumbnail_path), "wb").close()
+        rows.append((f"{i}.jpg", original_path, thumbnail_path, json.dumps([]), True, thumbnail_exists))
+    conn = db.get_db_connection()
+    conn.executemany("""
+        INSERT INTO images (original_filename, original_path, thumbnail_path, user_tags, original_exists, thumbnail_exists)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def format_rows_with_stat(images, workdir, stat_delay):
+    """修改前: 每一行对缩略图和原图各调用一次 os.path.exists"""
+    def exists(path):
+        if stat_delay:
+            time.sleep(stat_delay)
+        return os.path.exists(path)
+
+    results = []
+    for img_row in images:
+        relative_original_path = img_row['original_path']
+        relative_thumbnail_path = img_row['thumbnail_path']
+        thumbnail_url = f"/thumbnails/{os.path.basename(relative_thumbnail_path)}" if relative_thumbnail_path and exists(os.path.join(workdir, relative_thumbnail_path)) else None
+        original_url = f"/uploads/{os.path.basename(relative_original_path)}" if relative_original_path and exists(os.path.join(workdir, relative_original_path)) else None
+        results.append({"id": img_row["id"], "thumbnail_url": thumbnail_url, "original_url": original_url})
+    return results
+
+
+def format_rows_with_flags(images, workdir, stat_delay):
+    """修改后: 只根据 original_exists / thumbnail_exists 拼接URL"""
+    results = []
+    for img_row in images:
+        thumbnail_path = img_row["thumbnail_path"]
+        original_path = img_row["original_path"]
+        thumbnail_url = f"/thumbnails/{os.path.basename(thumbnail_path)}" if thumbnail_path and img_row["thumbnail_exists"] else None
+        original_url = f"/uploads/{os.path.basename(original_path)}" if original_path and img_row["original_exists"] else None
+        results.append({"id": img_row["id"], "thumbnail_url": thumbnail_url, "original_url": original_url})
+    return results
+
+
+def measure(format_fn, args, workdir):
+    timings = []
+    results = None
+    for _ in range(args.repeat):
+        start_time = time.perf_counter()
+        images, _ = db.get_all_images(1, args.limit)
+        results = format_fn(images, workdir, args.stat_delay_ms / 1000)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(timings), max(timings), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/images 列表响应构建基准测试")
+    parser.add_argument("--images", type=int, default=10000, help="相册中的图片数量")
+    parser.add_argument("--limit", type=int, default=100, help="每页数量 (对应 /images?limit=)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--missing-ratio", type=float, default=0.01, help="缩略图缺失的比例")
+    parser.add_argument("--stat-delay-ms", type=float, default=0.0, help="为每次 stat 额外增加的延迟, 用于模拟网络存储")
+    parser.add_argument("--workdir", default=None, help="存放测试文件的目录, 指向 NAS 挂载点可测量真实的 stat 开销 (默认系统临时目录)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        build_album(workdir, args.images, args.missing_ratio)
+        before_median, before_max, before_results = measure(format_rows_with_stat, args, workdir)
+        after_median, after_max, after_results = measure(format_rows_with_flags, args, workdir)
+        if before_results != after_results:
+            print("警告: 两种方式生成的URL不一致!")
+        print(f"图片数量 {args.images}, limit={args.limit}, 重复 {args.repeat} 次, 每次stat额外延迟 {args.stat_delay_ms}ms")
+        print(f"{'方式':<12}{'中位数(ms)':>12}{'最大(ms)':>12}")
+        print(f"{'stat 文件':<12}{before_median:>12.2f}{before_max:>12.2f}")
+        print(f"{'数据库标志位':<12}{after_median:>12.2f}{after_max:>12.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# 对比大尺寸 JPEG 原尺寸解码与 DCT 缩小解码 (image_loader) 在 CLIP 预处理和缩略图生成上的单张耗时
+# 用法 (在项目根目录执行):
+#   python tools/bench_image_loader.py --sizes 4000x3000,8000x6000 --count 10
+#   python tools/bench_image_loader.py --image_dir ./uploads --count 50
+# 同时给出两种解码方式得到的CLIP预处理输入的平均差异, 用于评估缩小解码对向量的影响。
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_loader
+from clip import ImagePreprocessor
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+
+def make_jpegs(workdir, sizes, count, quality):
+    """生成带渐变与噪声的测试 JPEG (接近照片的压缩率)"""
+    rng = np.random.default_rng(0)
+    paths = []
+    for width, height in sizes:
+        for i in range(count):
+            small = rng.integers(0, 256, (height // 64 + 1, width // 64 + 1, 3), dtype=np.uint8)
+            image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+            image = cv2.add(image, rng.integers(0, 24, image.shape, dtype=np.uint8))
+            path = os.path.join(workdir, f"{width}x{height}_{i}.jpg")
+            cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            paths.append(path)
+    return paths
+
+
+def time_per_image(fn, paths, repeat):
+    """重复 repeat 次取最快的一次, 返回单张平均耗时 (毫秒)"""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for path in paths:
+            fn(path)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(paths)
+
+
+def full_thumbnail(path, size):
+    # 改动前的 generate_thumbnail; 关闭 reducing_gap, 避免 Image.thumbnail 自行调用 draft
+    img = Image.open(path)
+    img.thumbnail(size, reducing_gap=None)
+    return img
+
+
+def reduced_thumbnail(path, size):
+    img = image_loader.open_pil(path, size)
+    img.thumbnail(size)
+    return img
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JPEG 缩小解码基准测试")
+    parser.add_argument("--image_dir", default="", help="测试 JPEG 目录, 不指定时生成测试图片")
+    parser.add_argument("--sizes", default="4000x3000,8000x6000", help="生成测试图片的尺寸, 逗号分隔的 宽x高")
+    parser.add_argument("--count", type=int, default=10, help="每种尺寸生成的图片数 (指定目录时为读取的图片数)")
+    parser.add_argument("--quality", type=int, default=90, help="生成测试图片的 JPEG 质量")
+    parser.add_argument("--resolution", type=int, default=224, help="CLIP 图像编码器输入分辨率")
+    parser.add_argument("--thumbnail_size", type=int, default=256, help="缩略图尺寸")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数, 取最快的一次")
+    args = parser.parse_args()
+
+    workdir = None
+    if args.image_dir:
+        names = sorted(name for name in os.listdir(args.image_dir) if name.lower().endswith(JPEG_EXTENSIONS))
+        paths = [os.path.join(args.image_dir, name) for name in names[:args.count]]
+    else:
+        workdir = tempfile.mkdtemp(prefix="bench_image_loader_")
+        sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes.split(",") if size]
+        paths = make_jpegs(workdir, sizes, args.count, args.quality)
+    if not paths:
+        print("没有可用的测试 JPEG")
+        return
+
+    try:
+        preprocessor = ImagePreprocessor(args.resolution)
+        thumbnail_size = (args.thumbnail_size, args.thumbnail_size)
+        rows = [
+            ("CLIP 解码", lambda path: cv2.imread(path), lambda path: image_loader.read_bgr(path, args.resolution)),
+            ("CLIP 解码+预处理", lambda path: preprocessor.preprocess(cv2.imread(path)),
+             lambda path: preprocessor.preprocess(image_loader.read_bgr(path, args.resolution))),
+            ("缩略图", lambda path: full_thumbnail(path, thumbnail_size), lambda path: reduced_thumbnail(path, thumbnail_size)),
+        ]
+        pixels = [Image.open(path).size for path in paths]
+        print(f"{len(paths)} 张 JPEG, 平均 {np.mean([w * h for w, h in pixels]) / 1e6:.1f} MP")
+        print(f"{'阶段':<20}{'原尺寸解码(ms/张)':>20}{'缩小解码(ms/张)':>20}{'加速比':>10}")
+        for name, full_fn, reduced_fn in rows:
+            before = time_per_image(full_fn, paths, args.repeat)
+            after = time_per_image(reduced_fn, paths, args.repeat)
+            print(f"{name:<20}{before:>20.2f}{after:>20.2f}{before / after:>10.2f}")
+
+        diffs = [float(np.abs(preprocessor.preprocess(cv2.imread(path)) - preprocessor.preprocess(image_loader.read_bgr(path, args.resolution))).mean())
+                 for path in paths]
+        factors = [image_loader.reduction_factor(size, args.resolution) for size in pixels]
+        print(f"缩小比例: {sorted(set(factors))}, CLIP 预处理输入的平均绝对差异: {np.mean(diffs):.4f} (归一化后的数值)")
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# 对比CLIP图像预处理改为 float32 查表归一化前后的单张耗时, 并检查两种方式的输出一致
+# 用法 (在项目根目录执行):
+#   python tools/bench_preprocess.py --count 200
+#   python tools/bench_preprocess.py --image_dir ./uploads --count 500 --batch_size 4
+# 原方式: letterbox 后 (image/255 - mean)/std 以 float64 计算, 转置后逐张 expand_dims, 再拼接成批;
+# 新方式: letterbox 后按通道查表, 归一化结果直接写入复用的 (B, 3, H, W) float32 批量缓冲的对应行 (与批量CLIP分析的解码线程相同)。
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clip import ImagePreprocessor
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def load_images(image_dir, count, rng):
+    """读取 image_dir 中的图片 (不计入预处理耗时); 未指定目录时生成不同尺寸的随机图片"""
+    if image_dir:
+        names = sorted(name for name in os.listdir(image_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+        images = [cv2.imread(os.path.join(image_dir, name)) for name in names[:count]]
+        return [image for image in images if image is not None]
+    sizes = [(480, 640), (1080, 1920), (3024, 4032), (800, 600)]
+    return [rng.integers(0, 256, (*sizes[i % len(sizes)], 3), dtype=np.uint8) for i in range(count)]
+
+
+def legacy_preprocess(preprocessor, image):
+    """改动前的 preprocess_cpu_letterbox (letterbox 后未做颜色转换, 以 float64 归一化)"""
+    letterbox_img, _, _ = preprocessor.letterbox(image, new_shape=(preprocessor.image_resolution, preprocessor.image_resolution),
+                                                 color=(114, 114, 114), auto=False, scaleFill=False, scaleup=True, stride=32)
+    image = letterbox_img.astype('float32')
+    image = (image/255-preprocessor.mean)/preprocessor.std
+    return np.transpose(image, (2, 0, 1))
+
+
+def time_per_image(fn, images, batch_size, repeat):
+    """重复 repeat 次取最快的一次, 返回单张平均耗时 (毫秒)"""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for start in range(0, len(images), batch_size):
+            fn(images[start:start + batch_size])
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000 / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLIP 图像预处理基准测试")
+    parser.add_argument("--image_dir", default="", help="测试图片目录, 不指定时使用随机生成的图片")
+    parser.add_argument("--count", type=int, default=200, help="图片数量")
+    parser.add_argument("--batch_size", type=int, default=4, help="每批图片数 (与图像编码器最大 batch 一致)")
+    parser.add_argument("--resolution", type=int, default=224, help="图像编码器输入分辨率")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数, 取最快的一次")
+    args = parser.parse_args()
+
+    preprocessor = ImagePreprocessor(args.resolution)
+    images = load_images(args.image_dir, args.count, np.random.default_rng(0))
+    if not images:
+        print("没有可用的测试图片")
+        return
+    batch_buffer = np.empty((args.batch_size, 3, args.resolution, args.resolution), dtype=np.float32)
+
+    def legacy_batch(batch):
+        return np.concatenate([np.expand_dims(legacy_preprocess(preprocessor, image), axis=0) for image in batch], axis=0)
+
+    def lut_batch(batch):
+        for row, image in enumerate(batch):
+            preprocessor.preprocess(image, out=batch_buffer[row])
+        return batch_buffer[:len(batch)]
+
+    max_diff = max(float(np.abs(legacy_preprocess(preprocessor, image) - preprocessor.preprocess(image)).max()) for image in images)
+    print(f"{len(images)} 张图片, 分辨率 {args.resolution}, 每批 {args.batch_size} 张")
+    print(f"两种方式输出的最大绝对误差: {max_diff:.2e} (float32 舍入)")
+
+    # 单独测量归一化部分: 输入为已 letterbox 的 uint8 图像
+    letterboxed = [preprocessor.letterbox(image, new_shape=(args.resolution, args.resolution))[0] for image in images]
+    normalize_legacy = time_per_image(lambda batch: np.stack([np.transpose((image.astype('float32')/255-preprocessor.mean)/preprocessor.std, (2, 0, 1)) for image in batch]),
+                                      letterboxed, args.batch_size, args.repeat)
+    normalize_lut = time_per_image(lambda batch: [preprocessor.normalize_into(image, batch_buffer[row]) for row, image in enumerate(batch)],
+                                   letterboxed, args.batch_size, args.repeat)
+    total_legacy = time_per_image(legacy_batch, images, args.batch_size, args.repeat)
+    total_lut = time_per_image(lut_batch, images, args.batch_size, args.repeat)
+
+    print(f"{'阶段':<16}{'原方式(ms/张)':>16}{'查表(ms/张)':>16}{'加速比':>10}")
+    for name, before, after in (("归一化+组批", normalize_legacy, normalize_lut), ("完整预处理", total_legacy, total_lut)):
+        print(f"{name:<16}{before:>16.3f}{after:>16.3f}{before / after:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# 对比三种文本检索方式的召回率与耗时:
+#   concat    旧版 1792 维拼接索引 (CLIP + BCE 拼接后精确内积检索), 作为召回率的基准
+#   fused     当前的 search_fused: 在 CLIP 索引和 BCE 索引中分别检索 top_k 后加权融合
+#   two_stage search_two_stage: 只在 CLIP 索引中取候选, 再对候选计算 BCE 相似度重排
+# 用法 (在项目根目录执行):
+#   python tools/bench_two_stage.py --num 100000 --top_k 50
+#   python tools/bench_two_stage.py --num 200000 --tier ivf --candidates 100 300 1000
+# 向量为带聚类结构的合成数据, 同一张图片的 CLIP 与 BCE 向量属于同一个聚类; 不包含关键词 (BM25) 打分的耗时。
+import argparse
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import faiss_utils as fu
+
+
+def normalize(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def make_album(num, enhanced_ratio, seed=0):
+    """生成 CLIP / BCE 向量, 同一聚类的图片在两个空间中都相近; 只有 enhanced_ratio 比例的图片有 BCE 向量"""
+    rng = np.random.default_rng(seed)
+    num_clusters = max(1, num // 50)
+    clusters = rng.integers(0, num_clusters, num)
+    clip_centers = rng.standard_normal((num_clusters, fu.CLIP_EMBEDDING_DIM)).astype(np.float32)
+    bce_centers = rng.standard_normal((num_clusters, fu.BCE_EMBEDDING_DIM)).astype(np.float32)
+    clip_vectors = normalize(clip_centers[clusters] + 0.8 * rng.standard_normal((num, fu.CLIP_EMBEDDING_DIM)).astype(np.float32))
+    bce_vectors = normalize(bce_centers[clusters] + 0.8 * rng.standard_normal((num, fu.BCE_EMBEDDING_DIM)).astype(np.float32))
+    enhanced = rng.random(num) < enhanced_ratio
+    return clip_vectors, bce_vectors, enhanced
+
+
+def make_queries(clip_vectors, bce_vectors, num_queries, noise, seed=1):
+    """以随机图片的向量加噪声作为查询, 模拟与图片语义相关的文本查询"""
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(clip_vectors), num_queries)
+    def noisy(vectors):
+        # 噪声的范数约为向量本身的 noise 倍
+        return normalize(vectors + noise * rng.standard_normal(vectors.shape).astype(np.float32) / np.sqrt(vectors.shape[1]))
+    return noisy(clip_vectors[picks]), noisy(bce_vectors[picks])
+
+
+def build_index(index_name, dim, tier, ids, vectors):
+    managed = fu.ManagedIndex(dim, path="", name=f"bench-{index_name}")
+    managed.index = managed._build(tier, fu.STORAGE_FLOAT32, ids, vectors)
+    managed.tier = tier
+    managed.index_storage = fu.STORAGE_FLOAT32
+    fu.indexes[index_name] = managed
+    return managed
+
+
+def timed(search_fn, num_queries):
+    """依次执行每个查询, 返回 (每个查询的结果ID列表, 平均耗时ms)"""
+    results = []
+    start_time = time.perf_counter()
+    for row in range(num_queries):
+        results.append(search_fn(row))
+    return results, (time.perf_counter() - start_time) * 1000 / num_queries
+
+
+def recall(results, truth):
+    return float(np.mean([len(set(result) & set(expected)) / len(expected) for result, expected in zip(results, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="两阶段检索 (CLIP 候选 + BCE 重排) 基准测试")
+    parser.add_argument("--num", type=int, default=100000, help="图片数量")
+    parser.add_argument("--enhanced_ratio", type=float, default=0.5, help="已增强 (有BCE向量) 的图片比例")
+    parser.add_argument("--tier", choices=fu.INDEX_TIER_ORDER, default=fu.INDEX_TIER_FLAT, help="CLIP / BCE 索引类型")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--query_noise", type=float, default=1.0, help="查询相对于原图片向量的噪声大小, 越大查询越模糊")
+    parser.add_argument("--candidates", type=int, nargs="+", default=[100, 300, 1000], help="两阶段检索的候选数量")
+    args = parser.parse_args()
+
+    clip_vectors, bce_vectors, enhanced = make_album(args.num, args.enhanced_ratio)
+    ids = np.arange(1, args.num + 1, dtype=np.int64)
+    clip_queries, bce_queries = make_queries(clip_vectors, bce_vectors, args.queries, args.query_noise)
+
+    # 旧版拼接索引: 未增强图片的 BCE 部分为零向量, 内积即 CLIP 相似度 + BCE 相似度
+    concat_vectors = np.hstack([clip_vectors, bce_vectors * enhanced[:, None]]).astype(np.float32)
+    concat_queries = np.hstack([clip_queries, bce_queries]).astype(np.float32)
+    concat_index = faiss.IndexIDMap2(faiss.IndexFlatIP(concat_vectors.shape[1]))
+    concat_index.add_with_ids(concat_vectors, ids)
+    del concat_vectors
+
+    build_index(fu.CLIP_INDEX, fu.CLIP_EMBEDDING_DIM, args.tier, ids, clip_vectors)
+    build_index(fu.BCE_INDEX, fu.BCE_EMBEDDING_DIM, args.tier, ids[enhanced], bce_vectors[enhanced])
+
+    def query_vectors(row):
+        return {fu.CLIP_INDEX: clip_queries[row], fu.BCE_INDEX: bce_queries[row]}
+
+    truth, concat_ms = timed(lambda row: concat_index.search(concat_queries[row:row + 1], args.top_k)[1][0].tolist(), args.queries)
+    print(f"图片数量 {args.num} (已增强 {int(enhanced.sum())}), 索引类型 {args.tier}, 查询数 {args.queries}, top_k {args.top_k}")
+    print(f"{'方式':<20}{'recall':>10}{'耗时(ms)':>12}")
+    print(f"{'concat (1792维)':<20}{1.0:>10.4f}{concat_ms:>12.3f}")
+
+    fused, fused_ms = timed(lambda row: fu.search_fused(query_vectors(row), args.top_k)[1], args.queries)
+    print(f"{'fused':<20}{recall(fused, truth):>10.4f}{fused_ms:>12.3f}")
+
+    for num_candidates in args.candidates:
+        two_stage, two_stage_ms = timed(
+            lambda row: fu.search_two_stage(query_vectors(row), args.top_k, num_candidates=num_candidates)[1], args.queries)
+        print(f"{f'two_stage ({num_candidates})':<20}{recall(two_stage, truth):>10.4f}{two_stage_ms:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# wsgi.py
+# 多进程部署的 WSGI 入口: gunicorn -c gunicorn.conf.py wsgi:application
+# 模块在 gunicorn 主进程中加载一次 (preload_app), 只初始化配置与数据库;
+# 各 worker fork 之后由 gunicorn.conf.py 的 post_fork 调用 app.init_worker 加载索引并连接推理服务。
+import app as album_app
+
+album_app.init_shared_state()
+application = album_app.app